@@ -0,0 +1,162 @@
+"""
+任务日志：claude 的 stdout/stderr 边运行边写入每个任务自己的日志文件，内存占用与输出大小无关。
+日志文件超过大小上限时轮转，旧文件 gzip 压缩；GET /jobs/{id}/log 可实时 tail 当前文件。
+"""
+import asyncio
+import gzip
+import logging
+import os
+import shutil
+import time
+from collections.abc import AsyncIterator
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# 任务日志目录，默认 InternalCodeReviewServer/logs/jobs
+JOB_LOG_DIR = os.environ.get("JOB_LOG_DIR", "").strip() or str(
+    Path(__file__).resolve().parent / "logs" / "jobs"
+)
+# 单个日志文件的大小上限（字节），超出后轮转
+JOB_LOG_MAX_BYTES = int(os.environ.get("JOB_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+# 每个任务保留的轮转文件数（<id>.log.1.gz ...），超出的删除
+JOB_LOG_BACKUPS = int(os.environ.get("JOB_LOG_BACKUPS", "3"))
+# 日志保留天数，启动时清理更早的文件；0 表示不清理
+JOB_LOG_RETENTION_DAYS = float(os.environ.get("JOB_LOG_RETENTION_DAYS", "7"))
+
+_TAIL_POLL_INTERVAL = 0.5
+
+
+def log_path(job_id: str) -> Path:
+    return Path(JOB_LOG_DIR) / f"{job_id}.log"
+
+
+def _compress(src: Path, dst: Path) -> None:
+    with open(src, "rb") as f_in, gzip.open(dst, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    src.unlink()
+
+
+class JobLog:
+    """单个任务的日志文件（追加写，按大小轮转并压缩旧文件）。"""
+
+    def __init__(self, job_id: str, max_bytes: int = JOB_LOG_MAX_BYTES, backups: int = JOB_LOG_BACKUPS):
+        self.path = log_path(job_id)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.written = 0
+        self._size = 0
+        self._file = None
+
+    def open(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "ab")
+        self._size = self._file.tell()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    async def write(self, data: bytes) -> None:
+        if self._file is None:
+            return
+        if self.max_bytes > 0 and self._size + len(data) > self.max_bytes and self._size > 0:
+            await self._rotate()
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+        self.written += len(data)
+
+    async def write_line(self, text: str) -> None:
+        await self.write((text + "\n").encode("utf-8"))
+
+    async def _rotate(self) -> None:
+        """<id>.log -> <id>.log.1.gz，已有的 .N.gz 依次后移，超出 backups 的删除。"""
+        self._file.close()
+        base = self.path
+        rotated = base.with_name(f"{base.name}.rotating")
+        try:
+            # Windows 下文件正被 tail 打开时无法改名，本次先不轮转，继续追加
+            base.rename(rotated)
+        except OSError as e:
+            logger.debug("[job-log] 暂缓轮转 %s: %s", base, e)
+            self._file = open(base, "ab")
+            self._size = self._file.tell()
+            return
+        for n in range(self.backups, 0, -1):
+            older = base.with_name(f"{base.name}.{n}.gz")
+            if not older.exists():
+                continue
+            if n >= self.backups:
+                older.unlink()
+            else:
+                older.rename(base.with_name(f"{base.name}.{n + 1}.gz"))
+        self._file = open(base, "ab")
+        self._size = 0
+        if self.backups > 0:
+            await asyncio.to_thread(_compress, rotated, base.with_name(f"{base.name}.1.gz"))
+        else:
+            rotated.unlink()
+
+
+async def tail(job_id: str, offset: int, is_active) -> AsyncIterator[bytes]:
+    """
+    从 offset 开始读取任务当前日志文件；is_active() 为真时持续等待新内容，任务结束且读完后停止。
+    读到末尾时若文件已被轮转，先读完旧文件（已打开的句柄仍可读）再从新文件开头继续，不丢内容。
+    """
+    path = log_path(job_id)
+    f = None
+    finishing = False
+    try:
+        while True:
+            if f is None:
+                try:
+                    f = open(path, "rb")
+                except FileNotFoundError:
+                    if not is_active():
+                        return
+                    await asyncio.sleep(_TAIL_POLL_INTERVAL)
+                    continue
+                f.seek(max(0, offset))
+                offset = 0
+            chunk = f.read(64 * 1024)
+            if chunk:
+                yield chunk
+                continue
+            try:
+                rotated = os.stat(path).st_ino != os.fstat(f.fileno()).st_ino
+            except FileNotFoundError:
+                rotated = False  # 轮转中，新文件尚未创建
+            if rotated:
+                f.close()
+                f = None
+                continue
+            if finishing:
+                return
+            if not is_active():
+                # 任务已结束，再读一次，取到结束前最后写入的内容
+                finishing = True
+                continue
+            await asyncio.sleep(_TAIL_POLL_INTERVAL)
+    finally:
+        if f is not None:
+            f.close()
+
+
+def cleanup_old_logs(retention_days: float = JOB_LOG_RETENTION_DAYS) -> None:
+    """删除超过保留天数的任务日志。"""
+    log_dir = Path(JOB_LOG_DIR)
+    if retention_days <= 0 or not log_dir.is_dir():
+        return
+    cutoff = time.time() - retention_days * 86400
+    removed = 0
+    for p in log_dir.iterdir():
+        try:
+            if p.is_file() and p.stat().st_mtime < cutoff:
+                p.unlink()
+                removed += 1
+        except OSError as e:
+            logger.warning("[job-log] 删除旧日志失败 %s: %s", p, e)
+    if removed:
+        logger.info("[job-log] 已清理 %d 个超过 %s 天的任务日志", removed, retention_days)
@@ -0,0 +1,140 @@
+"""
+review 任务持久化：任务在返回 202 之前写入本地 SQLite，状态变化（开始执行、结束）同步更新。
+服务重启或崩溃后，等待中与执行中断的任务在启动时重新入队，不必等 GitHub 再次推送。
+执行中的任务持有租约（lease_until）并定期续约；启动时租约未过期的任务推迟到租约到期后再执行，
+避免与仍在运行的另一个实例重复审查。
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+REVIEW_PERSIST = os.environ.get("REVIEW_PERSIST", "1").strip().lower() in ("1", "true", "yes")
+# 任务库文件路径，默认 InternalCodeReviewServer/data/jobs.db
+REVIEW_DB_PATH = os.environ.get("REVIEW_DB_PATH", "").strip() or str(
+    Path(__file__).resolve().parent / "data" / "jobs.db"
+)
+# 执行中任务的租约秒数，每 1/3 租约续约一次；进程退出后租约到期即可被重新执行
+REVIEW_LEASE_SECONDS = float(os.environ.get("REVIEW_LEASE_SECONDS", "60"))
+# 单个任务最多执行次数（含重启后的重新执行），超过后标记为 failed，避免反复导致崩溃的任务无限重试
+REVIEW_MAX_ATTEMPTS = int(os.environ.get("REVIEW_MAX_ATTEMPTS", "3"))
+
+# 未结束的任务状态：queued 等待中，其余为执行中
+ACTIVE_STATES = ("queued", "fetching", "throttled", "reviewing")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    repo TEXT NOT NULL,
+    pr_number INTEGER NOT NULL,
+    head_sha TEXT NOT NULL,
+    base_sha TEXT NOT NULL,
+    pr_title TEXT NOT NULL DEFAULT '',
+    pr_author TEXT NOT NULL DEFAULT '',
+    head_ref TEXT NOT NULL DEFAULT '',
+    base_ref TEXT NOT NULL DEFAULT '',
+    state TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    not_before REAL NOT NULL DEFAULT 0,
+    lease_until REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, created_at);
+"""
+
+# 直接存为列的字段；其余（mode、phases、superseded_by、cached_from、PR 规模、超时）存入 extra JSON
+_COLUMNS = (
+    "id", "repo", "pr_number", "head_sha", "base_sha", "pr_title", "pr_author", "head_ref", "base_ref",
+    "state", "created_at", "started_at", "finished_at", "not_before", "attempts",
+)
+_EXTRA = ("mode", "phases", "superseded_by", "cached_from", "changed_files", "changed_lines", "timeout")
+
+
+class JobStore:
+    """
+    SQLite 任务库。写入都很小（单行），在事件循环中同步执行；
+    WAL + synchronous=NORMAL 下进程崩溃不丢已提交的数据（断电可能丢最后几条）。
+    """
+
+    def __init__(self, path: str = REVIEW_DB_PATH, lease_seconds: float = REVIEW_LEASE_SECONDS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def open(self) -> None:
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        self._conn = conn
+        logger.info("[store] 任务库已打开 path=%s", self.path)
+
+    def close(self) -> None:
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+            self._conn = None
+
+    def save(self, job: Any, lease_until: float = 0.0) -> None:
+        """写入任务的当前状态（插入或覆盖）。"""
+        values = [getattr(job, name) for name in _COLUMNS]
+        extra = json.dumps({name: getattr(job, name) for name in _EXTRA}, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO jobs ({', '.join(_COLUMNS)}, lease_until, extra) "
+                f"VALUES ({', '.join('?' * len(_COLUMNS))}, ?, ?)",
+                (*values, lease_until, extra),
+            )
+
+    def renew(self, job_id: str) -> None:
+        """延长执行中任务的租约。"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ?", (time.time() + self.lease_seconds, job_id)
+            )
+
+    def prune(self, keep: int) -> None:
+        """只保留最近 keep 个已结束的任务。"""
+        placeholders = ", ".join("?" * len(ACTIVE_STATES))
+        with self._lock:
+            self._conn.execute(
+                f"DELETE FROM jobs WHERE state NOT IN ({placeholders}) AND id NOT IN "
+                f"(SELECT id FROM jobs WHERE state NOT IN ({placeholders}) ORDER BY created_at DESC LIMIT ?)",
+                (*ACTIVE_STATES, *ACTIVE_STATES, keep),
+            )
+
+    def load(self, history: int) -> tuple[list[dict[str, Any]], list[dict[str, Any]]]:
+        """
+        返回 (未结束的任务, 最近 history 个已结束的任务)，均按创建时间正序。
+        每个任务为字段字典，另含 lease_until。
+        """
+        placeholders = ", ".join("?" * len(ACTIVE_STATES))
+        columns = f"{', '.join(_COLUMNS)}, lease_until, extra"
+        with self._lock:
+            active = self._conn.execute(
+                f"SELECT {columns} FROM jobs WHERE state IN ({placeholders}) ORDER BY created_at",
+                ACTIVE_STATES,
+            ).fetchall()
+            finished = self._conn.execute(
+                f"SELECT {columns} FROM jobs WHERE state NOT IN ({placeholders}) "
+                "ORDER BY created_at DESC LIMIT ?",
+                (*ACTIVE_STATES, history),
+            ).fetchall()
+        return [self._row(r) for r in active], [self._row(r) for r in reversed(finished)]
+
+    @staticmethod
+    def _row(row: tuple) -> dict[str, Any]:
+        fields = dict(zip((*_COLUMNS, "lease_until"), row[:-1]))
+        fields.update(json.loads(row[-1]))
+        return fields
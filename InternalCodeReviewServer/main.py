@@ -3,22 +3,43 @@
 在 pull_request 时克隆仓库并在 Claude Code 终端执行 /code-review:code-review 进行 PR 审核。
 """
 import asyncio
+import codecs
+import json
 import logging
 import os
+import zlib
 from pathlib import Path
+from collections.abc import AsyncIterator
 from contextlib import asynccontextmanager
 from typing import Any
 
 from dotenv import load_dotenv
 
-# 启动时加载 .env，使 LOCAL_REPO_PATH、CLAUDE_WORKING_DIR 等生效（在 import review_runner 前）
+# 启动时加载 .env，使 REPO_REGISTRY_FILE、LOCAL_REPO_PATH 等生效（在 import review_runner 前）
 env_path = Path(__file__).resolve().parent / ".env"
 load_dotenv(env_path)
 
-from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 
-from review_runner import run_code_review_async, get_pr_info
+import metrics
+from job_logs import cleanup_old_logs, log_path, tail
+from repo_registry import registry
+from review_bundle import cached_stats, cleanup_old_bundles
+from rate_limiter import claude_limiter
+from review_cache import REVIEW_CACHE_ENABLED, review_cache
+from review_estimator import REVIEW_ADAPTIVE_TIMEOUT, REVIEW_AGING_RATE, REVIEW_SCHEDULER
+from review_runner import get_pr_info
+from job_store import REVIEW_DB_PATH, REVIEW_PERSIST, JobStore
+from review_queue import (
+    REVIEW_BACKPRESSURE_DEPTH,
+    REVIEW_BACKPRESSURE_LOAD,
+    REVIEW_RETRY_AFTER_MAX,
+    REVIEW_RETRY_AFTER_MIN,
+    QueueFull,
+    ReviewJob,
+    ReviewQueue,
+)
 
 # 配置日志格式
 logging.basicConfig(
@@ -33,6 +54,10 @@ def _log_startup_config():
     """记录启动时的配置信息"""
     logger.info("=" * 60)
     logger.info("InternalCodeReviewServer 启动配置:")
+    logger.info("  REPO_REGISTRY_FILE: %s", os.environ.get("REPO_REGISTRY_FILE", "(未设置)"))
+    for repo in registry.entries():
+        logger.info("    %s: %s", repo.name, repo.describe())
+    logger.info("    其它仓库: %s", registry.default.describe())
     logger.info("  LOCAL_REPO_PATH: %s", os.environ.get("LOCAL_REPO_PATH", "(未设置)"))
     logger.info("  LOCAL_REPO_NAME: %s", os.environ.get("LOCAL_REPO_NAME", "(未设置)"))
     logger.info("  CLAUDE_WORKING_DIR: %s", os.environ.get("CLAUDE_WORKING_DIR", "(未设置)"))
@@ -41,35 +66,129 @@ def _log_startup_config():
     logger.info("  CLAUDE_REVIEW_TIMEOUT: %s 秒", os.environ.get("CLAUDE_REVIEW_TIMEOUT", "600"))
     logger.info("  REPO_ROOT: %s", os.environ.get("REPO_ROOT", "(系统临时目录)"))
     logger.info("  GH_TOKEN: %s", "已配置" if os.environ.get("GH_TOKEN") else "未配置")
+    logger.info("  REVIEW_WORKERS: %s", review_queue.workers)
+    logger.info("  REVIEW_QUEUE_MAX: %s", review_queue.max_queue)
+    logger.info("  REVIEW_PER_REPO_LIMIT: %s", review_queue.per_repo_limit)
+    logger.info("  REVIEW_DEBOUNCE_SECONDS: %s", review_queue.debounce)
+    logger.info("  REVIEW_BACKPRESSURE: depth=%s load=%s (retry_after %s~%s 秒)",
+                REVIEW_BACKPRESSURE_DEPTH, REVIEW_BACKPRESSURE_LOAD, REVIEW_RETRY_AFTER_MIN, REVIEW_RETRY_AFTER_MAX)
+    logger.info("  REVIEW_SCHEDULER: %s (aging_rate=%s, adaptive_timeout=%s)",
+                REVIEW_SCHEDULER, REVIEW_AGING_RATE, REVIEW_ADAPTIVE_TIMEOUT)
+    logger.info("  REVIEW_PERSIST: %s", REVIEW_DB_PATH if REVIEW_PERSIST else "关闭（仅内存）")
+    logger.info("  REVIEW_CACHE: %s (ttl=%s 秒, max_size=%s)",
+                "开启" if REVIEW_CACHE_ENABLED else "关闭", review_cache.ttl, review_cache.max_size)
     logger.info("=" * 60)
 
+job_store: JobStore | None = JobStore() if REVIEW_PERSIST else None
+review_queue = ReviewQueue(store=job_store)
+
+
 @asynccontextmanager
 async def lifespan(_app: FastAPI):
     _log_startup_config()
-    yield
+    cleanup_old_logs()
+    cleanup_old_bundles()
+    if REVIEW_CACHE_ENABLED:
+        review_cache.open()
+    if job_store is not None:
+        job_store.open()
+    review_queue.start()
+    try:
+        yield
+    finally:
+        await review_queue.stop()
+        if job_store is not None:
+            job_store.close()
+        review_cache.close()
 
 
 app = FastAPI(title="InternalCodeReviewServer", lifespan=lifespan)
 
 
+class UnsupportedEncoding(Exception):
+    """请求使用了本服务无法解码的 Content-Encoding。"""
+
+
+class BodyTooLarge(Exception):
+    """请求 body（解压后）超过 REQUEST_MAX_BODY_BYTES。"""
+
+
+def _gunzip(raw: bytes, limit: int) -> bytes:
+    """流式解压 gzip（支持多个 member），输出超过 limit 字节时立即停止并抛出 BodyTooLarge。"""
+    out = bytearray()
+    while raw:
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        out += d.decompress(raw, limit + 1 - len(out))
+        if len(out) > limit or d.unconsumed_tail:
+            raise BodyTooLarge(f"> {limit} bytes")
+        if not d.eof:
+            raise ValueError("gzip 数据不完整")
+        raw = d.unused_data
+    return bytes(out)
+
+
+def _unzstd(raw: bytes, limit: int) -> bytes:
+    """流式解压 zstd，不信任帧头中声明的大小；输出超过 limit 字节时立即停止并抛出 BodyTooLarge。"""
+    try:
+        import zstandard
+    except ImportError:
+        raise UnsupportedEncoding("zstd（需 pip install zstandard）")
+    out = bytearray()
+    with zstandard.ZstdDecompressor().stream_reader(raw) as reader:
+        while len(out) <= limit:
+            chunk = reader.read(limit + 1 - len(out))
+            if not chunk:
+                break
+            out += chunk
+    if len(out) > limit:
+        raise BodyTooLarge(f"> {limit} bytes")
+    return bytes(out)
+
+
+def _decode_body(raw: bytes, encoding: str) -> Any:
+    """按 Content-Encoding（gzip / zstd / 无）解压并解析 JSON body；解压后超过 REQUEST_MAX_BODY_BYTES 时抛出 BodyTooLarge。"""
+    encoding = encoding.strip().lower()
+    limit = REQUEST_MAX_BODY_BYTES
+    if encoding == "gzip":
+        raw = _gunzip(raw, limit)
+    elif encoding == "zstd":
+        raw = _unzstd(raw, limit)
+    elif encoding not in ("", "identity"):
+        raise UnsupportedEncoding(encoding)
+    elif len(raw) > limit:
+        raise BodyTooLarge(f"{len(raw)} > {limit} bytes")
+    return json.loads(raw)
+
+
 @app.get("/")
 async def root():
-    return {"service": "InternalCodeReviewServer", "webhook": "POST /webhook/trigger"}
+    return {
+        "service": "InternalCodeReviewServer",
+        "webhook": "POST /webhook/trigger",
+        "batch": "POST /webhook/trigger/batch",
+        "jobs": "GET /jobs",
+        "job": "GET /jobs/{job_id}",
+        "job_log": "GET /jobs/{job_id}/log",
+        "metrics": "GET /metrics",
+        "queue": review_queue.snapshot(),
+        "cache": review_cache.snapshot(),
+        "ratelimit": claude_limiter.snapshot(),
+    }
 
 
-@app.post("/webhook/trigger")
-async def webhook_trigger(request: Request) -> JSONResponse:
+# 单次批量请求最多包含的事件数
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "100"))
+# 请求 body 解压后的最大字节数，超过时返回 413（防止压缩炸弹）
+REQUEST_MAX_BODY_BYTES = int(os.environ.get("REQUEST_MAX_BODY_BYTES", str(16 * 1024 * 1024)))
+
+
+async def _handle_trigger(body: dict[str, Any], client_host: str) -> tuple[int, dict[str, Any]]:
     """
-    接收 NasWebhookServer 转发的 payload：event, repo, branch, commit, payload。
+    处理一条转发事件（单条与批量接口共用），返回 (HTTP 状态码, 响应内容)。
     当 event 为 pull_request 时，在后台启动 Claude Code 终端执行 /code-review:code-review。
     """
-    client_host = request.client.host if request.client else "unknown"
-
-    try:
-        body = await request.json()
-    except Exception as e:
-        logger.warning("[%s] 解析 body 失败: %s", client_host, e)
-        return JSONResponse(status_code=400, content={"error": "invalid json"})
+    if not isinstance(body, dict):
+        return 400, {"error": "invalid body"}
 
     event = body.get("event", "")
     repo = body.get("repo", "")
@@ -79,17 +198,17 @@ async def webhook_trigger(request: Request) -> JSONResponse:
 
     if event != "pull_request":
         logger.info("[%s] 忽略非 PR 事件 event=%s repo=%s", client_host, event, repo)
-        return JSONResponse(status_code=200, content={"ok": True, "skipped": "not pull_request"})
+        return 200, {"ok": True, "skipped": "not pull_request"}
 
     action = payload.get("action", "")
     if action == "closed":
         logger.info("[%s] 忽略已关闭的 PR event=%s repo=%s action=%s", client_host, event, repo, action)
-        return JSONResponse(status_code=200, content={"ok": True, "skipped": "pull_request closed"})
+        return 200, {"ok": True, "skipped": "pull_request closed"}
 
     pr_info = get_pr_info(payload)
     if not pr_info:
         logger.warning("[%s] 无法从 payload 解析 PR 信息 repo=%s payload_keys=%s", client_host, repo, list(payload.keys())[:10])
-        return JSONResponse(status_code=200, content={"ok": True, "skipped": "no pr info"})
+        return 200, {"ok": True, "skipped": "no pr info"}
 
     repo_full_name, pr_number, head_sha, base_sha, head_ref, base_ref = pr_info
 
@@ -98,6 +217,13 @@ async def webhook_trigger(request: Request) -> JSONResponse:
     pr_title = pr_data.get("title", "(无标题)")
     pr_author = pr_data.get("user", {}).get("login", "(未知)")
     pr_url = pr_data.get("html_url", "")
+    # PR 规模（GitHub payload 自带），用于调度与超时估计；同一 SHA 对生成过审查包时以审查包统计为准
+    changed_files = int(pr_data.get("changed_files") or 0)
+    changed_lines = int(pr_data.get("additions") or 0) + int(pr_data.get("deletions") or 0)
+    # 读取审查包缓存的统计文件，放到线程中执行，不阻塞事件循环
+    stats = await asyncio.to_thread(cached_stats, repo_full_name, base_sha, head_sha)
+    if stats is not None:
+        changed_files, changed_lines = stats
 
     logger.info(
         "[%s] PR 信息: repo=%s pr=#%s title='%s' author=%s",
@@ -110,34 +236,168 @@ async def webhook_trigger(request: Request) -> JSONResponse:
     if pr_url:
         logger.info("[%s] PR URL: %s", client_host, pr_url)
 
-    # 异步执行 code review，立即返回 202
-    def _on_done(t):
-        if t.cancelled():
-            logger.error("[callback] code review 任务被取消 repo=%s pr=%s", repo_full_name, pr_number)
-        else:
-            ex = t.exception()
-            if ex is not None:
-                logger.exception("[callback] code review 任务异常 repo=%s pr=%s: %s", repo_full_name, pr_number, ex)
-            else:
-                logger.info("[callback] code review 任务完成 repo=%s pr=%s", repo_full_name, pr_number)
-
-    task = asyncio.create_task(run_code_review_async(
-        repo_full_name, pr_number, head_sha, base_sha,
-        pr_title, pr_author, head_ref, base_ref
-    ))
-    task.add_done_callback(_on_done)
-
-    logger.info("[%s] 已提交 code review 后台任务 repo=%s pr=%s head=%s", client_host, repo_full_name, pr_number, head_sha[:7])
-    return JSONResponse(
-        status_code=202,
-        content={
-            "ok": True,
-            "accepted": True,
-            "repo": repo_full_name,
-            "pr": pr_number,
-            "head_sha": head_sha[:7],
-            "head_ref": head_ref,
-            "base_ref": base_ref,
-            "title": pr_title,
-        },
+    # 放入 review 队列，立即返回 202
+    job = ReviewJob(
+        repo=repo_full_name,
+        pr_number=pr_number,
+        head_sha=head_sha,
+        base_sha=base_sha,
+        pr_title=pr_title,
+        pr_author=pr_author,
+        head_ref=head_ref,
+        base_ref=base_ref,
+        changed_files=changed_files,
+        changed_lines=changed_lines,
     )
+    try:
+        job, position = review_queue.submit(job)
+    except QueueFull as e:
+        logger.warning(
+            "[%s] %s，拒绝 repo=%s pr=%s status=%s retry_after=%s",
+            client_host, e, repo_full_name, pr_number, e.status, e.retry_after,
+        )
+        return e.status, {"error": e.error, "queued": review_queue.depth, "retry_after": e.retry_after}
+
+    logger.info("[%s] 已提交 code review 任务 %s position=%d", client_host, job.describe(), position)
+    return 202, {
+        "ok": True,
+        "accepted": True,
+        "job_id": job.id,
+        "queue_position": position,
+        "repo": repo_full_name,
+        "pr": pr_number,
+        "head_sha": head_sha[:7],
+        "head_ref": head_ref,
+        "base_ref": base_ref,
+        "title": pr_title,
+    }
+
+
+async def _read_body(request: Request, client_host: str) -> tuple[Any, JSONResponse | None]:
+    """读取并解码请求 body；失败时返回 (None, 错误响应)。"""
+    try:
+        return _decode_body(await request.body(), request.headers.get("content-encoding", "")), None
+    except UnsupportedEncoding as e:
+        logger.warning("[%s] 不支持的 Content-Encoding: %s", client_host, e)
+        return None, JSONResponse(status_code=415, content={"error": f"unsupported content-encoding: {e}"})
+    except BodyTooLarge as e:
+        logger.warning("[%s] 请求 body 过大: %s", client_host, e)
+        return None, JSONResponse(status_code=413, content={"error": f"body too large: {e}"})
+    except Exception as e:
+        logger.warning("[%s] 解析 body 失败: %s", client_host, e)
+        return None, JSONResponse(status_code=400, content={"error": "invalid json"})
+
+
+@app.post("/webhook/trigger")
+async def webhook_trigger(request: Request) -> JSONResponse:
+    """
+    接收 NasWebhookServer 转发的 payload：event, repo, branch, commit, payload。
+    当 event 为 pull_request 时，在后台启动 Claude Code 终端执行 /code-review:code-review。
+    """
+    client_host = request.client.host if request.client else "unknown"
+    body, error = await _read_body(request, client_host)
+    if error is not None:
+        return error
+    status_code, content = await _handle_trigger(body, client_host)
+    metrics.TRIGGERS.labels(status=str(status_code)).inc()
+    # 背压：拒绝时告诉 NasWebhookServer 多久后再试
+    headers = {"Retry-After": str(content["retry_after"])} if "retry_after" in content else None
+    return JSONResponse(status_code=status_code, content=content, headers=headers)
+
+
+@app.post("/webhook/trigger/batch")
+async def webhook_trigger_batch(request: Request) -> JSONResponse:
+    """
+    批量接收 NasWebhookServer 转发的事件：body 为 {"items": [单条事件, ...]}。
+    每条按与 /webhook/trigger 相同的逻辑处理，返回逐条结果 {"results": [{"status": ..., ...}, ...]}。
+    """
+    client_host = request.client.host if request.client else "unknown"
+    body, error = await _read_body(request, client_host)
+    if error is not None:
+        return error
+    items = body.get("items") if isinstance(body, dict) else None
+    if not isinstance(items, list):
+        return JSONResponse(status_code=400, content={"error": "items must be a list"})
+    if len(items) > BATCH_MAX_ITEMS:
+        return JSONResponse(
+            status_code=413,
+            content={"error": f"too many items: {len(items)} > {BATCH_MAX_ITEMS}"},
+        )
+
+    logger.info("[%s] 收到批量 webhook items=%d", client_host, len(items))
+    results = []
+    for item in items:
+        status_code, content = await _handle_trigger(item, client_host)
+        metrics.TRIGGERS.labels(status=str(status_code)).inc()
+        results.append({"status": status_code, **content})
+    return JSONResponse(status_code=200, content={"ok": True, "results": results})
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus 指标（文本格式）。"""
+    if not metrics.ENABLED:
+        return JSONResponse(status_code=503, content={"error": "prometheus_client not installed"})
+    metrics.set_queue(review_queue)
+    metrics.set_ratelimit(claude_limiter.snapshot())
+    content, content_type = metrics.render()
+    return Response(content=content, media_type=content_type)
+
+
+@app.get("/jobs")
+async def list_jobs(state: str = "", repo: str = "", limit: int = 50):
+    """列出执行中、等待中与最近结束的任务（按创建时间倒序），可按 state、repo 过滤。"""
+    jobs = review_queue.jobs(state=state, repo=repo, limit=limit)
+    return {"queue": review_queue.snapshot(), "jobs": [job.to_dict() for job in jobs]}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """单个任务的状态、各阶段开始时间与耗时。"""
+    job = review_queue.lookup(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "job not found"})
+    return {**job.to_dict(), "queue_position": review_queue.position(job_id)}
+
+
+def _sse_message(text: str) -> str:
+    return "".join(f"data: {line}\n" for line in text.splitlines()) + "\n"
+
+
+async def _sse_events(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """
+    把日志字节流转换为 SSE：每个 chunk 中的完整行作为一个 message 事件（每行一个 data 字段），结束时发送 end 事件。
+    跨 chunk 的半行与多字节字符留到下一个 chunk 拼接，流结束时输出剩余部分。
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        complete, newline, pending = pending.rpartition("\n")
+        if newline:
+            yield _sse_message(complete + "\n")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield _sse_message(pending)
+    yield "event: end\ndata: \n\n"
+
+
+@app.get("/jobs/{job_id}/log")
+async def job_log(request: Request, job_id: str, offset: int = 0, follow: bool = True):
+    """
+    读取任务的 claude 输出日志。任务在等待或执行中且 follow=true 时持续推送新输出，任务结束后关闭连接。
+    请求头 Accept: text/event-stream 时以 SSE 返回，否则以 chunked 纯文本返回。
+    """
+    if not job_id.isalnum():
+        return JSONResponse(status_code=400, content={"error": "invalid job id"})
+    if review_queue.lookup(job_id) is None and not log_path(job_id).exists():
+        return JSONResponse(status_code=404, content={"error": "job log not found"})
+
+    chunks = tail(job_id, offset, lambda: follow and review_queue.get(job_id) is not None)
+    if "text/event-stream" in request.headers.get("accept", ""):
+        return StreamingResponse(
+            _sse_events(chunks),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    return StreamingResponse(chunks, media_type="text/plain; charset=utf-8")
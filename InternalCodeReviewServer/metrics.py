@@ -0,0 +1,96 @@
+"""
+Prometheus 指标：GET /metrics 暴露 review 队列深度、执行中任务数，以及各阶段（排队、clone、fetch、
+checkout、审查包、限速等待、claude review）的耗时直方图，均按仓库打标签；另有 claude 调用限速的额度与等待时间。
+阶段耗时在任务结束时按 ReviewJob.durations() 一次性记录；队列深度在抓取时才统计。
+依赖 prometheus_client（见 requirements.txt），未安装时记录为空操作，/metrics 返回 503。
+"""
+from typing import Any
+
+try:
+    import prometheus_client
+    from prometheus_client import Counter, Gauge, Histogram
+except ImportError:  # pragma: no cover - 取决于部署环境
+    prometheus_client = None
+
+ENABLED = prometheus_client is not None
+
+# 记录耗时的阶段：queued 为排队时间，review 为 claude 执行时间，total 不单独记录（可由各阶段相加）
+_PHASES = ("queued", "clone", "fetch", "checkout", "bundle", "throttle", "review")
+# 从秒级的 fetch 到数十分钟的 clone / claude review
+_PHASE_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 900, 1200, 1800, 3600)
+
+
+class _Noop:
+    """prometheus_client 未安装时的占位指标。"""
+
+    def labels(self, *args, **kwargs) -> "_Noop":
+        return self
+
+    def observe(self, value: float) -> None:
+        pass
+
+    def inc(self, amount: float = 1) -> None:
+        pass
+
+    def set(self, value: float) -> None:
+        pass
+
+    def clear(self) -> None:
+        pass
+
+
+if ENABLED:
+    QUEUE_DEPTH = Gauge("review_queue_depth", "等待中的 review 任务数", ["repo"])
+    ACTIVE_JOBS = Gauge("review_active_jobs", "执行中的 review 任务数", ["repo"])
+    WORKERS = Gauge("review_workers", "review worker 数")
+    PHASE_SECONDS = Histogram(
+        "review_phase_seconds", "review 各阶段耗时", ["repo", "phase"], buckets=_PHASE_BUCKETS
+    )
+    JOBS = Counter("review_jobs_total", "已结束的 review 任务数（按结束状态）", ["repo", "state"])
+    TRIGGERS = Counter("review_trigger_responses_total", "触发请求的处理结果（按状态码）", ["status"])
+    RATELIMIT_AVAILABLE = Gauge(
+        "review_ratelimit_available", "claude 限速令牌桶的剩余额度（requests / tokens）", ["bucket"]
+    )
+    RATELIMIT_LIMIT = Gauge("review_ratelimit_limit", "claude 限速每分钟额度，0 为不限", ["bucket"])
+    RATELIMIT_WAITING = Gauge("review_ratelimit_waiting", "等待限速额度的 claude 调用数")
+    RATELIMIT_WAIT = Histogram(
+        "review_ratelimit_wait_seconds", "claude 调用等待限速额度的时间", buckets=_PHASE_BUCKETS
+    )
+    RATELIMIT_TOKENS = Counter("review_ratelimit_tokens_total", "已放行的 claude 调用的估计 token 数")
+else:
+    QUEUE_DEPTH = ACTIVE_JOBS = WORKERS = PHASE_SECONDS = JOBS = TRIGGERS = _Noop()
+    RATELIMIT_AVAILABLE = RATELIMIT_LIMIT = RATELIMIT_WAITING = RATELIMIT_WAIT = RATELIMIT_TOKENS = _Noop()
+
+
+def observe_job(job: Any) -> None:
+    """任务结束时记录各阶段耗时与结束状态。"""
+    for phase, seconds in job.durations().items():
+        if phase in _PHASES:
+            PHASE_SECONDS.labels(repo=job.repo, phase=phase).observe(seconds)
+    JOBS.labels(repo=job.repo, state=job.state).inc()
+
+
+def set_queue(queue: Any) -> None:
+    """抓取时按仓库统计等待与执行中的任务数（先清空，已无任务的仓库不再出现）。"""
+    pending, running = queue.repo_counts()
+    QUEUE_DEPTH.clear()
+    ACTIVE_JOBS.clear()
+    for repo, count in pending.items():
+        QUEUE_DEPTH.labels(repo=repo).set(count)
+    for repo, count in running.items():
+        ACTIVE_JOBS.labels(repo=repo).set(count)
+    WORKERS.set(queue.workers)
+
+
+def set_ratelimit(snapshot: dict[str, Any]) -> None:
+    """抓取时记录限速令牌桶的额度（RateLimiter.snapshot()）。"""
+    RATELIMIT_LIMIT.labels(bucket="requests").set(snapshot["rpm"])
+    RATELIMIT_LIMIT.labels(bucket="tokens").set(snapshot["tpm"])
+    RATELIMIT_AVAILABLE.labels(bucket="requests").set(snapshot["requests_available"])
+    RATELIMIT_AVAILABLE.labels(bucket="tokens").set(snapshot["tokens_available"])
+    RATELIMIT_WAITING.set(snapshot["waiting"])
+
+
+def render() -> tuple[bytes, str]:
+    """返回 (Prometheus 文本格式的指标, Content-Type)。"""
+    return prometheus_client.generate_latest(), prometheus_client.CONTENT_TYPE_LATEST
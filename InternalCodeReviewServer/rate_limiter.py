@@ -0,0 +1,131 @@
+"""
+claude 调用限速：所有 review worker（含大 PR 的分片）共用一组令牌桶，按每分钟请求数与每分钟估计 token 数限速。
+每次启动 claude 前按提示词与审查包大小估计 token 数，预算不足时等待（任务状态为 throttled），而不是让并发的 claude
+同时撞上 API 限额一起失败。令牌持续补充，桶容量为一分钟的额度（允许一分钟内的突发）。
+"""
+import asyncio
+import logging
+import math
+import os
+import time
+from typing import Any
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 每分钟最多启动的 claude 进程数，0 表示不限
+CLAUDE_RPM = int(os.environ.get("CLAUDE_RPM", "0"))
+# 每分钟估计 token 数上限，0 表示不限
+CLAUDE_TPM = int(os.environ.get("CLAUDE_TPM", "0"))
+# 估计 token 数 = 输入字节数 / CLAUDE_BYTES_PER_TOKEN + CLAUDE_TOKENS_OVERHEAD（claude 读取代码、调用工具、输出的消耗）
+CLAUDE_BYTES_PER_TOKEN = float(os.environ.get("CLAUDE_BYTES_PER_TOKEN", "4"))
+CLAUDE_TOKENS_OVERHEAD = int(os.environ.get("CLAUDE_TOKENS_OVERHEAD", "20000"))
+
+
+def estimate_tokens(*inputs: str | bytes) -> int:
+    """按提示词、标准输入等的字节数估计一次 claude 调用的 token 数。"""
+    size = sum(len(x.encode("utf-8")) if isinstance(x, str) else len(x) for x in inputs)
+    return math.ceil(size / CLAUDE_BYTES_PER_TOKEN) + CLAUDE_TOKENS_OVERHEAD
+
+
+class TokenBucket:
+    """容量为每分钟额度、按秒连续补充的令牌桶；rate_per_minute 为 0 时不限。"""
+
+    def __init__(self, rate_per_minute: int):
+        self.capacity = float(rate_per_minute)
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.capacity <= 0
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.capacity / 60)
+        self._updated = now
+
+    def delay(self, amount: float) -> float:
+        """还需等待多少秒才能取出 amount（调用前先 refill）。"""
+        if self.unlimited or self.level >= amount:
+            return 0.0
+        return (amount - self.level) * 60 / self.capacity
+
+
+class RateLimiter:
+    """
+    请求数 + token 数两个令牌桶。acquire 按到达顺序排队（先到的大请求不会被后到的小请求一直插队），
+    单次估计超过桶容量时按容量计，避免永远等不到。
+    """
+
+    def __init__(self, rpm: int = CLAUDE_RPM, tpm: int = CLAUDE_TPM):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.waiting = 0
+        self.granted = 0
+        self.tokens_granted = 0
+        self.wait_seconds = 0.0
+        self._lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return not (self.requests.unlimited and self.tokens.unlimited)
+
+    async def acquire(self, tokens: int, on_wait=None) -> float:
+        """
+        取得一次 claude 调用的额度，返回等待的秒数。需要等待时先调用一次 on_wait(秒数)（用于更新任务状态）。
+        所在任务被取消时直接抛出，不消耗额度。
+        """
+        if not self.enabled:
+            return 0.0
+        cost = min(float(tokens), self.tokens.capacity) if not self.tokens.unlimited else 0.0
+        start = time.monotonic()
+        self.waiting += 1
+        # 前面已有调用在等待额度：先进入等待状态
+        notified = self._lock.locked()
+        if notified and on_wait is not None:
+            on_wait(0.0)
+        try:
+            async with self._lock:
+                while True:
+                    self.requests.refill()
+                    self.tokens.refill()
+                    delay = max(self.requests.delay(1), self.tokens.delay(cost))
+                    if delay <= 0:
+                        break
+                    logger.info("[ratelimit] 额度不足，等待 %.1f 秒（估计 %d tokens，排队 %d）", delay, tokens, self.waiting)
+                    if not notified and on_wait is not None:
+                        on_wait(delay)
+                    notified = True
+                    await asyncio.sleep(delay)
+                if not self.requests.unlimited:
+                    self.requests.level -= 1
+                self.tokens.level -= cost
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - start
+        self.granted += 1
+        self.tokens_granted += tokens
+        self.wait_seconds += waited
+        metrics.RATELIMIT_WAIT.observe(waited)
+        metrics.RATELIMIT_TOKENS.inc(tokens)
+        return waited
+
+    def snapshot(self) -> dict[str, Any]:
+        self.requests.refill()
+        self.tokens.refill()
+        return {
+            "enabled": self.enabled,
+            "rpm": int(self.requests.capacity),
+            "tpm": int(self.tokens.capacity),
+            "requests_available": round(self.requests.level, 2),
+            "tokens_available": int(self.tokens.level),
+            "waiting": self.waiting,
+            "granted": self.granted,
+            "tokens_granted": self.tokens_granted,
+            "wait_seconds": round(self.wait_seconds, 1),
+        }
+
+
+claude_limiter = RateLimiter()
@@ -0,0 +1,146 @@
+"""
+仓库注册表：按仓库名配置本地仓库路径、Claude 工作目录、review 超时与并发上限。
+配置了本地路径的仓库走本地 worktree（增量 fetch），其余仓库走克隆模式（持久镜像）。
+查找为字典索引，同时接受 owner/repo 与 owner_repo 两种写法（不区分大小写）。
+LOCAL_REPO_PATH / LOCAL_REPO_NAME / CLAUDE_WORKING_DIR / CLAUDE_SUBDIR 仍然有效，视为注册表中的一项。
+"""
+import json
+import logging
+import os
+from dataclasses import dataclass, replace
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+# 注册表文件（JSON）：{"owner/repo": {"path", "working_dir", "subdir", "timeout", "concurrency"}, "*": {...}}
+REPO_REGISTRY_FILE = os.environ.get("REPO_REGISTRY_FILE", "").strip()
+# 以下为单仓库的旧配置
+LOCAL_REPO_PATH = os.environ.get("LOCAL_REPO_PATH", "").strip()
+LOCAL_REPO_NAME = os.environ.get("LOCAL_REPO_NAME", "").strip()
+CLAUDE_WORKING_DIR = os.environ.get("CLAUDE_WORKING_DIR", "").strip()
+CLAUDE_SUBDIR = os.environ.get("CLAUDE_SUBDIR", "").strip()
+
+
+@dataclass(frozen=True)
+class RepoConfig:
+    """
+    单个仓库的配置。path 为空表示克隆模式；working_dir 为本地仓库内 Claude 的启动目录（绝对路径），
+    subdir 为相对仓库根的启动目录（也用于 sparse checkout）；timeout、concurrency 为 None 时使用全局配置
+    （CLAUDE_REVIEW_TIMEOUT、REVIEW_PER_REPO_LIMIT），concurrency 为 0 表示不限。
+    """
+
+    name: str = "*"
+    path: str = ""
+    working_dir: str = ""
+    subdir: str = ""
+    timeout: int | None = None
+    concurrency: int | None = None
+
+    def describe(self) -> str:
+        parts = [f"path={self.path or '(克隆)'}"]
+        if self.working_dir:
+            parts.append(f"working_dir={self.working_dir}")
+        if self.subdir:
+            parts.append(f"subdir={self.subdir}")
+        if self.timeout is not None:
+            parts.append(f"timeout={self.timeout}")
+        if self.concurrency is not None:
+            parts.append(f"concurrency={self.concurrency}")
+        return " ".join(parts)
+
+
+def _key(name: str) -> str:
+    return name.strip().lower().replace("/", "_")
+
+
+def _parse_entry(name: str, data: dict[str, Any], base: RepoConfig | None = None) -> RepoConfig:
+    """解析注册表中的一项；base 非空时，未出现在 data 中的字段取 base 的值。"""
+    base = base or RepoConfig()
+    timeout = data.get("timeout", base.timeout)
+    concurrency = data.get("concurrency", base.concurrency)
+    return RepoConfig(
+        name=name,
+        path=str(data.get("path", base.path) or "").strip(),
+        working_dir=str(data.get("working_dir", base.working_dir) or "").strip(),
+        subdir=str(data.get("subdir", base.subdir) or "").strip().strip("/\\"),
+        timeout=int(timeout) if timeout is not None else None,
+        concurrency=int(concurrency) if concurrency is not None else None,
+    )
+
+
+def _merge_default(legacy: RepoConfig, data: dict[str, Any]) -> RepoConfig:
+    """
+    注册表的 "*" 项与旧配置（LOCAL_REPO_PATH 等）合并为默认配置："*" 中出现的字段优先，其余字段沿用旧配置。
+    "*" 覆盖了旧配置中已设置的字段时记录警告。
+    """
+    merged = _parse_entry("*", data, legacy)
+    overridden = [
+        f"{field}: {getattr(legacy, field)} -> {getattr(merged, field) or '(空)'}"
+        for field in ("path", "working_dir", "subdir")
+        if getattr(legacy, field) and getattr(merged, field) != getattr(legacy, field)
+    ]
+    if overridden:
+        logger.warning(
+            "[registry] 注册表的 \"*\" 项覆盖了 LOCAL_REPO_PATH / CLAUDE_WORKING_DIR / CLAUDE_SUBDIR 的配置: %s",
+            "; ".join(overridden),
+        )
+    return merged
+
+
+class RepoRegistry:
+    """仓库名 -> RepoConfig 的索引；未注册的仓库使用 default。"""
+
+    def __init__(self, entries: list[RepoConfig], default: RepoConfig):
+        self.default = default
+        self._entries: dict[str, RepoConfig] = {}
+        for entry in entries:
+            self._entries[_key(entry.name)] = entry
+
+    def lookup(self, repo_full_name: str) -> RepoConfig:
+        entry = self._entries.get(_key(repo_full_name))
+        if entry is None:
+            return replace(self.default, name=repo_full_name)
+        return entry
+
+    def own_timeout(self, repo_full_name: str) -> int | None:
+        """仓库自己的注册项中配置的 timeout；未注册或未配置时为 None（"*" 的 timeout 不算）。"""
+        entry = self._entries.get(_key(repo_full_name))
+        return entry.timeout if entry is not None else None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def entries(self) -> list[RepoConfig]:
+        return list(self._entries.values())
+
+
+def load_registry(path: str = REPO_REGISTRY_FILE) -> RepoRegistry:
+    """
+    旧的单仓库配置 + 注册表文件（同名仓库以文件为准）。
+    未设置 LOCAL_REPO_NAME 时 LOCAL_REPO_PATH 对所有仓库生效（与旧行为一致），作为默认配置；
+    注册表的 "*" 项只覆盖其中写出的字段。
+    文件加载失败时只使用旧配置。
+    """
+    default = RepoConfig(subdir=CLAUDE_SUBDIR)
+    entries: list[RepoConfig] = []
+    if LOCAL_REPO_PATH:
+        legacy = RepoConfig(path=LOCAL_REPO_PATH, working_dir=CLAUDE_WORKING_DIR, subdir=CLAUDE_SUBDIR)
+        if LOCAL_REPO_NAME:
+            entries.append(replace(legacy, name=LOCAL_REPO_NAME))
+        else:
+            default = legacy
+    if path:
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            for name, entry in data.items():
+                if name == "*":
+                    default = _merge_default(default, entry)
+                else:
+                    entries.append(_parse_entry(name, entry))
+        except Exception as e:
+            logger.error("[registry] 加载仓库注册表失败 path=%s error=%s，仅使用 LOCAL_REPO_PATH 配置", path, e)
+    return RepoRegistry(entries, default)
+
+
+registry = load_registry()
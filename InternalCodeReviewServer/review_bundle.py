@@ -0,0 +1,338 @@
+"""
+审查包（review bundle）：在检出目录中用 git 预先整理 PR 的变更（统计、变更文件列表、unified diff、
+变更文件全文），通过标准输入交给 claude，不再让 claude 自己调用 gh pr diff 获取。
+按 (repo, base_sha, head_sha) 缓存到磁盘，同一对提交的重复审查不再重新计算。
+变更行数超过 REVIEW_SHARD_LINES 的大 PR 按目录拆分为多个分片审查包，由多个 claude 并行审查。
+"""
+import json
+import logging
+import math
+import os
+import re
+import subprocess
+import tempfile
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# 是否生成审查包（1/true 默认）；0 则与旧行为一致，由 claude 通过 gh pr diff 获取变更
+REVIEW_BUNDLE = os.environ.get("REVIEW_BUNDLE", "1").strip().lower() in ("1", "true", "yes")
+# 审查包总大小上限（字节），diff 优先，剩余额度放变更文件全文
+REVIEW_BUNDLE_MAX_BYTES = int(os.environ.get("REVIEW_BUNDLE_MAX_BYTES", str(256 * 1024)))
+# 单个文件全文的大小上限（字节），超过的文件只给 diff
+REVIEW_BUNDLE_MAX_FILE_BYTES = int(os.environ.get("REVIEW_BUNDLE_MAX_FILE_BYTES", str(64 * 1024)))
+# 审查包缓存目录，默认 REPO_ROOT/bundles
+BUNDLE_ROOT = os.environ.get("BUNDLE_ROOT", "").strip() or str(
+    Path(os.environ.get("REPO_ROOT", tempfile.gettempdir())) / "bundles"
+)
+# 缓存保留天数，启动时清理更早的文件；0 表示不清理
+REVIEW_BUNDLE_RETENTION_DAYS = float(os.environ.get("REVIEW_BUNDLE_RETENTION_DAYS", "7"))
+
+# 变更行数（增 + 删）超过该值的 PR 拆分为多个分片并行审查；0（默认）表示不拆分。
+# 分片使用内置的分片提示词，不使用 CLAUDE_CODE_REVIEW_CMD 与 CODE_REVIEW_PROMPT_TEMPLATE，因此需显式开启
+REVIEW_SHARD_LINES = int(os.environ.get("REVIEW_SHARD_LINES", "0"))
+# 每个分片的目标变更行数，分片数 = 总行数 / 该值（向上取整，不超过 REVIEW_SHARD_MAX）
+REVIEW_SHARD_SIZE = int(os.environ.get("REVIEW_SHARD_SIZE", "1500"))
+REVIEW_SHARD_MAX = int(os.environ.get("REVIEW_SHARD_MAX", "8"))
+# 单个任务同时运行的 claude 分片进程数
+REVIEW_SHARD_WORKERS = int(os.environ.get("REVIEW_SHARD_WORKERS", "3"))
+# 合并后总结评论的最大字符数（GitHub 评论上限 65536），超出时按比例截断各分片的结果，完整结果见任务日志
+REVIEW_COMMENT_MAX_CHARS = int(os.environ.get("REVIEW_COMMENT_MAX_CHARS", "60000"))
+
+# 在检出目录中执行 git 的协程：git(args, timeout) -> CompletedProcess（由 review_runner 提供）
+Git = Callable[[list[str], float], Awaitable[subprocess.CompletedProcess]]
+
+
+@dataclass
+class ChangedFile:
+    path: str
+    status: str  # A / M / D / T 等（--no-renames，重命名拆为 D + A）
+    additions: int = 0
+    deletions: int = 0
+    binary: bool = False
+
+    @property
+    def weight(self) -> int:
+        """分片时的权重：变更行数（二进制文件计 1）。"""
+        return max(1, self.additions + self.deletions)
+
+
+@dataclass
+class ReviewBundle:
+    base_sha: str
+    head_sha: str
+    files: list[ChangedFile] = field(default_factory=list)
+    text: str = ""
+    truncated: bool = False
+    # 拆分后的分片（仅大 PR）；label 为分片涉及的目录
+    shards: list["ReviewBundle"] = field(default_factory=list)
+    label: str = ""
+
+    @property
+    def additions(self) -> int:
+        return sum(f.additions for f in self.files)
+
+    @property
+    def deletions(self) -> int:
+        return sum(f.deletions for f in self.files)
+
+    def summary(self) -> str:
+        return f"{len(self.files)} 个文件 +{self.additions} -{self.deletions}，{len(self.text.encode('utf-8'))} 字节"
+
+
+def _cache_path(repo_full_name: str, base_sha: str, head_sha: str) -> Path:
+    return Path(BUNDLE_ROOT) / repo_full_name.replace("/", "_") / f"{base_sha[:12]}_{head_sha[:12]}"
+
+
+def _load_cached(path: Path) -> ReviewBundle | None:
+    try:
+        meta = json.loads(path.with_suffix(".json").read_text(encoding="utf-8"))
+        text = path.with_suffix(".md").read_text(encoding="utf-8")
+    except (OSError, ValueError):
+        return None
+    files = [ChangedFile(**f) for f in meta.pop("files")]
+    now = time.time()
+    for suffix in (".json", ".md"):
+        # 更新修改时间，按保留天数清理时不会删掉仍在使用的缓存
+        os.utime(path.with_suffix(suffix), (now, now))
+    return ReviewBundle(files=files, text=text, **meta)
+
+
+def _save_cached(path: Path, bundle: ReviewBundle) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    meta = {
+        "base_sha": bundle.base_sha,
+        "head_sha": bundle.head_sha,
+        "truncated": bundle.truncated,
+        "files": [asdict(f) for f in bundle.files],
+    }
+    path.with_suffix(".md").write_text(bundle.text, encoding="utf-8")
+    path.with_suffix(".json").write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+
+
+def _parse_files(name_status: str, numstat: str) -> list[ChangedFile]:
+    files: dict[str, ChangedFile] = {}
+    for line in name_status.splitlines():
+        status, _, path = line.partition("\t")
+        if path:
+            files[path] = ChangedFile(path=path, status=status[:1])
+    for line in numstat.splitlines():
+        parts = line.split("\t", 2)
+        if len(parts) != 3 or parts[2] not in files:
+            continue
+        f = files[parts[2]]
+        if parts[0] == "-":
+            f.binary = True
+        else:
+            f.additions, f.deletions = int(parts[0]), int(parts[1])
+    return list(files.values())
+
+
+def _fence(text: str) -> str:
+    """比内容中最长的连续反引号多一个，避免文件内容（如 Markdown）提前结束代码块。"""
+    longest = max((len(run) for run in re.findall(r"`+", text)), default=0)
+    return "`" * max(3, longest + 1)
+
+
+def _render(bundle: ReviewBundle, diff: str, checkout_dir: Path) -> None:
+    """生成审查包文本：统计与文件列表总是完整保留，diff 与文件全文按大小上限截断。"""
+    header = [
+        f"# PR 变更包 base={bundle.base_sha} head={bundle.head_sha}",
+        "",
+        f"共 {len(bundle.files)} 个文件，+{bundle.additions} -{bundle.deletions}",
+        "",
+        "## 变更文件",
+        "",
+    ]
+    for f in bundle.files:
+        change = "binary" if f.binary else f"+{f.additions} -{f.deletions}"
+        header.append(f"{f.status}  {change:>14}  {f.path}")
+    parts = ["\n".join(header), ""]
+    budget = REVIEW_BUNDLE_MAX_BYTES - len(parts[0].encode("utf-8"))
+
+    diff_bytes = diff.encode("utf-8")
+    if len(diff_bytes) > budget:
+        diff = diff_bytes[: max(0, budget)].decode("utf-8", "ignore")
+        bundle.truncated = True
+    fence = _fence(diff)
+    parts += ["## Diff", "", f"{fence}diff", diff.rstrip("\n"), fence, ""]
+    budget -= len(diff.encode("utf-8"))
+    if bundle.truncated:
+        parts.append("（diff 超过大小上限已截断，其余部分请在当前目录用 git diff 查看）\n")
+        bundle.text = "\n".join(parts)
+        return
+
+    parts += ["## 变更文件全文（PR head）", ""]
+    skipped: list[str] = []
+    for f in bundle.files:
+        if f.status == "D" or f.binary:
+            continue
+        path = checkout_dir / f.path
+        try:
+            size = path.stat().st_size
+            if size > REVIEW_BUNDLE_MAX_FILE_BYTES or size > budget:
+                skipped.append(f.path)
+                continue
+            content = path.read_text(encoding="utf-8")
+        except (OSError, UnicodeDecodeError):
+            # sparse checkout 之外的文件、非 UTF-8 文本
+            skipped.append(f.path)
+            continue
+        fence = _fence(content)
+        parts += [f"### {f.path}", "", fence, content.rstrip("\n"), fence, ""]
+        budget -= len(content.encode("utf-8"))
+    if skipped:
+        bundle.truncated = True
+        parts.append("未附全文的文件（过大、超出总大小上限或不在检出范围内），需要时请直接阅读：")
+        parts += [f"- {p}" for p in skipped]
+    bundle.text = "\n".join(parts)
+
+
+async def _diff_range(git: Git, base_sha: str, head_sha: str) -> list[str]:
+    """三点 diff（相对 merge-base，与 GitHub PR 页面一致）；浅拉取缺少 merge-base 时退回两点 diff。"""
+    merge_base = await git(["merge-base", base_sha, head_sha], 30)
+    return [f"{base_sha}...{head_sha}"] if merge_base.returncode == 0 else [base_sha, head_sha]
+
+
+def _needs_shards(bundle: ReviewBundle) -> bool:
+    return 0 < REVIEW_SHARD_LINES < bundle.additions + bundle.deletions and len(bundle.files) > 1
+
+
+def _split_files(files: list[ChangedFile], shard_count: int) -> list[list[ChangedFile]]:
+    """
+    按目录把文件分成 shard_count 组：同一目录的文件作为一个单元（超过单个分片目标行数的目录按文件拆开），
+    单元按行数从大到小依次放入当前行数最少的分片，使各分片耗时接近。
+    """
+    target = math.ceil(sum(f.weight for f in files) / shard_count)
+    by_dir: dict[str, list[ChangedFile]] = {}
+    for f in sorted(files, key=lambda f: f.path):
+        by_dir.setdefault(f.path.rpartition("/")[0], []).append(f)
+    units: list[list[ChangedFile]] = []
+    for group in by_dir.values():
+        if sum(f.weight for f in group) <= target:
+            units.append(group)
+        else:
+            units.extend([f] for f in group)
+    units.sort(key=lambda unit: sum(f.weight for f in unit), reverse=True)
+
+    shards: list[list[ChangedFile]] = [[] for _ in range(shard_count)]
+    for unit in units:
+        min(shards, key=lambda shard: sum(f.weight for f in shard)).extend(unit)
+    return [sorted(shard, key=lambda f: f.path) for shard in shards if shard]
+
+
+def _split_diff(diff: str) -> dict[str, str]:
+    """按文件拆分 unified diff：路径 -> 该文件的 diff 段（按 diff --git a/<path> b/<path> 头识别）。"""
+    sections: dict[str, str] = {}
+    for section in re.split(r"^(?=diff --git )", diff, flags=re.MULTILINE):
+        header = section.partition("\n")[0]
+        if header.startswith("diff --git a/") and " b/" in header:
+            # --no-renames 下 a/ 与 b/ 路径相同：取前一半
+            path = header[len("diff --git a/"):][: (len(header) - len("diff --git a/") - 3) // 2]
+            sections[path] = section
+    return sections
+
+
+def _shard_label(files: list[ChangedFile]) -> str:
+    dirs = sorted({f.path.rpartition("/")[0] or "/" for f in files})
+    return "、".join(dirs[:3]) + (f" 等 {len(dirs)} 个目录" if len(dirs) > 3 else "")
+
+
+def _add_shards(bundle: ReviewBundle, diff: str, checkout_dir: Path) -> None:
+    """把大 PR 拆分为多个分片审查包（每个分片各自按大小上限渲染，不写缓存）。"""
+    shard_count = min(REVIEW_SHARD_MAX, math.ceil((bundle.additions + bundle.deletions) / max(1, REVIEW_SHARD_SIZE)))
+    if shard_count < 2:
+        return
+    sections = _split_diff(diff)
+    groups = _split_files(bundle.files, shard_count)
+    # 无法识别路径的 diff 段（路径含特殊字符被 git 加引号）放入最后一个分片
+    unmatched = [s for p, s in sections.items() if p not in {f.path for f in bundle.files}]
+    for i, group in enumerate(groups):
+        shard = ReviewBundle(base_sha=bundle.base_sha, head_sha=bundle.head_sha, files=group, label=_shard_label(group))
+        shard_diff = "".join(sections.get(f.path, "") for f in group)
+        if i == len(groups) - 1:
+            shard_diff += "".join(unmatched)
+        _render(shard, shard_diff, checkout_dir)
+        bundle.shards.append(shard)
+    logger.info(
+        "[bundle] 变更 %d 行超过 %d，拆分为 %d 个分片: %s",
+        bundle.additions + bundle.deletions, REVIEW_SHARD_LINES, len(bundle.shards),
+        "；".join(f"{s.label}（{len(s.files)} 个文件 +{s.additions} -{s.deletions}）" for s in bundle.shards),
+    )
+
+
+async def build_bundle(
+    git: Git, checkout_dir: Path, repo_full_name: str, base_sha: str, head_sha: str
+) -> ReviewBundle | None:
+    """
+    在检出目录（PR head）中生成审查包；命中缓存时直接读取。失败返回 None（由 claude 自行获取变更）。
+    变更行数超过 REVIEW_SHARD_LINES 时同时生成分片（bundle.shards）。
+    """
+    if not base_sha or not head_sha:
+        return None
+    cache = _cache_path(repo_full_name, base_sha, head_sha)
+    bundle = _load_cached(cache)
+    if bundle is not None:
+        logger.info("[bundle] 命中缓存 %s（%s）", cache.name, bundle.summary())
+        if _needs_shards(bundle):
+            diff = await git(["diff", "--no-renames", *await _diff_range(git, base_sha, head_sha)], 120)
+            if diff.returncode == 0:
+                _add_shards(bundle, diff.stdout, checkout_dir)
+        return bundle
+
+    start_time = time.time()
+    diff_range = await _diff_range(git, base_sha, head_sha)
+    name_status = await git(["diff", "--no-renames", "--name-status", *diff_range], 60)
+    numstat = await git(["diff", "--no-renames", "--numstat", *diff_range], 60)
+    diff = await git(["diff", "--no-renames", *diff_range], 120)
+    for r in (name_status, numstat, diff):
+        if r.returncode != 0:
+            logger.warning("[bundle] git diff 失败: %s", r.stderr.strip()[:500])
+            return None
+
+    bundle = ReviewBundle(base_sha=base_sha, head_sha=head_sha, files=_parse_files(name_status.stdout, numstat.stdout))
+    _render(bundle, diff.stdout, checkout_dir)
+    try:
+        _save_cached(cache, bundle)
+    except OSError as e:
+        logger.warning("[bundle] 写入缓存失败 %s: %s", cache, e)
+    logger.info(
+        "[bundle] 已生成 %s%s，耗时 %.1f 秒",
+        bundle.summary(), "（已截断）" if bundle.truncated else "", time.time() - start_time,
+    )
+    if _needs_shards(bundle):
+        _add_shards(bundle, diff.stdout, checkout_dir)
+    return bundle
+
+
+def cleanup_old_bundles(retention_days: float = REVIEW_BUNDLE_RETENTION_DAYS) -> None:
+    """删除超过保留天数未使用的审查包缓存。"""
+    root = Path(BUNDLE_ROOT)
+    if retention_days <= 0 or not root.is_dir():
+        return
+    cutoff = time.time() - retention_days * 86400
+    removed = 0
+    for p in root.glob("*/*"):
+        try:
+            if p.is_file() and p.stat().st_mtime < cutoff:
+                p.unlink()
+                removed += 1
+        except OSError as e:
+            logger.warning("[bundle] 删除旧缓存失败 %s: %s", p, e)
+    if removed:
+        logger.info("[bundle] 已清理 %d 个超过 %s 天的审查包缓存文件", removed, retention_days)
+
+
+def cached_stats(repo_full_name: str, base_sha: str, head_sha: str) -> tuple[int, int] | None:
+    """同一 SHA 对已生成过审查包时返回 (变更文件数, 变更行数)，用于调度时估计任务规模。"""
+    if not base_sha or not head_sha:
+        return None
+    try:
+        meta = json.loads(_cache_path(repo_full_name, base_sha, head_sha).with_suffix(".json").read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    files = meta.get("files", [])
+    return len(files), sum(f.get("additions", 0) + f.get("deletions", 0) for f in files)
@@ -0,0 +1,122 @@
+"""
+审查结果缓存：记录已成功完成的 review，键为 (repo, head_sha, base_sha, 提示词哈希)。
+reopened、edited、ready_for_review 或重投的事件若 head 未变且提示词相同，直接命中缓存，不再运行 claude。
+持久化到 SQLite，服务重启后仍然有效；按 TTL 过期，超出容量时淘汰最早的记录。
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+REVIEW_CACHE_ENABLED = os.environ.get("REVIEW_CACHE_ENABLED", "1").strip().lower() in ("1", "true", "yes")
+# 缓存文件路径，默认 InternalCodeReviewServer/data/review_cache.db
+REVIEW_CACHE_PATH = os.environ.get("REVIEW_CACHE_PATH", "").strip() or str(
+    Path(__file__).resolve().parent / "data" / "review_cache.db"
+)
+# 记录保留秒数，默认 7 天；0 表示不过期
+REVIEW_CACHE_TTL = float(os.environ.get("REVIEW_CACHE_TTL", str(7 * 86400)))
+# 最多保留的记录数，超出后淘汰最早的
+REVIEW_CACHE_MAX_SIZE = int(os.environ.get("REVIEW_CACHE_MAX_SIZE", "5000"))
+
+
+class ReviewCache:
+    """已完成 review 的 SQLite 缓存；未 open（如本地测试脚本）时不命中也不记录。"""
+
+    def __init__(self, path: str = REVIEW_CACHE_PATH, ttl: float = REVIEW_CACHE_TTL, max_size: int = REVIEW_CACHE_MAX_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def open(self) -> None:
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS reviews ("
+            " repo TEXT NOT NULL, head_sha TEXT NOT NULL, base_sha TEXT NOT NULL, prompt_hash TEXT NOT NULL,"
+            " pr_number INTEGER NOT NULL, job_id TEXT NOT NULL, created_at REAL NOT NULL,"
+            " PRIMARY KEY (repo, head_sha, base_sha, prompt_hash))"
+        )
+        self._conn = conn
+        self._evict(time.time())
+        entries = conn.execute("SELECT COUNT(*) FROM reviews").fetchone()[0]
+        logger.info("[cache] 审查结果缓存已加载 path=%s entries=%s", self.path, entries)
+
+    def close(self) -> None:
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+            self._conn = None
+
+    def _evict(self, now: float) -> None:
+        """删除过期及超出容量的记录。"""
+        with self._lock:
+            if self.ttl > 0:
+                self._conn.execute("DELETE FROM reviews WHERE created_at < ?", (now - self.ttl,))
+            self._conn.execute(
+                "DELETE FROM reviews WHERE rowid NOT IN "
+                "(SELECT rowid FROM reviews ORDER BY created_at DESC LIMIT ?)",
+                (self.max_size,),
+            )
+
+    def _select(self, key: tuple[str, str, str, str]) -> dict[str, Any] | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT pr_number, job_id, created_at FROM reviews"
+                " WHERE repo = ? AND head_sha = ? AND base_sha = ? AND prompt_hash = ?",
+                key,
+            ).fetchone()
+        if row is None or (self.ttl > 0 and row[2] < time.time() - self.ttl):
+            return None
+        return {"pr_number": row[0], "job_id": row[1], "created_at": row[2]}
+
+    def _insert(self, key: tuple[str, str, str, str], pr_number: int, job_id: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO reviews"
+                " (repo, head_sha, base_sha, prompt_hash, pr_number, job_id, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (*key, pr_number, job_id, now),
+            )
+        self._evict(now)
+
+    async def get(self, repo: str, head_sha: str, base_sha: str, prompt_hash: str) -> dict[str, Any] | None:
+        """命中时返回 {"pr_number", "job_id", "created_at"}（原 review 的信息），否则返回 None。"""
+        if self._conn is None:
+            return None
+        hit = await asyncio.to_thread(self._select, (repo, head_sha, base_sha, prompt_hash))
+        if hit is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return hit
+
+    async def put(self, repo: str, head_sha: str, base_sha: str, prompt_hash: str, pr_number: int, job_id: str) -> None:
+        """记录一次成功完成的 review。"""
+        if self._conn is None:
+            return
+        await asyncio.to_thread(self._insert, (repo, head_sha, base_sha, prompt_hash), pr_number, job_id)
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "enabled": self._conn is not None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "ttl": self.ttl,
+            "max_size": self.max_size,
+        }
+
+
+review_cache = ReviewCache()
@@ -0,0 +1,123 @@
+"""
+review 耗时估计：按 PR 规模估计 claude 审查耗时，用于调度（短任务优先 + 等待老化）与自适应超时。
+规模 = 变更行数 + 文件数 × REVIEW_FILE_LINES，优先取同一 SHA 对的审查包统计（见 review_bundle），
+否则取 webhook payload 中的 additions / deletions / changed_files。
+耗时模型为 review 秒数 ≈ a + b × 规模，用最近完成的任务做最小二乘拟合；样本不足时使用先验值，不调整超时。
+超时的任务只知道耗时的下限，不参与拟合，而是作为超时下限：规模不小于它的任务，超时不低于 该耗时 × REVIEW_TIMEOUT_FACTOR。
+"""
+import logging
+import math
+import os
+from collections import deque
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+# 调度策略：sjf 估计耗时短的任务优先（等待越久优先级越高）；fifo 按到达顺序
+REVIEW_SCHEDULER = os.environ.get("REVIEW_SCHEDULER", "sjf").strip().lower()
+# 老化速度：每等待 1 秒，排序时相当于估计耗时减少该秒数；大于 0 时任何任务的等待时间都有上限
+REVIEW_AGING_RATE = float(os.environ.get("REVIEW_AGING_RATE", "1.0"))
+# 每个变更文件折算的行数（claude 需要逐个阅读文件）
+REVIEW_FILE_LINES = int(os.environ.get("REVIEW_FILE_LINES", "20"))
+# 按耗时模型设置每个任务的 claude 超时（1/true 默认）；0 则一律使用 CLAUDE_REVIEW_TIMEOUT
+REVIEW_ADAPTIVE_TIMEOUT = os.environ.get("REVIEW_ADAPTIVE_TIMEOUT", "1").strip().lower() in ("1", "true", "yes")
+# 自适应超时 = (估计耗时 + 2 × 残差标准差) × 该倍数，限制在 [MIN, MAX] 秒内
+REVIEW_TIMEOUT_FACTOR = float(os.environ.get("REVIEW_TIMEOUT_FACTOR", "2.0"))
+REVIEW_TIMEOUT_MIN = int(os.environ.get("REVIEW_TIMEOUT_MIN", "300"))
+REVIEW_TIMEOUT_MAX = int(os.environ.get("REVIEW_TIMEOUT_MAX", "3600"))
+# 拟合所需的最少样本数与使用的最近样本数
+REVIEW_MODEL_MIN_SAMPLES = int(os.environ.get("REVIEW_MODEL_MIN_SAMPLES", "10"))
+REVIEW_MODEL_WINDOW = int(os.environ.get("REVIEW_MODEL_WINDOW", "200"))
+
+# 样本不足时的先验：60 秒 + 每行 0.2 秒
+_PRIOR = (60.0, 0.2)
+
+
+def job_size(changed_files: int, changed_lines: int) -> int:
+    """任务规模；0 表示未知。"""
+    return changed_lines + changed_files * REVIEW_FILE_LINES
+
+
+class DurationModel:
+    """review 耗时 ≈ a + b × 规模 的在线拟合（最近 REVIEW_MODEL_WINDOW 个成功任务）。"""
+
+    def __init__(self, window: int = REVIEW_MODEL_WINDOW, min_samples: int = REVIEW_MODEL_MIN_SAMPLES):
+        self.min_samples = min_samples
+        self._samples: deque[tuple[int, float]] = deque(maxlen=window)
+        # 超时任务的 (规模, 已运行秒数)：真实耗时的下限
+        self._timeouts: deque[tuple[int, float]] = deque(maxlen=window)
+        self.a, self.b = _PRIOR
+        self.sigma = 0.0
+
+    @property
+    def fitted(self) -> bool:
+        return len(self._samples) >= self.min_samples
+
+    def observe(self, size: int, seconds: float) -> None:
+        """记录一次成功审查的规模与 review 阶段耗时，并重新拟合。"""
+        if size <= 0 or seconds <= 0:
+            return
+        self._samples.append((size, seconds))
+        if self.fitted:
+            self._fit()
+
+    def observe_timeout(self, size: int, seconds: float) -> None:
+        """记录一次超时：规模不小于 size 的任务之后的自适应超时不低于 seconds × REVIEW_TIMEOUT_FACTOR。"""
+        if size <= 0 or seconds <= 0:
+            return
+        self._timeouts.append((size, seconds))
+        logger.info("[estimator] 规模 %d 的任务运行 %.0f 秒后超时，之后同等规模的超时不低于 %.0f 秒",
+                    size, seconds, seconds * REVIEW_TIMEOUT_FACTOR)
+
+    def _timeout_floor(self, size: int) -> float:
+        """规模不大于 size 的超时任务中最长的已运行时间 × REVIEW_TIMEOUT_FACTOR；没有时为 0。"""
+        return max((seconds for s, seconds in self._timeouts if s <= size), default=0.0) * REVIEW_TIMEOUT_FACTOR
+
+    def _fit(self) -> None:
+        n = len(self._samples)
+        mean_x = sum(x for x, _ in self._samples) / n
+        mean_y = sum(y for _, y in self._samples) / n
+        var_x = sum((x - mean_x) ** 2 for x, _ in self._samples)
+        # 规模都相同时无法估计斜率，只用均值
+        b = sum((x - mean_x) * (y - mean_y) for x, y in self._samples) / var_x if var_x > 0 else 0.0
+        self.b = max(0.0, b)
+        self.a = max(0.0, mean_y - self.b * mean_x)
+        self.sigma = math.sqrt(sum((y - self.predict(x)) ** 2 for x, y in self._samples) / n)
+
+    def _mean_size(self) -> float:
+        if not self._samples:
+            return 0.0
+        return sum(x for x, _ in self._samples) / len(self._samples)
+
+    def predict(self, size: int) -> float:
+        """估计 review 耗时（秒）；规模未知时按历史平均规模估计。"""
+        return self.a + self.b * (size if size > 0 else self._mean_size())
+
+    def timeout_for(self, size: int) -> int | None:
+        """
+        自适应超时（秒），不低于同等规模任务曾超时的下限；
+        未开启、规模未知，或样本不足且没有超时记录时返回 None（使用 "*" 的 timeout 或 CLAUDE_REVIEW_TIMEOUT）。
+        """
+        if not (REVIEW_ADAPTIVE_TIMEOUT and size > 0):
+            return None
+        floor = self._timeout_floor(size)
+        if not (self.fitted or floor):
+            return None
+        timeout = (self.predict(size) + 2 * self.sigma) * REVIEW_TIMEOUT_FACTOR if self.fitted else 0.0
+        return int(min(REVIEW_TIMEOUT_MAX, max(REVIEW_TIMEOUT_MIN, timeout, floor)))
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "scheduler": REVIEW_SCHEDULER,
+            "aging_rate": REVIEW_AGING_RATE,
+            "adaptive_timeout": REVIEW_ADAPTIVE_TIMEOUT,
+            "samples": len(self._samples),
+            "timeouts": len(self._timeouts),
+            "fitted": self.fitted,
+            "intercept": round(self.a, 2),
+            "seconds_per_unit": round(self.b, 4),
+            "sigma": round(self.sigma, 2),
+        }
+
+
+duration_model = DurationModel()
@@ -0,0 +1,545 @@
+"""
+Code Review 任务队列：有界等待队列 + 固定数量的 worker，并限制同一仓库的并发数，
+避免 PR 突发时同时启动过多 claude 进程与 git 操作。
+同一 PR 连续推送时只审核最新的 head：新 head 替换等待中的旧任务、取消执行中的旧任务。
+默认按估计耗时短的任务优先调度（等待越久优先级越高，不会饿死），并按历史耗时为每个任务设置超时（见 review_estimator）。
+配置了 JobStore 时任务持久化到 SQLite，重启后未完成的任务重新入队（见 job_store）。
+"""
+import asyncio
+import logging
+import math
+import os
+import sqlite3
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any
+
+import metrics
+from job_store import REVIEW_MAX_ATTEMPTS, JobStore
+from repo_registry import registry
+from review_estimator import REVIEW_AGING_RATE, REVIEW_SCHEDULER, duration_model, job_size
+from review_runner import run_code_review_async
+
+logger = logging.getLogger(__name__)
+
+# 同时执行的 review 数（worker 数）
+REVIEW_WORKERS = int(os.environ.get("REVIEW_WORKERS", "2"))
+# 等待队列最大长度，超出时拒绝新任务
+REVIEW_QUEUE_MAX = int(os.environ.get("REVIEW_QUEUE_MAX", "100"))
+# 同一仓库同时执行的 review 数上限，0 表示不限
+REVIEW_PER_REPO_LIMIT = int(os.environ.get("REVIEW_PER_REPO_LIMIT", "1"))
+# 入队后等待的秒数（防抖），期间同一 PR 的新推送会替换该任务；0 表示立即执行
+REVIEW_DEBOUNCE_SECONDS = float(os.environ.get("REVIEW_DEBOUNCE_SECONDS", "0"))
+# 保留在内存中、可通过 GET /jobs 查询的已结束任务数
+REVIEW_JOB_HISTORY = int(os.environ.get("REVIEW_JOB_HISTORY", "200"))
+# 背压：等待队列达到该长度后新任务返回 429（带 Retry-After），0 表示只在队列满时拒绝
+REVIEW_BACKPRESSURE_DEPTH = int(os.environ.get("REVIEW_BACKPRESSURE_DEPTH", "0"))
+# 背压：1 分钟平均负载 / CPU 核数超过该值时新任务返回 503（带 Retry-After），0 表示不检查（Windows 无负载值，不检查）
+REVIEW_BACKPRESSURE_LOAD = float(os.environ.get("REVIEW_BACKPRESSURE_LOAD", "0"))
+# 拒绝时的 Retry-After 秒数：按 等待任务数 × 平均估计耗时 / worker 数 估计，限制在 [MIN, MAX]
+REVIEW_RETRY_AFTER_MIN = int(os.environ.get("REVIEW_RETRY_AFTER_MIN", "30"))
+REVIEW_RETRY_AFTER_MAX = int(os.environ.get("REVIEW_RETRY_AFTER_MAX", "600"))
+
+# 执行阶段对应的任务状态（clone / fetch / checkout 都算 fetching）
+_PHASE_STATES = {
+    "clone": "fetching", "fetch": "fetching", "checkout": "fetching", "bundle": "fetching",
+    "throttle": "throttled", "review": "reviewing",
+}
+
+
+class QueueFull(Exception):
+    """
+    等待队列已满或超过背压阈值，新任务不入队。
+    error 为返回给调用方的错误说明，status 为应返回的状态码（429 排队过多 / 503 队列满或主机过载），
+    retry_after 为建议的重试秒数。
+    """
+
+    def __init__(self, message: str, error: str, status: int, retry_after: int):
+        super().__init__(message)
+        self.error = error
+        self.status = status
+        self.retry_after = retry_after
+
+
+@dataclass
+class ReviewJob:
+    """一次 PR 代码审查任务。"""
+
+    repo: str
+    pr_number: int
+    head_sha: str
+    base_sha: str
+    pr_title: str = ""
+    pr_author: str = ""
+    head_ref: str = ""
+    base_ref: str = ""
+    id: str = field(default_factory=lambda: uuid.uuid4().hex[:12])
+    state: str = "queued"
+    created_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+    not_before: float = 0.0
+    superseded_by: str | None = None
+    cached_from: str | None = None
+    mode: str = ""
+    attempts: int = 0
+    # PR 规模（来自 payload 或审查包统计），0 表示未知；timeout 为本次执行的 claude 超时（None 为默认）
+    changed_files: int = 0
+    changed_lines: int = 0
+    timeout: int | None = None
+    phases: dict[str, float] = field(default_factory=dict)
+    task: asyncio.Task | None = field(default=None, repr=False)
+
+    @property
+    def key(self) -> tuple[str, int]:
+        return (self.repo, self.pr_number)
+
+    @property
+    def size(self) -> int:
+        return job_size(self.changed_files, self.changed_lines)
+
+    def describe(self) -> str:
+        return f"job={self.id} repo={self.repo} pr=#{self.pr_number} head={self.head_sha[:7]}"
+
+    def enter_phase(self, phase: str, detail: str = "") -> None:
+        """review_runner 的阶段回调：记录阶段开始时间并更新状态。"""
+        if phase == "mode":
+            self.mode = detail
+        elif phase == "timeout":
+            self.state = "timeout"
+            return
+        elif phase == "cached":
+            # 命中审查缓存，detail 为之前完成审查的任务 id
+            self.state = "cached"
+            self.cached_from = detail
+            return
+        elif phase == "stats":
+            # 审查包统计出的实际规模，detail 为 "<文件数> <行数>"
+            files, _, lines = detail.partition(" ")
+            self.changed_files, self.changed_lines = int(files), int(lines)
+            return
+        self.phases[phase] = time.time()
+        self.state = _PHASE_STATES.get(phase, self.state)
+
+    def durations(self) -> dict[str, float]:
+        """各阶段耗时（秒）：排队时间 + 每个阶段到下一阶段（或结束）为止的时间。"""
+        result: dict[str, float] = {}
+        if self.started_at is not None:
+            result["queued"] = round(self.started_at - self.created_at, 3)
+        marks = list(self.phases.items())
+        end = self.finished_at or time.time()
+        for i, (phase, started) in enumerate(marks):
+            until = marks[i + 1][1] if i + 1 < len(marks) else end
+            result[phase] = round(until - started, 3)
+        if self.started_at is not None:
+            result["total"] = round(end - self.created_at, 3)
+        return result
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "state": self.state,
+            "repo": self.repo,
+            "pr": self.pr_number,
+            "head_sha": self.head_sha,
+            "base_sha": self.base_sha,
+            "head_ref": self.head_ref,
+            "base_ref": self.base_ref,
+            "title": self.pr_title,
+            "author": self.pr_author,
+            "mode": self.mode,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "phases": dict(self.phases),
+            "durations": self.durations(),
+            "superseded_by": self.superseded_by,
+            "cached_from": self.cached_from,
+            "attempts": self.attempts,
+            "changed_files": self.changed_files,
+            "changed_lines": self.changed_lines,
+            "estimate": round(duration_model.predict(self.size), 1),
+            "timeout": self.timeout,
+        }
+
+
+class ReviewQueue:
+    """
+    review 队列：worker 在「已过防抖时间且所在仓库未达并发上限」的任务中取估计耗时减去老化量最小的一个
+    （REVIEW_SCHEDULER=fifo 时取最早到达的一个）执行。
+    submit 在事件循环内同步调用，同一 PR（repo + pr_number）的任务会合并或互相替换。
+    """
+
+    def __init__(
+        self,
+        workers: int = REVIEW_WORKERS,
+        max_queue: int = REVIEW_QUEUE_MAX,
+        per_repo_limit: int = REVIEW_PER_REPO_LIMIT,
+        debounce: float = REVIEW_DEBOUNCE_SECONDS,
+        store: JobStore | None = None,
+    ):
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.per_repo_limit = per_repo_limit
+        self.debounce = max(0.0, debounce)
+        self.superseded = 0
+        self.coalesced = 0
+        self.recovered = 0
+        self.rejected = 0
+        self._store = store
+        self._finished = 0
+        self._history: OrderedDict[str, ReviewJob] = OrderedDict()
+        self._pending: list[ReviewJob] = []
+        self._running: dict[str, ReviewJob] = {}
+        self._repo_running: dict[str, int] = {}
+        self._changed = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+        self._stopping = False
+
+    @property
+    def depth(self) -> int:
+        """等待中的任务数。"""
+        return len(self._pending)
+
+    @property
+    def active(self) -> int:
+        """执行中的任务数。"""
+        return len(self._running)
+
+    def submit(self, job: ReviewJob) -> tuple[ReviewJob, int]:
+        """
+        提交任务，返回 (实际排队的任务, 在等待队列中的位置)，位置 0 表示已在执行。
+        - 同一 PR 同一 head 已在等待或执行：合并，返回已有任务；
+        - 同一 PR 旧 head 在等待：新任务原位替换旧任务（保留排队顺序）；
+        - 同一 PR 旧 head 在执行：取消旧任务（结束 claude 进程树），新任务入队。
+        只有会让排队与执行总量变多的任务受队列上限与背压阈值限制（超过时抛出 QueueFull，且不动已有任务）；
+        合并、原位替换以及替换执行中的旧 head 总是接受。
+        """
+        job.not_before = time.time() + self.debounce
+        replaced: ReviewJob | None = None
+        for running in self._running.values():
+            if running.key != job.key or running.superseded_by is not None:
+                continue
+            if running.head_sha == job.head_sha:
+                self.coalesced += 1
+                logger.info("[queue] 同一 head 已在执行，合并 %s", running.describe())
+                return running, 0
+            replaced = running
+        for i, pending in enumerate(self._pending):
+            if pending.key != job.key:
+                continue
+            if pending.head_sha == job.head_sha:
+                self.coalesced += 1
+                logger.info("[queue] 同一 head 已在等待，合并 %s", pending.describe())
+                return pending, i + 1
+            self._cancel_running(replaced, job)
+            self._supersede(pending, job)
+            self._pending[i] = job
+            self._save(job)
+            self._changed.set()
+            return job, i + 1
+        if replaced is None:
+            overload = self._overload()
+            if overload is not None:
+                self.rejected += 1
+                raise overload
+        self._cancel_running(replaced, job)
+        self._pending.append(job)
+        self._save(job)
+        self._changed.set()
+        logger.info("[queue] 任务入队 %s position=%d running=%d", job.describe(), len(self._pending), self.active)
+        return job, len(self._pending)
+
+    def _cancel_running(self, running: ReviewJob | None, new: ReviewJob) -> None:
+        """新任务已被接受后再取消同一 PR 执行中的旧 head，避免新任务被拒时 PR 没有任何审查。"""
+        if running is None:
+            return
+        self._supersede(running, new)
+        if running.task is not None:
+            running.task.cancel()
+
+    def _supersede(self, old: ReviewJob, new: ReviewJob) -> None:
+        self.superseded += 1
+        old.superseded_by = new.id
+        if old.state == "queued":
+            old.state = "superseded"
+            old.finished_at = time.time()
+            self._remember(old)
+        logger.info(
+            "[queue] PR #%s 有新的 head=%s，替换 %s（state=%s）",
+            new.pr_number, new.head_sha[:7], old.describe(), old.state,
+        )
+
+    def get(self, job_id: str) -> ReviewJob | None:
+        """等待中或执行中的任务；已结束或不存在返回 None。"""
+        job = self._running.get(job_id)
+        if job is not None:
+            return job
+        return next((j for j in self._pending if j.id == job_id), None)
+
+    def lookup(self, job_id: str) -> ReviewJob | None:
+        """等待中、执行中或最近结束的任务。"""
+        return self.get(job_id) or self._history.get(job_id)
+
+    def jobs(self, state: str = "", repo: str = "", limit: int = 50) -> list[ReviewJob]:
+        """按创建时间倒序列出任务（执行中、等待中与最近结束的），可按状态、仓库过滤。"""
+        all_jobs = [*self._running.values(), *self._pending, *self._history.values()]
+        matched = [
+            j for j in all_jobs
+            if (not state or j.state == state) and (not repo or j.repo == repo)
+        ]
+        matched.sort(key=lambda j: j.created_at, reverse=True)
+        return matched[:limit] if limit > 0 else matched
+
+    def _remember(self, job: ReviewJob) -> None:
+        self._history[job.id] = job
+        while len(self._history) > REVIEW_JOB_HISTORY:
+            self._history.popitem(last=False)
+        self._save(job)
+        self._finished += 1
+        if self._store is not None and self._finished % 100 == 0:
+            self._store.prune(REVIEW_JOB_HISTORY)
+
+    def _save(self, job: ReviewJob, lease_until: float = 0.0) -> None:
+        """把任务状态写入任务库；写入失败只记录日志，不影响本次处理。"""
+        if self._store is None:
+            return
+        try:
+            self._store.save(job, lease_until)
+        except sqlite3.Error as e:
+            logger.error("[queue] 任务持久化失败 %s: %s", job.describe(), e)
+
+    def _recover(self) -> None:
+        """从任务库恢复：已结束的任务进入历史；等待中与执行中断的任务按创建顺序重新入队。"""
+        active, finished = self._store.load(REVIEW_JOB_HISTORY)
+        for fields in finished:
+            fields.pop("lease_until")
+            job = ReviewJob(**fields)
+            self._history[job.id] = job
+            self._observe(job)
+        now = time.time()
+        for fields in active:
+            lease_until = fields.pop("lease_until")
+            job = ReviewJob(**fields)
+            if job.state != "queued":
+                if REVIEW_MAX_ATTEMPTS > 0 and job.attempts >= REVIEW_MAX_ATTEMPTS:
+                    job.state = "failed"
+                    job.finished_at = now
+                    logger.error("[queue] 任务已执行 %d 次仍未完成，不再重试 %s", job.attempts, job.describe())
+                    self._remember(job)
+                    continue
+                # 上次进程在执行中退出：重新排队；租约未到期时等到期再执行
+                logger.warning("[queue] 恢复执行中断的任务 %s state=%s", job.describe(), job.state)
+                job.state = "queued"
+                job.not_before = max(job.not_before, lease_until)
+            # 服务停止时被中断的任务已记回 queued，同样清掉上次执行的记录
+            job.started_at = job.finished_at = None
+            job.mode = ""
+            job.timeout = None
+            job.phases = {}
+            self._save(job)
+            self._pending.append(job)
+        self.recovered = len(self._pending)
+        if active or finished:
+            logger.info("[queue] 从任务库恢复 queued=%d history=%d", len(self._pending), len(finished))
+
+    def retry_after(self) -> int:
+        """建议的重试秒数：当前等待的任务按平均估计耗时由全部 worker 执行完所需的时间。"""
+        drain = len(self._pending) * duration_model.predict(0) / self.workers
+        return int(min(REVIEW_RETRY_AFTER_MAX, max(REVIEW_RETRY_AFTER_MIN, math.ceil(drain))))
+
+    def load(self) -> float | None:
+        """1 分钟平均负载 / CPU 核数；不支持的平台返回 None。"""
+        if not hasattr(os, "getloadavg"):
+            return None
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+    def _overload(self) -> QueueFull | None:
+        """新任务是否应被拒绝：队列已满（503）、排队数超过背压阈值（429）或主机负载过高（503）。"""
+        depth = len(self._pending)
+        if self.max_queue > 0 and depth >= self.max_queue:
+            return QueueFull(f"review 队列已满 ({depth}/{self.max_queue})", "review queue full", 503, self.retry_after())
+        if REVIEW_BACKPRESSURE_DEPTH > 0 and depth >= REVIEW_BACKPRESSURE_DEPTH:
+            return QueueFull(
+                f"review 排队过多 ({depth}/{REVIEW_BACKPRESSURE_DEPTH})", "review queue busy", 429, self.retry_after()
+            )
+        if REVIEW_BACKPRESSURE_LOAD > 0:
+            load = self.load()
+            if load is not None and load > REVIEW_BACKPRESSURE_LOAD:
+                return QueueFull(
+                    f"主机负载过高 ({load:.2f}/{REVIEW_BACKPRESSURE_LOAD})", "review host overloaded", 503, self.retry_after()
+                )
+        return None
+
+    def position(self, job_id: str) -> int:
+        """任务在等待队列中的位置（从 1 开始）；不在等待队列中返回 0。"""
+        for i, job in enumerate(self._pending):
+            if job.id == job_id:
+                return i + 1
+        return 0
+
+    def repo_limit(self, repo: str) -> int:
+        """仓库的并发上限：注册表中的 concurrency，未配置时为 per_repo_limit；0 表示不限。"""
+        concurrency = registry.lookup(repo).concurrency
+        return self.per_repo_limit if concurrency is None else concurrency
+
+    def repo_counts(self) -> tuple[dict[str, int], dict[str, int]]:
+        """按仓库统计 (等待中, 执行中) 的任务数。"""
+        pending: dict[str, int] = {}
+        for job in self._pending:
+            pending[job.repo] = pending.get(job.repo, 0) + 1
+        return pending, dict(self._repo_running)
+
+    def snapshot(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queued": self.depth,
+            "running": self.active,
+            "max_queue": self.max_queue,
+            "per_repo_limit": self.per_repo_limit,
+            "debounce": self.debounce,
+            "superseded": self.superseded,
+            "coalesced": self.coalesced,
+            "recovered": self.recovered,
+            "rejected": self.rejected,
+            "backpressure_depth": REVIEW_BACKPRESSURE_DEPTH,
+            "backpressure_load": REVIEW_BACKPRESSURE_LOAD,
+            "persistent": self._store is not None,
+            "estimator": duration_model.snapshot(),
+        }
+
+    def start(self) -> None:
+        if self._store is not None:
+            self._store.prune(REVIEW_JOB_HISTORY)
+            self._recover()
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker_loop(i + 1)))
+        logger.info(
+            "[queue] review worker 已启动 workers=%d max_queue=%d per_repo_limit=%d debounce=%.1fs",
+            self.workers, self.max_queue, self.per_repo_limit, self.debounce,
+        )
+
+    async def stop(self) -> None:
+        self._stopping = True
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        logger.info("[queue] review worker 已停止，未执行的任务数=%d", self.depth)
+
+    def _pick(self) -> tuple[ReviewJob | None, float | None]:
+        """取一个可执行的任务；没有时返回 (None, 最近一个防抖到期的等待秒数或 None)。"""
+        now = time.time()
+        wait: float | None = None
+        best: int | None = None
+        best_score = 0.0
+        for i, job in enumerate(self._pending):
+            limit = self.repo_limit(job.repo)
+            if limit > 0 and self._repo_running.get(job.repo, 0) >= limit:
+                continue
+            if job.not_before > now:
+                delay = job.not_before - now
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            if REVIEW_SCHEDULER == "fifo":
+                return self._pending.pop(i), None
+            # 估计耗时减去老化量：短任务优先，等待足够久的大任务最终排到所有新任务之前
+            score = duration_model.predict(job.size) - REVIEW_AGING_RATE * (now - job.not_before)
+            if best is None or score < best_score:
+                best, best_score = i, score
+        if best is not None:
+            return self._pending.pop(best), None
+        return None, wait
+
+    def _observe(self, job: ReviewJob) -> None:
+        """
+        成功完成的任务加入耗时模型的样本，超时的任务作为超时下限（命中缓存的任务没有 review 阶段，不计入）。
+        """
+        if "review" not in job.phases:
+            return
+        if job.state == "done":
+            duration_model.observe(job.size, job.durations()["review"])
+        elif job.state == "timeout":
+            duration_model.observe_timeout(job.size, job.durations()["review"])
+
+    async def _worker_loop(self, worker_no: int) -> None:
+        while True:
+            job, wait = self._pick()
+            if job is None:
+                self._changed.clear()
+                try:
+                    await asyncio.wait_for(self._changed.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(worker_no, job)
+
+    async def _run(self, worker_no: int, job: ReviewJob) -> None:
+        self._running[job.id] = job
+        self._repo_running[job.repo] = self._repo_running.get(job.repo, 0) + 1
+        job.state = "fetching"
+        job.started_at = time.time()
+        job.attempts += 1
+        # 仓库自己配置的 timeout > 自适应超时 > "*" 的 timeout > CLAUDE_REVIEW_TIMEOUT（后两者在执行时按 None 回退）
+        job.timeout = registry.own_timeout(job.repo) or duration_model.timeout_for(job.size)
+        lease = None
+        if self._store is not None:
+            self._save(job, job.started_at + self._store.lease_seconds)
+            lease = asyncio.create_task(self._keep_lease(job))
+        logger.info(
+            "[queue] worker-%d 开始 %s 排队 %.1f 秒 规模=%d 估计 %.0f 秒 超时=%s",
+            worker_no, job.describe(), job.started_at - job.created_at, job.size,
+            duration_model.predict(job.size), job.timeout or "默认",
+        )
+        # 每个任务单独一个 asyncio 任务，被新 head 替换时只取消它，worker 继续取下一个任务
+        job.task = asyncio.create_task(run_code_review_async(
+            job.repo, job.pr_number, job.head_sha, job.base_sha,
+            job.pr_title, job.pr_author, job.head_ref, job.base_ref, job.id, job.enter_phase, job.timeout,
+        ))
+        try:
+            ok = await job.task
+            if job.state not in ("timeout", "cached"):
+                job.state = "done" if ok else "failed"
+        except asyncio.CancelledError:
+            if self._stopping and self._store is not None:
+                # 服务停止导致的中断：任务库中记回 queued，下次启动时重新执行，不计入执行次数
+                job.state = "queued"
+                job.attempts -= 1
+                raise
+            if self._stopping or job.superseded_by is None:
+                job.state = "cancelled"
+                raise
+            job.state = "superseded"
+        except Exception as e:
+            job.state = "failed"
+            logger.exception("[queue] worker-%d 任务异常 %s: %s", worker_no, job.describe(), e)
+        finally:
+            if lease is not None:
+                lease.cancel()
+            job.finished_at = time.time()
+            self._running.pop(job.id, None)
+            self._remember(job)
+            if not self._stopping:
+                metrics.observe_job(job)
+                self._observe(job)
+            self._repo_running[job.repo] -= 1
+            if self._repo_running[job.repo] <= 0:
+                del self._repo_running[job.repo]
+            # 释放了仓库并发名额，唤醒可能在等待的 worker
+            self._changed.set()
+            logger.info(
+                "[queue] worker-%d 结束 %s state=%s 耗时 %.1f 秒",
+                worker_no, job.describe(), job.state, job.finished_at - job.started_at,
+            )
+
+    async def _keep_lease(self, job: ReviewJob) -> None:
+        """执行期间定期续约，进程退出后租约自然过期。"""
+        interval = max(1.0, self._store.lease_seconds / 3)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self._store.renew(job.id)
+            except sqlite3.Error as e:
+                logger.error("[queue] 任务续约失败 %s: %s", job.describe(), e)
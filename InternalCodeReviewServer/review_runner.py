@@ -1,32 +1,63 @@
 """
 接收 PR 信息后克隆仓库，在 Claude Code 终端中执行 /code-review:code-review 进行 PR 审核。
+git / gh / claude 均以 asyncio 子进程（独立进程组）运行，超时或取消时结束整个进程树。
 依赖：本机已安装 Claude Code CLI（claude）、gh CLI，并配置 ANTHROPIC_API_KEY、GH_TOKEN。
 """
 import asyncio
+import hashlib
 import logging
 import os
 import shutil
+import signal
 import subprocess
 import tempfile
 import time
+import uuid
 from datetime import datetime
+from collections.abc import Callable
 from pathlib import Path
 from typing import Any
 
+from job_logs import JobLog
+from repo_registry import (
+    CLAUDE_SUBDIR, CLAUDE_WORKING_DIR, LOCAL_REPO_NAME, LOCAL_REPO_PATH, REPO_REGISTRY_FILE, RepoConfig, registry,
+)
+from review_bundle import (
+    BUNDLE_ROOT, REVIEW_BUNDLE, REVIEW_BUNDLE_MAX_BYTES, REVIEW_BUNDLE_MAX_FILE_BYTES, REVIEW_SHARD_LINES,
+    REVIEW_COMMENT_MAX_CHARS, REVIEW_SHARD_MAX, REVIEW_SHARD_SIZE, REVIEW_SHARD_WORKERS, ReviewBundle, build_bundle,
+)
+from rate_limiter import CLAUDE_RPM, CLAUDE_TPM, claude_limiter, estimate_tokens
+from review_cache import review_cache
+
 logger = logging.getLogger(__name__)
 
 # ===== 配置变量 =====
 REPO_ROOT = os.environ.get("REPO_ROOT", tempfile.gettempdir())
-LOCAL_REPO_PATH = os.environ.get("LOCAL_REPO_PATH", "").strip()
-LOCAL_REPO_NAME = os.environ.get("LOCAL_REPO_NAME", "").strip()
 CLAUDE_CLI = os.environ.get("CLAUDE_CLI", "claude")
 CLAUDE_USE_NATURAL_PROMPT = os.environ.get("CLAUDE_USE_NATURAL_PROMPT", "1").strip().lower() in ("1", "true", "yes")
 CLAUDE_CODE_REVIEW_CMD = os.environ.get("CLAUDE_CODE_REVIEW_CMD", "/code-review:code-review")
-CLAUDE_WORKING_DIR = os.environ.get("CLAUDE_WORKING_DIR", "").strip()
-CLAUDE_SUBDIR = os.environ.get("CLAUDE_SUBDIR", "").strip()
 ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY", "")
 GH_TOKEN = os.environ.get("GH_TOKEN", "")
 CLAUDE_REVIEW_TIMEOUT = int(os.environ.get("CLAUDE_REVIEW_TIMEOUT", "600"))
+# 各 git 阶段的超时（秒）：拉取 PR、检出 worktree、首次克隆镜像
+FETCH_TIMEOUT = int(os.environ.get("FETCH_TIMEOUT", "300"))
+CHECKOUT_TIMEOUT = int(os.environ.get("CHECKOUT_TIMEOUT", "300"))
+CLONE_TIMEOUT = int(os.environ.get("CLONE_TIMEOUT", "1800"))
+# 本地仓库模式下每个任务使用独立的 git worktree（1/true 默认）；0 则在 LOCAL_REPO_PATH 中直接 checkout
+LOCAL_REPO_WORKTREE = os.environ.get("LOCAL_REPO_WORKTREE", "1").strip().lower() in ("1", "true", "yes")
+WORKTREE_ROOT = os.environ.get("WORKTREE_ROOT", "").strip() or str(Path(REPO_ROOT) / "worktrees")
+# 克隆模式镜像的浅拉取深度，0 表示完整历史；大于 0 时镜像以该深度创建，拉取 PR 后按该步长加深到 head 与 base 的 merge-base。
+# 只作用于服务自己的镜像，从不对 LOCAL_REPO_PATH 浅拉取（否则用户的开发仓库会被改成 shallow 仓库）
+FETCH_DEPTH = int(os.environ.get("FETCH_DEPTH", "0"))
+# 浅拉取时加深到 merge-base 的最多次数（每次加深的深度翻倍），仍找不到时退回完整拉取（--unshallow）
+FETCH_DEEPEN_MAX = int(os.environ.get("FETCH_DEEPEN_MAX", "10"))
+# 克隆模式下设置了 CLAUDE_SUBDIR 时 worktree 只检出该子目录（sparse checkout，cone 模式），1/true 默认；
+# 本地仓库模式不使用（sparse-checkout 会修改 LOCAL_REPO_PATH 共享的 .git/config）
+SPARSE_CHECKOUT = os.environ.get("SPARSE_CHECKOUT", "1").strip().lower() in ("1", "true", "yes")
+# 克隆模式下持久保存的裸仓库镜像目录，之后只做增量 fetch
+MIRROR_ROOT = os.environ.get("MIRROR_ROOT", "").strip() or str(Path(REPO_ROOT) / "mirrors")
+# 创建镜像时的 partial clone 过滤条件，如 blob:none（文件内容在 checkout 时按需下载）；默认完整克隆
+MIRROR_FILTER = os.environ.get("MIRROR_FILTER", "").strip()
 
 # 记录配置加载情况
 def _log_config():
@@ -37,8 +68,23 @@ def _log_config():
     logger.info("[config]   CLAUDE_USE_NATURAL_PROMPT: %s", CLAUDE_USE_NATURAL_PROMPT)
     logger.info("[config]   CLAUDE_CODE_REVIEW_CMD: %s", CLAUDE_CODE_REVIEW_CMD)
     logger.info("[config]   CLAUDE_REVIEW_TIMEOUT: %s 秒", CLAUDE_REVIEW_TIMEOUT)
+    logger.info("[config]   FETCH_TIMEOUT / CHECKOUT_TIMEOUT / CLONE_TIMEOUT: %s / %s / %s 秒",
+                FETCH_TIMEOUT, CHECKOUT_TIMEOUT, CLONE_TIMEOUT)
+    logger.info("[config]   REPO_REGISTRY_FILE: %s（%d 个仓库）", REPO_REGISTRY_FILE or "(未设置)", len(registry))
     logger.info("[config]   LOCAL_REPO_PATH: %s", LOCAL_REPO_PATH or "(未设置)")
     logger.info("[config]   LOCAL_REPO_NAME: %s", LOCAL_REPO_NAME or "(未设置)")
+    logger.info("[config]   LOCAL_REPO_WORKTREE: %s", LOCAL_REPO_WORKTREE)
+    logger.info("[config]   WORKTREE_ROOT: %s", WORKTREE_ROOT)
+    logger.info("[config]   FETCH_DEPTH: %s（仅克隆模式镜像，加深到 merge-base，最多 %s 次）", FETCH_DEPTH or "(完整历史)", FETCH_DEEPEN_MAX)
+    logger.info("[config]   SPARSE_CHECKOUT: %s", SPARSE_CHECKOUT)
+    logger.info("[config]   MIRROR_ROOT: %s", MIRROR_ROOT)
+    logger.info("[config]   MIRROR_FILTER: %s", MIRROR_FILTER or "(完整克隆)")
+    logger.info("[config]   REVIEW_BUNDLE: %s（上限 %s / 单文件 %s 字节，缓存 %s）",
+                REVIEW_BUNDLE, REVIEW_BUNDLE_MAX_BYTES, REVIEW_BUNDLE_MAX_FILE_BYTES, BUNDLE_ROOT)
+    logger.info("[config]   REVIEW_SHARD_LINES: %s（每片 %s 行，最多 %s 片，%s 个并行）",
+                REVIEW_SHARD_LINES or "(不拆分)", REVIEW_SHARD_SIZE, REVIEW_SHARD_MAX, REVIEW_SHARD_WORKERS)
+    logger.info("[config]   REVIEW_COMMENT_MAX_CHARS: %s", REVIEW_COMMENT_MAX_CHARS)
+    logger.info("[config]   CLAUDE_RPM / CLAUDE_TPM: %s / %s", CLAUDE_RPM or "(不限)", CLAUDE_TPM or "(不限)")
     logger.info("[config]   CLAUDE_WORKING_DIR: %s", CLAUDE_WORKING_DIR or "(未设置)")
     logger.info("[config]   CLAUDE_SUBDIR: %s", CLAUDE_SUBDIR or "(未设置)")
     logger.info("[config]   REPO_ROOT: %s", REPO_ROOT)
@@ -72,12 +118,133 @@ def get_pr_info(payload: dict[str, Any]) -> tuple[str, int, str, str, str, str]
     return (repo_full_name, int(pr_number), head_sha, base_sha, head_ref, base_ref)
 
 
-# 自然语言 code review 提示词模板（占位符：repo, pr_number, head_sha, base_sha）
+# 阶段回调：progress(phase, detail)，phase 为 mode / clone / fetch / checkout / bundle / throttle / review / timeout，
+# 以及不计入阶段的 cached（detail 为原任务 id）、stats（detail 为 "<文件数> <行数>"）
+Progress = Callable[[str, str], None]
+
+
+def _report(progress: Progress | None, phase: str, detail: str = "") -> None:
+    if progress is not None:
+        progress(phase, detail)
+
+
+# 子进程在独立进程组中运行，超时或取消时可以连同其子进程（claude 会再启动 gh、git 等）一起结束
+_PROCESS_GROUP: dict[str, Any] = (
+    {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP} if os.name == "nt" else {"start_new_session": True}
+)
+
+
+def _subprocess_env() -> dict[str, str]:
+    env = os.environ.copy()
+    if ANTHROPIC_API_KEY:
+        env["ANTHROPIC_API_KEY"] = ANTHROPIC_API_KEY
+    if GH_TOKEN:
+        env["GH_TOKEN"] = GH_TOKEN
+    return env
+
+
+async def _kill_process_tree(proc: asyncio.subprocess.Process) -> None:
+    """结束进程及其整个进程组。"""
+    if proc.returncode is not None:
+        return
+    try:
+        if os.name == "nt":
+            killer = await asyncio.create_subprocess_exec(
+                "taskkill", "/F", "/T", "/PID", str(proc.pid),
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            await killer.wait()
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    except Exception as e:
+        logger.warning("[exec] 结束进程树失败 pid=%s: %s", proc.pid, e)
+        proc.kill()
+
+
+async def _feed_stdin(proc: asyncio.subprocess.Process, data: bytes) -> None:
+    """写入标准输入后关闭；进程未读完就退出时忽略。"""
+    try:
+        proc.stdin.write(data)
+        await proc.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    finally:
+        proc.stdin.close()
+
+
+async def _stream_to_log(
+    proc: asyncio.subprocess.Process, sink: JobLog, tail_bytes: int, input: bytes | None = None
+) -> tuple[bytes, bytes]:
+    """
+    把 stdout/stderr 边读边写入任务日志，只在内存中保留各自最后 tail_bytes 字节。
+    input 与读取同时写入标准输入，避免输入较大时双方互相等待管道。
+    """
+
+    async def pump(stream: asyncio.StreamReader, tail: bytearray) -> None:
+        while True:
+            chunk = await stream.read(64 * 1024)
+            if not chunk:
+                return
+            await sink.write(chunk)
+            tail += chunk
+            del tail[:-tail_bytes]
+
+    out_tail, err_tail = bytearray(), bytearray()
+    feed = [_feed_stdin(proc, input)] if input is not None else []
+    await asyncio.gather(pump(proc.stdout, out_tail), pump(proc.stderr, err_tail), *feed)
+    await proc.wait()
+    return bytes(out_tail), bytes(err_tail)
+
+
+async def _exec(
+    cmd: list[str],
+    cwd: Path | None = None,
+    timeout: float = 60,
+    env: dict[str, str] | None = None,
+    sink: JobLog | None = None,
+    tail_bytes: int = 4096,
+    input: bytes | None = None,
+) -> subprocess.CompletedProcess:
+    """
+    用 asyncio 子进程执行命令并收集输出（utf-8 解码，避免 Windows 下 cp950 报错）。
+    指定 sink 时输出流式写入任务日志，返回的 stdout/stderr 只包含最后 tail_bytes 字节。
+    input 非空时写入子进程的标准输入，否则标准输入为空设备。
+    超时抛出 subprocess.TimeoutExpired；超时或所在任务被取消时结束整个进程树。
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        cwd=str(cwd) if cwd else None,
+        env=env or _subprocess_env(),
+        stdin=asyncio.subprocess.DEVNULL if input is None else asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        **_PROCESS_GROUP,
+    )
+    try:
+        collect = proc.communicate(input) if sink is None else _stream_to_log(proc, sink, tail_bytes, input)
+        stdout, stderr = await asyncio.wait_for(collect, timeout)
+    except asyncio.TimeoutError:
+        await _kill_process_tree(proc)
+        await proc.wait()
+        raise subprocess.TimeoutExpired(cmd, timeout) from None
+    except asyncio.CancelledError:
+        await _kill_process_tree(proc)
+        await proc.wait()
+        raise
+    return subprocess.CompletedProcess(
+        cmd, proc.returncode, stdout.decode("utf-8", "replace"), stderr.decode("utf-8", "replace")
+    )
+
+
+# 自然语言 code review 提示词模板（占位符：repo, pr_number, head_sha, base_sha, diff_source）
 # 要求：做 PR 代码评审；若本次未产生任何 PR 评论，则必须发一条总结评论表示已自动评审
 _DEFAULT_CODE_REVIEW_PROMPT = """你正在对本 PR 做自动代码评审。当前仓库为 {repo}，PR 编号为 {pr_number}，head_sha={head_sha}，base_sha={base_sha}。
 
 请按以下步骤执行（可使用 gh、Bash、Read 等工具）：
-1. 使用 gh pr diff 等获取本 PR 的变更内容，进行代码评审。
+1. {diff_source}
 2. 若发现需要反馈的问题，请在对应位置发表 inline 评论或总结评论（通过 gh api 或 gh pr review 等）。
 3. **若本次评审没有发现需要反馈的问题、因而没有发表任何 PR 评论**，则你必须至少发表一条总结评论到本 PR，内容表示“已自动评审过”，例如：
    - 「已自动评审，本次未发现需反馈的问题。」
@@ -87,208 +254,312 @@ _DEFAULT_CODE_REVIEW_PROMPT = """你正在对本 PR 做自动代码评审。当
 CODE_REVIEW_PROMPT_TEMPLATE = os.environ.get(
     "CODE_REVIEW_PROMPT_TEMPLATE", _DEFAULT_CODE_REVIEW_PROMPT
 )
+# {diff_source} 的两种取值：已通过标准输入提供审查包 / 由 claude 自行获取变更
+_DIFF_SOURCE_BUNDLE = (
+    "本 PR 的变更（统计、变更文件列表、diff 及变更文件全文）已通过标准输入提供，无需再用 gh pr diff 获取，"
+    "请基于这些内容进行代码评审；审查包中注明截断或未附全文的部分可在当前目录用 git 或 Read 查看。"
+)
+_DIFF_SOURCE_GH = "使用 gh pr diff 等获取本 PR 的变更内容，进行代码评审。"
 
 
-def _fetch_and_checkout(repo_dir: Path, head_sha: str, head_ref: str = "") -> bool:
+def _build_prompt(
+    repo_full_name: str | None,
+    pr_number: int | None,
+    head_sha: str = "",
+    base_sha: str = "",
+    with_bundle: bool = False,
+) -> str:
     """
-    在本地仓库中拉取最新代码并切换到 PR 的 head SHA。
-    1. git fetch origin --prune 获取最新远程分支
-    2. git checkout head_sha 切换到 PR 的 head commit
+    claude -p 的提示词：slash 命令；CLAUDE_USE_NATURAL_PROMPT 且提供了 repo、PR 号时附加渲染后的模板。
+    with_bundle 表示审查包通过标准输入提供。
     """
-    start_time = time.time()
-    logger.info("[git] 开始拉取最新代码...")
+    if not (CLAUDE_USE_NATURAL_PROMPT and repo_full_name is not None and pr_number is not None):
+        return CLAUDE_CODE_REVIEW_CMD
+    extra_prompt = CODE_REVIEW_PROMPT_TEMPLATE.format(
+        repo=repo_full_name,
+        pr_number=pr_number,
+        head_sha=head_sha,
+        base_sha=base_sha,
+        diff_source=_DIFF_SOURCE_BUNDLE if with_bundle else _DIFF_SOURCE_GH,
+    )
+    # 先发 slash 命令，再附上自然语言说明
+    return CLAUDE_CODE_REVIEW_CMD + "\n\n" + extra_prompt
 
-    env = os.environ.copy()
-    if GH_TOKEN:
-        env["GH_TOKEN"] = GH_TOKEN
 
-    try:
-        # 1. git fetch origin --prune
-        logger.info("[git] 执行: git fetch origin --prune")
-        r1 = subprocess.run(
-            ["git", "fetch", "origin", "--prune"],
-            cwd=str(repo_dir),
-            env=env,
-            capture_output=True,
-            text=True,
-            encoding="utf-8",
-            errors="replace",
-            timeout=60,
-        )
-        if r1.returncode != 0:
-            logger.warning("[git] git fetch 警告: %s", r1.stderr)
-        else:
-            logger.info("[git] git fetch 完成")
-
-        # 2. 尝试直接 checkout 到 head_sha
-        logger.info("[git] 切换到 PR head: %s%s", head_sha[:7], f" (分支: {head_ref})" if head_ref else "")
-        r2 = subprocess.run(
-            ["git", "checkout", head_sha],
-            cwd=str(repo_dir),
-            env=env,
-            capture_output=True,
-            text=True,
-            encoding="utf-8",
-            errors="replace",
-            timeout=30,
+# 分片审查的提示词（占位符：repo, pr_number, head_sha, base_sha, index, total, label）
+# 分片只输出发现的问题，不发表评论；各分片的结果由服务合并为一条总结评论
+_SHARD_REVIEW_PROMPT = """你正在对一个较大 PR 的一部分变更做自动代码评审。当前仓库为 {repo}，PR 编号为 {pr_number}，head_sha={head_sha}，base_sha={base_sha}。
+
+本 PR 已按目录拆分为 {total} 个分片并行评审，你负责第 {index} 个分片（{label}）。本分片的变更（统计、变更文件列表、diff 及变更文件全文）已通过标准输入提供：
+1. 只评审标准输入中列出的文件；需要上下文时可在当前目录用 git、Read 等查看其它代码。
+2. **不要在 PR 上发表任何评论**，各分片的结果会由服务合并为一条总结评论。
+3. 把发现的问题以 Markdown 列表输出，每条注明文件路径与行号及修改建议；没有需要反馈的问题时只输出「未发现需反馈的问题。」。输出中不要包含其它内容。"""
+
+
+def _prompt_hash(prompt: str) -> str:
+    """审查缓存键中的提示词哈希：模板、CLAUDE_CODE_REVIEW_CMD 或 PR 号变化时缓存不再命中。"""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+
+
+def _cache_prompt(repo_full_name: str | None, pr_number: int | None, head_sha: str, base_sha: str) -> str:
+    """
+    审查缓存键所用的提示词。开启分片时大 PR 实际运行的是分片提示词，且是否分片、如何分片由分片参数决定，
+    因此附加分片参数与分片提示词，分片配置变化后缓存不再命中。
+    """
+    prompt = _build_prompt(repo_full_name, pr_number, head_sha, base_sha, with_bundle=REVIEW_BUNDLE)
+    if REVIEW_BUNDLE and REVIEW_SHARD_LINES > 0:
+        prompt += (
+            f"\n\n[shard lines={REVIEW_SHARD_LINES} size={REVIEW_SHARD_SIZE} max={REVIEW_SHARD_MAX}]\n"
+            + _SHARD_REVIEW_PROMPT
         )
+    return prompt
 
-        if r2.returncode != 0:
-            # 如果 SHA 不存在，尝试 fetch 该 ref
-            logger.info("[git] SHA 不存在本地，尝试 fetch: %s", head_ref or head_sha[:7])
-            if head_ref:
-                r3 = subprocess.run(
-                    ["git", "fetch", "origin", f"{head_ref}:{head_ref}"],
-                    cwd=str(repo_dir),
-                    env=env,
-                    capture_output=True,
-                    text=True,
-                    encoding="utf-8",
-                    errors="replace",
-                    timeout=60,
-                )
-                logger.info("[git] git fetch origin %s: returncode=%s", head_ref, r3.returncode)
-
-            # 再次尝试 fetch 该 SHA
-            r4 = subprocess.run(
-                ["git", "fetch", "origin", head_sha],
-                cwd=str(repo_dir),
-                env=env,
-                capture_output=True,
-                text=True,
-                encoding="utf-8",
-                errors="replace",
-                timeout=60,
-            )
-            logger.info("[git] git fetch origin %s: returncode=%s", head_sha[:7], r4.returncode)
-
-            # 重试 checkout
-            r5 = subprocess.run(
-                ["git", "checkout", head_sha],
-                cwd=str(repo_dir),
-                env=env,
-                capture_output=True,
-                text=True,
-                encoding="utf-8",
-                errors="replace",
-                timeout=30,
-            )
-            if r5.returncode != 0:
-                logger.error("[git] checkout 失败: %s", r5.stderr)
-                return False
 
-        # 验证当前 HEAD
-        r6 = subprocess.run(
-            ["git", "rev-parse", "HEAD"],
-            cwd=str(repo_dir),
-            env=env,
-            capture_output=True,
-            text=True,
-            encoding="utf-8",
-            errors="replace",
-            timeout=10,
+# 同一仓库的 fetch 与 worktree 增删会修改共享的 .git，需串行执行
+_repo_locks: dict[str, asyncio.Lock] = {}
+
+
+def _repo_lock(repo_dir: Path) -> asyncio.Lock:
+    return _repo_locks.setdefault(str(repo_dir), asyncio.Lock())
+
+
+async def _git(repo_dir: Path, args: list[str], timeout: float = 60) -> subprocess.CompletedProcess:
+    return await _exec(["git", *args], cwd=repo_dir, timeout=timeout)
+
+
+async def _has_commit(repo_dir: Path, sha: str) -> bool:
+    if not sha:
+        return True
+    return (await _git(repo_dir, ["cat-file", "-e", f"{sha}^{{commit}}"], timeout=10)).returncode == 0
+
+
+async def _is_shallow(repo_dir: Path) -> bool:
+    r = await _git(repo_dir, ["rev-parse", "--is-shallow-repository"], timeout=10)
+    return r.returncode == 0 and r.stdout.strip() == "true"
+
+
+async def _deepen_to_merge_base(repo_dir: Path, head_sha: str, base_sha: str) -> None:
+    """
+    浅仓库中逐步加深 head 与 base（每次加深 FETCH_DEPTH × 2^i 个提交），直到能求出 merge-base；
+    超过 FETCH_DEEPEN_MAX 次后完整拉取。
+    """
+    if not base_sha:
+        return
+    for i in range(FETCH_DEEPEN_MAX + 1):
+        r = await _git(repo_dir, ["merge-base", head_sha, base_sha], timeout=30)
+        if r.returncode == 0:
+            if i:
+                logger.info("[git] 加深 %s 次后找到 merge-base %s", i, r.stdout.strip()[:7])
+            return
+        if i == FETCH_DEEPEN_MAX:
+            break
+        r = await _git(
+            repo_dir, ["fetch", "--no-tags", f"--deepen={FETCH_DEPTH * 2 ** i}", "origin", head_sha, base_sha],
+            timeout=FETCH_TIMEOUT,
         )
-        current_head = r6.stdout.strip()[:7] if r6.returncode == 0 else "(unknown)"
-        elapsed = time.time() - start_time
-        logger.info("[git] 已切换到 %s (目标: %s)，耗时 %.1f 秒", current_head, head_sha[:7], elapsed)
+        if r.returncode != 0:
+            logger.warning("[git] 加深失败: %s", r.stderr.strip())
+            break
+    logger.warning("[git] 浅拉取找不到 merge-base，完整拉取历史")
+    r = await _git(repo_dir, ["fetch", "--no-tags", "--unshallow", "origin"], timeout=FETCH_TIMEOUT)
+    if r.returncode != 0:
+        logger.warning("[git] --unshallow 失败: %s", r.stderr.strip())
 
+
+async def _fetch_pr(
+    repo_dir: Path, pr_number: int, head_sha: str, base_sha: str, head_ref: str = "", mirror: bool = False
+) -> bool:
+    """
+    一次 fetch 同时拉取 refs/pull/<n>/head 与 base SHA（本地已有的跳过，两者都有则不访问网络）。
+    refs/pull 对 fork 的 PR 同样可用；远程不支持时退回按 SHA / 分支名拉取。
+    mirror 为 True（服务自己的镜像）且镜像是浅仓库时按 FETCH_DEPTH 浅拉取，再加深到 merge-base；
+    本地仓库从不浅拉取。
+    """
+    shallow = mirror and FETCH_DEPTH > 0 and await _is_shallow(repo_dir)
+    has_head, has_base = await asyncio.gather(_has_commit(repo_dir, head_sha), _has_commit(repo_dir, base_sha))
+    if has_head and has_base:
+        logger.info("[git] head %s 已在本地，跳过 fetch", head_sha[:7])
+        if shallow:
+            await _deepen_to_merge_base(repo_dir, head_sha, base_sha)
         return True
 
-    except subprocess.TimeoutExpired:
-        logger.error("[git] 操作超时")
+    start_time = time.time()
+    depth = [f"--depth={FETCH_DEPTH}"] if shallow else []
+    refspecs = [f"+refs/pull/{pr_number}/head:refs/remotes/origin/pr/{pr_number}"]
+    if not has_base:
+        refspecs.append(base_sha)
+    logger.info("[git] 执行: git fetch origin %s", " ".join(depth + refspecs))
+    r = await _git(repo_dir, ["fetch", "--no-tags", *depth, "origin", *refspecs], timeout=FETCH_TIMEOUT)
+    if r.returncode != 0:
+        logger.warning("[git] 拉取 refs/pull/%s/head 失败，按 SHA 拉取: %s", pr_number, r.stderr.strip())
+        fallback = [head_sha] + ([] if has_base else [base_sha])
+        r = await _git(repo_dir, ["fetch", "--no-tags", *depth, "origin", *fallback], timeout=FETCH_TIMEOUT)
+        if r.returncode != 0 and head_ref:
+            r = await _git(repo_dir, ["fetch", "--no-tags", *depth, "origin", head_ref], timeout=FETCH_TIMEOUT)
+    if not await _has_commit(repo_dir, head_sha):
+        logger.error("[git] 拉取后仍找不到 head %s: %s", head_sha[:7], r.stderr.strip())
+        return False
+    if shallow:
+        await _deepen_to_merge_base(repo_dir, head_sha, base_sha)
+    logger.info("[git] fetch 完成，耗时 %.1f 秒", time.time() - start_time)
+    return True
+
+
+async def _fetch_and_checkout(
+    repo_dir: Path,
+    pr_number: int,
+    head_sha: str,
+    base_sha: str,
+    head_ref: str = "",
+    progress: Progress | None = None,
+) -> bool:
+    """在本地仓库中拉取 PR 并直接切换到 head SHA（LOCAL_REPO_WORKTREE=0 时使用）。"""
+    try:
+        async with _repo_lock(repo_dir):
+            _report(progress, "fetch")
+            if not await _fetch_pr(repo_dir, pr_number, head_sha, base_sha, head_ref):
+                return False
+            _report(progress, "checkout")
+            logger.info("[git] 切换到 PR head: %s%s", head_sha[:7], f" (分支: {head_ref})" if head_ref else "")
+            r = await _git(repo_dir, ["checkout", "--detach", head_sha], timeout=CHECKOUT_TIMEOUT)
+        if r.returncode != 0:
+            logger.error("[git] checkout 失败: %s", r.stderr)
+            return False
+        return True
+    except subprocess.TimeoutExpired as e:
+        logger.error("[git] 操作超时（%s 秒）: %s", e.timeout, " ".join(e.cmd))
         return False
     except Exception as e:
         logger.exception("[git] 异常: %s", e)
         return False
 
 
-def _clone_and_checkout(repo_full_name: str, head_sha: str, work_dir: Path) -> bool:
-    """克隆仓库并 checkout 到 head_sha。使用 gh repo clone + git checkout。"""
+async def _add_worktree(
+    repo_dir: Path,
+    pr_number: int,
+    head_sha: str,
+    base_sha: str,
+    head_ref: str,
+    name: str,
+    sparse_dir: str = "",
+    progress: Progress | None = None,
+    mirror: bool = False,
+) -> Path | None:
+    """
+    在共享仓库中拉取 PR，并为本次任务创建独立的 detached worktree（共用对象库，不复制对象）。
+    mirror 为 True 表示 repo_dir 是服务自己的镜像（允许浅拉取与 sparse checkout），否则是 LOCAL_REPO_PATH。
+    sparse_dir 非空时只检出该子目录（及仓库根目录下的文件），仅用于镜像。返回 worktree 目录；失败返回 None。
+    """
+    if sparse_dir and not mirror:
+        logger.warning("[worktree] 本地仓库模式不使用 sparse checkout（会修改共享的 .git/config），完整检出")
+        sparse_dir = ""
     start_time = time.time()
-    clone_dir = work_dir / repo_full_name.replace("/", "_")
-
-    logger.info("[clone] 开始克隆 repo=%s -> %s", repo_full_name, clone_dir)
-
+    worktree_dir = Path(WORKTREE_ROOT) / name
+    logger.info("[worktree] 准备 %s -> %s", head_sha[:7], worktree_dir)
     try:
-        if clone_dir.exists():
-            logger.info("[clone] 删除已存在的目录: %s", clone_dir)
-            shutil.rmtree(clone_dir, ignore_errors=True)
-        clone_dir.mkdir(parents=True, exist_ok=True)
-
-        env = os.environ.copy()
-        if GH_TOKEN:
-            env["GH_TOKEN"] = GH_TOKEN
-
-        # gh repo clone owner/repo <dir>（Windows 下用 utf-8 解码输出，避免 cp950 报错）
-        logger.info("[clone] 执行: gh repo clone %s %s", repo_full_name, clone_dir)
-        r = subprocess.run(
-            ["gh", "repo", "clone", repo_full_name, str(clone_dir)],
-            env=env,
-            capture_output=True,
-            text=True,
-            encoding="utf-8",
-            errors="replace",
-            timeout=120,
-        )
+        async with _repo_lock(repo_dir):
+            _report(progress, "fetch")
+            # fetch 与清理上次异常退出遗留的 worktree 记录互不影响，并行执行
+            fetched, _ = await asyncio.gather(
+                _fetch_pr(repo_dir, pr_number, head_sha, base_sha, head_ref, mirror),
+                _git(repo_dir, ["worktree", "prune"], timeout=30),
+            )
+            if not fetched:
+                return None
+            _report(progress, "checkout")
+            if worktree_dir.exists():
+                await _git(repo_dir, ["worktree", "remove", "--force", str(worktree_dir)], timeout=60)
+                await asyncio.to_thread(shutil.rmtree, worktree_dir, ignore_errors=True)
+            worktree_dir.parent.mkdir(parents=True, exist_ok=True)
+            add_args = ["worktree", "add", "--detach"] + (["--no-checkout"] if sparse_dir else [])
+            r = await _git(repo_dir, [*add_args, str(worktree_dir), head_sha], timeout=CHECKOUT_TIMEOUT)
         if r.returncode != 0:
-            logger.error("[clone] gh repo clone 失败: returncode=%s stderr=%s stdout=%s", r.returncode, r.stderr, r.stdout)
-            return False
-
-        elapsed = time.time() - start_time
-        logger.info("[clone] 克隆完成，耗时 %.1f 秒", elapsed)
-
-        # git checkout head_sha
-        logger.info("[clone] 切换到 SHA: %s", head_sha[:7])
-        r2 = subprocess.run(
-            ["git", "checkout", head_sha],
-            cwd=str(clone_dir),
-            env=env,
-            capture_output=True,
-            text=True,
-            encoding="utf-8",
-            errors="replace",
-            timeout=60,
+            logger.error("[worktree] git worktree add 失败: %s", r.stderr)
+            return None
+        if sparse_dir:
+            # 在 linked worktree 中 sparse-checkout set 会在镜像的共享 config 中开启 extensions.worktreeConfig，
+            # 检出范围写在该 worktree 自己的 config.worktree 中；镜像只由本服务使用，不影响用户仓库
+            r = await _git(worktree_dir, ["sparse-checkout", "set", "--cone", sparse_dir], timeout=60)
+            if r.returncode == 0:
+                r = await _git(worktree_dir, ["checkout", "--detach", head_sha], timeout=CHECKOUT_TIMEOUT)
+            if r.returncode != 0:
+                logger.error("[worktree] sparse checkout %s 失败: %s", sparse_dir, r.stderr)
+                await _remove_worktree(repo_dir, worktree_dir)
+                return None
+        logger.info(
+            "[worktree] 已创建 %s (HEAD=%s%s)，耗时 %.1f 秒",
+            worktree_dir, head_sha[:7], f" sparse={sparse_dir}" if sparse_dir else "", time.time() - start_time,
         )
-        if r2.returncode != 0:
-            logger.warning("[clone] git checkout %s 失败，尝试 fetch: %s", head_sha[:7], r2.stderr)
-            # 尝试 fetch 后再 checkout
-            r3 = subprocess.run(
-                ["git", "fetch", "origin", head_sha],
-                cwd=str(clone_dir),
-                env=env,
-                capture_output=True,
-                text=True,
-                encoding="utf-8",
-                errors="replace",
-                timeout=60,
-            )
-            logger.info("[clone] git fetch 结果: returncode=%s", r3.returncode)
-            r4 = subprocess.run(
-                ["git", "checkout", head_sha],
-                cwd=str(clone_dir),
-                env=env,
-                capture_output=True,
-                text=True,
-                encoding="utf-8",
-                errors="replace",
-                timeout=60,
-            )
-            if r4.returncode != 0:
-                logger.error("[clone] git checkout 最终失败: %s", r4.stderr)
-                return False
+        return worktree_dir
+    except subprocess.TimeoutExpired as e:
+        logger.error("[worktree] 操作超时（%s 秒）: %s", e.timeout, " ".join(e.cmd))
+        await _remove_worktree(repo_dir, worktree_dir)
+        return None
+    except asyncio.CancelledError:
+        await _remove_worktree(repo_dir, worktree_dir)
+        raise
+    except Exception as e:
+        logger.exception("[worktree] 异常: %s", e)
+        return None
 
-        total_elapsed = time.time() - start_time
-        logger.info("[clone] 完成，总耗时 %.1f 秒，目录: %s", total_elapsed, clone_dir)
-        return True
-    except subprocess.TimeoutExpired:
-        logger.error("[clone] 超时 repo=%s", repo_full_name)
-        return False
+
+async def _remove_worktree(repo_dir: Path, worktree_dir: Path) -> None:
+    """删除任务的 worktree；git 删除失败时直接删目录并 prune。"""
+    try:
+        async with _repo_lock(repo_dir):
+            r = await _git(repo_dir, ["worktree", "remove", "--force", str(worktree_dir)], timeout=60)
+            if r.returncode != 0:
+                logger.warning("[worktree] git worktree remove 失败: %s", r.stderr.strip())
+                await asyncio.to_thread(shutil.rmtree, worktree_dir, ignore_errors=True)
+                await _git(repo_dir, ["worktree", "prune"], timeout=30)
+        logger.info("[worktree] 已删除 %s", worktree_dir)
     except Exception as e:
-        logger.exception("[clone] 异常: %s", e)
-        return False
+        logger.warning("[worktree] 删除 %s 失败: %s", worktree_dir, e)
+
 
+async def _ensure_mirror(repo_full_name: str, progress: Progress | None = None) -> Path | None:
+    """
+    返回仓库的持久镜像（裸仓库）目录；不存在时用 gh repo clone --bare 创建（可选 --filter）。
+    之后每次任务只在镜像中增量 fetch，再从镜像 git worktree add 检出。
+    """
+    mirror_dir = Path(MIRROR_ROOT) / f"{repo_full_name.replace('/', '_')}.git"
+    async with _repo_lock(mirror_dir):
+        if mirror_dir.is_dir():
+            r = await _git(mirror_dir, ["rev-parse", "--is-bare-repository"], timeout=10)
+            if r.returncode == 0 and r.stdout.strip() == "true":
+                return mirror_dir
+            logger.warning("[mirror] 镜像目录无效，重新创建: %s", mirror_dir)
+            await asyncio.to_thread(shutil.rmtree, mirror_dir, ignore_errors=True)
+
+        _report(progress, "clone")
+        start_time = time.time()
+        mirror_dir.parent.mkdir(parents=True, exist_ok=True)
+        git_flags = ["--bare"] + ([f"--filter={MIRROR_FILTER}"] if MIRROR_FILTER else [])
+        if FETCH_DEPTH > 0:
+            git_flags.append(f"--depth={FETCH_DEPTH}")
+        logger.info("[mirror] 创建镜像: gh repo clone %s %s -- %s", repo_full_name, mirror_dir, " ".join(git_flags))
+        try:
+            r = await _exec(
+                ["gh", "repo", "clone", repo_full_name, str(mirror_dir), "--", *git_flags], timeout=CLONE_TIMEOUT
+            )
+        except subprocess.TimeoutExpired:
+            logger.error("[mirror] 克隆超时 repo=%s", repo_full_name)
+            await asyncio.to_thread(shutil.rmtree, mirror_dir, ignore_errors=True)
+            return None
+        except asyncio.CancelledError:
+            await asyncio.to_thread(shutil.rmtree, mirror_dir, ignore_errors=True)
+            raise
+        if r.returncode != 0:
+            logger.error("[mirror] gh repo clone 失败: returncode=%s stderr=%s", r.returncode, r.stderr)
+            await asyncio.to_thread(shutil.rmtree, mirror_dir, ignore_errors=True)
+            return None
+        # 裸克隆默认没有 fetch refspec，补上后 git fetch origin 才会更新远程分支
+        await _git(mirror_dir, ["config", "remote.origin.fetch", "+refs/heads/*:refs/remotes/origin/*"], timeout=10)
+        logger.info("[mirror] 镜像已创建 %s，耗时 %.1f 秒", mirror_dir, time.time() - start_time)
+        return mirror_dir
 
-def _run_claude_code_review_in_dir(
+
+async def _run_claude_code_review_in_dir(
     repo_dir: Path,
     repo_full_name: str | None = None,
     pr_number: int | None = None,
@@ -296,11 +567,18 @@ def _run_claude_code_review_in_dir(
     base_sha: str = "",
     pr_title: str = "",
     pr_author: str = "",
+    job_id: str = "",
+    progress: Progress | None = None,
+    timeout: int | None = None,
+    bundle: ReviewBundle | None = None,
 ) -> bool:
     """
     在指定仓库目录中执行 Claude Code：一律使用 /code-review:code-review 命令进行审核。
     若 CLAUDE_USE_NATURAL_PROMPT 且提供了 repo_full_name、pr_number，则在命令后附加自然语言提示词。
+    提供 job_id 时输出流式写入该任务的日志文件（见 job_logs）。所在任务被取消时结束 claude 进程树。
+    timeout 为 None 时使用 CLAUDE_REVIEW_TIMEOUT。bundle 非空时审查包文本通过标准输入交给 claude。
     """
+    timeout = CLAUDE_REVIEW_TIMEOUT if timeout is None else timeout
     start_time = time.time()
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
@@ -318,44 +596,46 @@ def _run_claude_code_review_in_dir(
         logger.error("[claude] 仓库目录不存在或不是目录: %s", repo_dir)
         return False
 
-    env = os.environ.copy()
-    if ANTHROPIC_API_KEY:
-        env["ANTHROPIC_API_KEY"] = ANTHROPIC_API_KEY
-    if GH_TOKEN:
-        env["GH_TOKEN"] = GH_TOKEN
-
-    use_natural = CLAUDE_USE_NATURAL_PROMPT and repo_full_name is not None and pr_number is not None
-    if use_natural:
-        extra_prompt = CODE_REVIEW_PROMPT_TEMPLATE.format(
-            repo=repo_full_name,
-            pr_number=pr_number,
-            head_sha=head_sha,
-            base_sha=base_sha,
-        )
-        # 先发 slash 命令，再附上自然语言说明
-        prompt = CLAUDE_CODE_REVIEW_CMD + "\n\n" + extra_prompt
-        cmd = [CLAUDE_CLI, "-p", prompt]
+    prompt = _build_prompt(repo_full_name, pr_number, head_sha, base_sha, with_bundle=bundle is not None)
+    cmd = [CLAUDE_CLI, "-p", prompt]
+    if prompt != CLAUDE_CODE_REVIEW_CMD:
         logger.info("[claude] 执行模式: slash 命令 + 自然语言提示")
         logger.info("[claude] 命令: %s -p '<prompt len=%d>'", CLAUDE_CLI, len(prompt))
     else:
-        cmd = [CLAUDE_CLI, "-p", CLAUDE_CODE_REVIEW_CMD]
         logger.info("[claude] 执行模式: 仅 slash 命令")
         logger.info("[claude] 命令: %s -p '%s'", CLAUDE_CLI, CLAUDE_CODE_REVIEW_CMD)
 
-    logger.info("[claude] 超时设置: %d 秒", CLAUDE_REVIEW_TIMEOUT)
+    if bundle is not None:
+        logger.info("[claude] 审查包（标准输入）: %s", bundle.summary())
+    logger.info("[claude] 超时设置: %d 秒", timeout)
+
+    sharded = bundle is not None and bool(bundle.shards) and repo_full_name is not None and pr_number is not None
+    stdin = bundle.text.encode("utf-8") if bundle is not None else None
+    if not sharded and await _throttle(progress, prompt, stdin) > 0:
+        # 执行耗时不含等待限速额度的时间
+        start_time = time.time()
+
+    job_log = None
+    if job_id:
+        job_log = JobLog(job_id)
+        job_log.open()
+        await job_log.write_line(
+            f"===== {timestamp} {repo_full_name} PR #{pr_number} head={head_sha[:7]} base={base_sha[:7]} cwd={repo_dir}"
+        )
+        logger.info("[claude] 输出写入: %s", job_log.path)
+    if sharded:
+        try:
+            return await _run_sharded_review(
+                repo_dir, repo_full_name, pr_number, head_sha, base_sha, bundle, timeout, job_log, progress
+            )
+        finally:
+            if job_log is not None:
+                job_log.close()
     logger.info("[claude] 开始执行...")
+    _report(progress, "review")
 
     try:
-        r = subprocess.run(
-            cmd,
-            cwd=str(repo_dir),
-            env=env,
-            capture_output=True,
-            text=True,
-            encoding="utf-8",
-            errors="replace",
-            timeout=CLAUDE_REVIEW_TIMEOUT,
-        )
+        r = await _exec(cmd, cwd=repo_dir, timeout=timeout, sink=job_log, input=stdin)
 
         elapsed = time.time() - start_time
         logger.info("-" * 60)
@@ -363,12 +643,17 @@ def _run_claude_code_review_in_dir(
         logger.info("[claude] 返回码: %d", r.returncode)
         logger.info("[claude] 执行耗时: %.1f 秒", elapsed)
 
-        if r.stdout:
+        if job_log is not None:
+            await job_log.write_line(f"===== 返回码 {r.returncode}，耗时 {elapsed:.1f} 秒")
+            logger.info("[claude] 输出 %d 字节，已写入 %s", job_log.written, job_log.path)
+            if r.stdout:
+                logger.info("[claude] 输出末尾:\n%s", r.stdout[-500:])
+        elif r.stdout:
             stdout_preview = r.stdout[:500] + "..." if len(r.stdout) > 500 else r.stdout
             logger.info("[claude] 输出长度: %d 字符", len(r.stdout))
             logger.info("[claude] 输出预览:\n%s", stdout_preview)
         if r.stderr:
-            logger.warning("[claude] 错误输出: %s", r.stderr[:500])
+            logger.warning("[claude] 错误输出: %s", r.stderr[-500:])
 
         if r.returncode != 0:
             logger.warning("[claude] 执行失败，返回码非 0")
@@ -378,45 +663,262 @@ def _run_claude_code_review_in_dir(
         logger.info("=" * 60)
         return r.returncode == 0
 
-    except subprocess.TimeoutExpired as e:
+    except asyncio.CancelledError:
+        logger.warning("[claude] PR #%s 的 review 已取消，claude 进程树已结束（已运行 %.1f 秒）",
+                       pr_number, time.time() - start_time)
+        if job_log is not None:
+            await job_log.write_line("===== 已取消")
+        raise
+    except subprocess.TimeoutExpired:
         elapsed = time.time() - start_time
-        logger.error("[claude] 执行超时！已运行 %.1f 秒（超时设置: %d 秒）", elapsed, CLAUDE_REVIEW_TIMEOUT)
+        logger.error("[claude] 执行超时！已运行 %.1f 秒（超时设置: %d 秒）", elapsed, timeout)
         logger.error("[claude] PR #%s 代码审查超时", pr_number)
+        _report(progress, "timeout")
+        if job_log is not None:
+            await job_log.write_line(f"===== 执行超时（{timeout} 秒）")
         return False
     except Exception as e:
         elapsed = time.time() - start_time
         logger.exception("[claude] 执行异常（已运行 %.1f 秒）: %s", elapsed, e)
         return False
+    finally:
+        if job_log is not None:
+            job_log.close()
+
+
+async def _prepare_bundle(
+    checkout_dir: Path, repo_full_name: str, head_sha: str, base_sha: str, progress: Progress | None = None
+) -> ReviewBundle | None:
+    """在检出目录中生成审查包（REVIEW_BUNDLE=0 或生成失败时返回 None，由 claude 自行获取变更）。"""
+    if not REVIEW_BUNDLE:
+        return None
+    _report(progress, "bundle")
+    try:
+        bundle = await build_bundle(
+            lambda args, timeout: _git(checkout_dir, args, timeout), checkout_dir, repo_full_name, base_sha, head_sha
+        )
+        if bundle is not None:
+            _report(progress, "stats", f"{len(bundle.files)} {bundle.additions + bundle.deletions}")
+        return bundle
+    except subprocess.TimeoutExpired as e:
+        logger.warning("[bundle] git 操作超时（%s 秒），由 claude 自行获取变更: %s", e.timeout, " ".join(e.cmd))
+    except Exception as e:
+        logger.exception("[bundle] 生成审查包失败，由 claude 自行获取变更: %s", e)
+    return None
+
+
+async def _throttle(progress: Progress | None, prompt: str, stdin: bytes | None) -> float:
+    """启动 claude 前取得限速额度（见 rate_limiter），额度不足时进入 throttle 阶段等待。返回等待的秒数。"""
+    tokens = estimate_tokens(prompt, stdin or b"")
+    return await claude_limiter.acquire(tokens, lambda delay: _report(progress, "throttle", f"{delay:.0f}"))
+
+
+async def _review_shard(
+    repo_dir: Path,
+    repo_full_name: str,
+    pr_number: int,
+    head_sha: str,
+    base_sha: str,
+    shard: ReviewBundle,
+    index: int,
+    total: int,
+    deadline: float,
+    job_log: JobLog | None,
+) -> tuple[str, str]:
+    """
+    审查一个分片，返回 (结果 done / failed / timeout, claude 的输出)。输出在分片结束后整段写入任务日志。
+    deadline 为整个任务的截止时间（time.time()），等待并发名额、限速额度与执行都计入其中。
+    """
+    prompt = _SHARD_REVIEW_PROMPT.format(
+        repo=repo_full_name, pr_number=pr_number, head_sha=head_sha, base_sha=base_sha,
+        index=index, total=total, label=shard.label,
+    )
+    stdin = shard.text.encode("utf-8")
+    try:
+        # 分片已处于 reviewing 状态，等待限速额度时只记录日志
+        waited = await asyncio.wait_for(_throttle(None, prompt, stdin), max(0.0, deadline - time.time()))
+        if waited >= 1:
+            logger.info("[shard] 分片 %d/%d 等待限速额度 %.1f 秒", index, total, waited)
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise asyncio.TimeoutError
+        start_time = time.time()
+        logger.info("[shard] 分片 %d/%d 开始: %s（%s），剩余 %.0f 秒", index, total, shard.label, shard.summary(), remaining)
+        r = await _exec([CLAUDE_CLI, "-p", prompt], cwd=repo_dir, timeout=remaining, input=stdin)
+    except (subprocess.TimeoutExpired, asyncio.TimeoutError):
+        logger.error("[shard] 分片 %d/%d 未能在任务截止时间前完成", index, total)
+        if job_log is not None:
+            await job_log.write_line(f"===== 分片 {index}/{total} {shard.label}：超过任务截止时间")
+        return "timeout", ""
+    elapsed = time.time() - start_time
+    state = "done" if r.returncode == 0 else "failed"
+    logger.info("[shard] 分片 %d/%d 结束，返回码 %d，耗时 %.1f 秒", index, total, r.returncode, elapsed)
+    if r.stderr:
+        logger.warning("[shard] 分片 %d/%d 错误输出: %s", index, total, r.stderr[-500:])
+    if job_log is not None:
+        await job_log.write_line(f"===== 分片 {index}/{total} {shard.label}：返回码 {r.returncode}，耗时 {elapsed:.1f} 秒")
+        await job_log.write(r.stdout.encode("utf-8"))
+    return state, r.stdout.strip()
+
+
+def _fit_outputs(outputs: list[str], budget: int) -> list[str]:
+    """
+    把各分片的输出截断到总长度不超过 budget：短的输出保持完整，剩余额度平分给较长的输出，
+    被截断的输出末尾附上说明。
+    """
+    note = "\n\n…（结果过长已截断，完整内容见任务日志）"
+    budget = max(0, budget - len(note) * len(outputs))
+    limits = [0] * len(outputs)
+    order = sorted(range(len(outputs)), key=lambda i: len(outputs[i]))
+    for k, i in enumerate(order):
+        limits[i] = min(len(outputs[i]), budget // (len(outputs) - k))
+        budget -= limits[i]
+    return [out if len(out) <= limit else out[:limit].rstrip() + note for out, limit in zip(outputs, limits)]
 
 
-def _run_claude_code_review(
+def _shard_comment(bundle: ReviewBundle, head_sha: str, results: list[tuple[str, str]]) -> str:
+    """把各分片的结果合并为总结评论正文，总长度不超过 REVIEW_COMMENT_MAX_CHARS。"""
+    total = len(bundle.shards)
+    header = (
+        "## 自动代码评审\n\n"
+        f"本 PR 共 {len(bundle.files)} 个文件（+{bundle.additions} -{bundle.deletions}），"
+        f"已按目录拆分为 {total} 个分片并行评审（head {head_sha[:7]}）。"
+    )
+    titles = [
+        f"\n\n### 分片 {i}/{total}：{shard.label}（{len(shard.files)} 个文件）\n\n"
+        for i, shard in enumerate(bundle.shards, 1)
+    ]
+    outputs = []
+    for state, output in results:
+        if state == "done":
+            outputs.append(output or "未发现需反馈的问题。")
+        else:
+            outputs.append("该分片评审超时，未给出结果。" if state == "timeout" else "该分片评审失败，未给出结果。")
+    budget = REVIEW_COMMENT_MAX_CHARS - len(header) - sum(len(t) for t in titles)
+    if sum(len(out) for out in outputs) > budget:
+        outputs = _fit_outputs(outputs, budget)
+    return header + "".join(title + out for title, out in zip(titles, outputs))
+
+
+async def _run_sharded_review(
+    repo_dir: Path,
+    repo_full_name: str,
+    pr_number: int,
+    head_sha: str,
+    base_sha: str,
+    bundle: ReviewBundle,
+    timeout: int,
+    job_log: JobLog | None,
+    progress: Progress | None,
+) -> bool:
+    """
+    大 PR 的分片审查：最多 REVIEW_SHARD_WORKERS 个 claude 同时审查各分片，所有分片共用任务的 timeout
+    （排在后面的分片只有剩余时间）；任一分片异常或任务被取消时结束其余分片的 claude 进程树。
+    结束后把各分片的结果合并为一条总结评论（gh pr comment，超过 REVIEW_COMMENT_MAX_CHARS 时截断各分片结果）。
+    有分片失败或超时时仍发表已有结果，但返回 False。
+    """
+    total = len(bundle.shards)
+    semaphore = asyncio.Semaphore(max(1, REVIEW_SHARD_WORKERS))
+    start_time = time.time()
+    deadline = start_time + timeout
+    logger.info("[shard] 分片审查: %d 个分片，%d 个并行，总超时 %d 秒", total, REVIEW_SHARD_WORKERS, timeout)
+    _report(progress, "review", f"{total} shards")
+
+    async def run(index: int, shard: ReviewBundle) -> tuple[str, str]:
+        async with semaphore:
+            return await _review_shard(
+                repo_dir, repo_full_name, pr_number, head_sha, base_sha, shard, index, total, deadline, job_log
+            )
+
+    tasks = [asyncio.create_task(run(i, shard)) for i, shard in enumerate(bundle.shards, 1)]
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        # gather 不会取消其余分片：逐个取消并等待，确保 claude 进程树都已结束
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    failed = [i for i, (state, _) in enumerate(results, 1) if state != "done"]
+    if any(state == "timeout" for state, _ in results):
+        _report(progress, "timeout")
+
+    body = _shard_comment(bundle, head_sha, results)
+    if job_log is not None:
+        await job_log.write_line(f"===== 总结评论（{len(body)} 字符）")
+        await job_log.write((body + "\n").encode("utf-8"))
+
+    r = await _exec(
+        ["gh", "pr", "comment", str(pr_number), "--repo", repo_full_name, "--body-file", "-"],
+        cwd=repo_dir, timeout=60, input=body.encode("utf-8"),
+    )
+    elapsed = time.time() - start_time
+    if r.returncode != 0:
+        logger.error("[shard] 发表总结评论失败: %s", r.stderr.strip())
+        if job_log is not None:
+            await job_log.write_line(f"===== 发表总结评论失败: {r.stderr.strip()[:500]}")
+        return False
+    logger.info(
+        "[shard] 已发表总结评论，%d/%d 个分片完成，耗时 %.1f 秒", total - len(failed), total, elapsed,
+    )
+    if job_log is not None:
+        await job_log.write_line(f"===== 已发表总结评论，{total - len(failed)}/{total} 个分片完成，耗时 {elapsed:.1f} 秒")
+    return not failed
+
+
+async def _review_local_checkout(
+    repo_dir: Path,
+    checkout_dir: Path,
     repo_full_name: str,
     pr_number: int,
     head_sha: str,
     base_sha: str,
-    work_dir: Path,
     pr_title: str = "",
     pr_author: str = "",
+    job_id: str = "",
+    progress: Progress | None = None,
+    repo: RepoConfig | None = None,
+    timeout: int | None = None,
 ) -> bool:
     """
-    在已 clone 的仓库目录中启动 Claude Code 终端，执行 /code-review:code-review。
+    在本地仓库的检出目录（本地仓库本身或任务的 worktree）中执行 code review。
+    working_dir（CLAUDE_WORKING_DIR）位于本地仓库内时，换算到检出目录中对应的位置。
+    timeout 为 None 时使用仓库配置的超时。
     """
-    clone_dir = work_dir / repo_full_name.replace("/", "_")
-    if not clone_dir.exists():
-        logger.error("[review] 仓库目录不存在: %s", clone_dir)
-        return False
-    return _run_claude_code_review_in_dir(
-        clone_dir,
+    repo = repo or registry.lookup(repo_full_name)
+    # Claude 启动目录：优先 working_dir，否则 repo 根（或 repo/subdir）
+    if repo.working_dir and Path(repo.working_dir).is_dir():
+        claude_cwd = Path(repo.working_dir).resolve()
+        if checkout_dir != repo_dir and claude_cwd.is_relative_to(repo_dir):
+            claude_cwd = checkout_dir / claude_cwd.relative_to(repo_dir)
+        logger.info("[review] Claude 工作目录 (working_dir): %s", claude_cwd)
+    elif repo.subdir:
+        claude_cwd = (checkout_dir / repo.subdir).resolve()
+        if not claude_cwd.is_dir():
+            logger.error("[review] subdir 目录不存在: %s", claude_cwd)
+            return False
+        logger.info("[review] Claude 工作目录 (subdir): %s", claude_cwd)
+    else:
+        claude_cwd = checkout_dir
+        logger.info("[review] Claude 工作目录 (仓库根): %s", claude_cwd)
+
+    bundle = await _prepare_bundle(checkout_dir, repo_full_name, head_sha, base_sha, progress)
+    return await _run_claude_code_review_in_dir(
+        claude_cwd,
         repo_full_name=repo_full_name,
         pr_number=pr_number,
         head_sha=head_sha,
         base_sha=base_sha,
         pr_title=pr_title,
         pr_author=pr_author,
+        job_id=job_id,
+        progress=progress,
+        timeout=repo.timeout if timeout is None else timeout,
+        bundle=bundle,
     )
 
 
-def _run_code_review_sync(
+async def run_code_review_async(
     repo_full_name: str,
     pr_number: int,
     head_sha: str,
@@ -425,10 +927,57 @@ def _run_code_review_sync(
     pr_author: str = "",
     head_ref: str = "",
     base_ref: str = "",
-) -> None:
+    job_id: str = "",
+    progress: Progress | None = None,
+    timeout: int | None = None,
+) -> bool:
     """
-    同步执行：若配置了 LOCAL_REPO_PATH 且匹配则直接用；否则克隆后在 Claude Code 终端执行。
+    执行一次 code review：仓库注册表中配置了本地路径的仓库用本地仓库；否则用镜像检出后在 Claude Code 终端执行。
+    git / gh / claude 均为 asyncio 子进程，不占用线程；任务被取消时结束正在运行的进程树并清理 worktree。
+    job_id 非空时 claude 的输出写入该任务的日志文件；progress 在进入各阶段时被调用。
+    timeout 为本次 claude 执行的超时（队列按历史耗时估计），None 时使用仓库配置或 CLAUDE_REVIEW_TIMEOUT。
+    同一 (repo, head, base, 提示词) 已成功审查过时直接返回，不再拉取代码、运行 claude。
+    返回 True 表示 code review 执行成功。
     """
+    prompt_hash = _prompt_hash(_cache_prompt(repo_full_name, pr_number, head_sha, base_sha))
+    hit = await review_cache.get(repo_full_name, head_sha, base_sha, prompt_hash)
+    if hit is not None:
+        reviewed_at = datetime.fromtimestamp(hit["created_at"]).strftime("%Y-%m-%d %H:%M:%S")
+        logger.info(
+            "[review] 命中审查缓存，跳过 %s PR #%s head=%s（已于 %s 由任务 %s 审查）",
+            repo_full_name, pr_number, head_sha[:7], reviewed_at, hit["job_id"],
+        )
+        _report(progress, "cached", hit["job_id"])
+        if job_id:
+            job_log = JobLog(job_id)
+            job_log.open()
+            await job_log.write_line(f"===== 命中审查缓存：head={head_sha[:7]} 已于 {reviewed_at} 由任务 {hit['job_id']} 审查")
+            job_log.close()
+        return True
+
+    ok = await _run_code_review(
+        repo_full_name, pr_number, head_sha, base_sha, pr_title, pr_author, head_ref, base_ref, job_id, progress,
+        timeout,
+    )
+    if ok:
+        await review_cache.put(repo_full_name, head_sha, base_sha, prompt_hash, pr_number, job_id)
+    return ok
+
+
+async def _run_code_review(
+    repo_full_name: str,
+    pr_number: int,
+    head_sha: str,
+    base_sha: str,
+    pr_title: str,
+    pr_author: str,
+    head_ref: str,
+    base_ref: str,
+    job_id: str,
+    progress: Progress | None,
+    timeout: int | None,
+) -> bool:
+    """run_code_review_async 未命中缓存时的实际执行：选择本地仓库 / 克隆模式，检出后运行 claude。"""
     start_time = time.time()
     logger.info("=" * 60)
     logger.info("[review] 开始代码审查任务")
@@ -440,120 +989,94 @@ def _run_code_review_sync(
     logger.info("[review] BASE: %s (%s)", base_sha[:7], base_ref or "unknown")
     logger.info("=" * 60)
 
-    repo_dir_local = Path(LOCAL_REPO_PATH).resolve() if LOCAL_REPO_PATH else None
-    if not LOCAL_REPO_PATH:
-        logger.info("[review] LOCAL_REPO_PATH 未设置，将克隆仓库")
+    repo = registry.lookup(repo_full_name)
+    if timeout is None:
+        timeout = repo.timeout
+    repo_dir_local = Path(repo.path).resolve() if repo.path else None
+    if not repo.path:
+        logger.info("[review] 仓库 %s 未配置本地路径，将克隆仓库", repo_full_name)
+    elif not repo_dir_local.is_dir():
+        logger.warning("[review] 本地仓库目录不存在: %s，将克隆仓库", repo.path)
         repo_dir_local = None
-    elif not repo_dir_local or not repo_dir_local.is_dir():
-        logger.warning("[review] LOCAL_REPO_PATH 目录不存在: %s，将克隆仓库", LOCAL_REPO_PATH)
-        repo_dir_local = None
-
-    if repo_dir_local and repo_dir_local.is_dir():
-        # 若设置了 LOCAL_REPO_NAME，仅当 webhook 的 repo 与之匹配时才用本地仓库
-        name_normalized = repo_full_name.replace("/", "_")
-        if LOCAL_REPO_NAME:
-            if name_normalized != LOCAL_REPO_NAME and repo_full_name != LOCAL_REPO_NAME:
-                logger.info("[review] 仓库名不匹配 (webhook=%s, config=%s)，将克隆仓库",
-                           repo_full_name, LOCAL_REPO_NAME)
-                repo_dir_local = None
-
-        if repo_dir_local:
-            logger.info("[review] 使用本地仓库: %s", repo_dir_local)
 
+    if repo_dir_local:
+        logger.info("[review] 使用本地仓库: %s", repo_dir_local)
+        _report(progress, "mode", "local-worktree" if LOCAL_REPO_WORKTREE else "local")
+        if LOCAL_REPO_WORKTREE:
+            name = f"{repo_full_name.replace('/', '_')}_pr{pr_number}_{head_sha[:7]}_{uuid.uuid4().hex[:6]}"
+            worktree_dir = await _add_worktree(
+                repo_dir_local, pr_number, head_sha, base_sha, head_ref, name, progress=progress
+            )
+            if worktree_dir is None:
+                logger.error("[review] 创建 worktree 失败，跳过代码审查")
+                return False
+            try:
+                ok = await _review_local_checkout(
+                    repo_dir_local, worktree_dir, repo_full_name, pr_number, head_sha, base_sha,
+                    pr_title, pr_author, job_id, progress, repo, timeout,
+                )
+            finally:
+                await _remove_worktree(repo_dir_local, worktree_dir)
+        else:
             # ★ 拉取最新代码并切换到 PR head
-            if not _fetch_and_checkout(repo_dir_local, head_sha, head_ref):
+            if not await _fetch_and_checkout(
+                repo_dir_local, pr_number, head_sha, base_sha, head_ref, progress
+            ):
                 logger.error("[review] 拉取代码失败，跳过代码审查")
-                return
-
-            # Claude 启动目录：优先 CLAUDE_WORKING_DIR，否则 repo 根（或 repo/CLAUDE_SUBDIR）
-            if CLAUDE_WORKING_DIR and Path(CLAUDE_WORKING_DIR).is_dir():
-                claude_cwd = Path(CLAUDE_WORKING_DIR).resolve()
-                logger.info("[review] Claude 工作目录 (CLAUDE_WORKING_DIR): %s", claude_cwd)
-            elif CLAUDE_SUBDIR:
-                claude_cwd = (repo_dir_local / CLAUDE_SUBDIR).resolve()
-                if not claude_cwd.is_dir():
-                    logger.error("[review] CLAUDE_SUBDIR 目录不存在: %s", claude_cwd)
-                    return
-                logger.info("[review] Claude 工作目录 (CLAUDE_SUBDIR): %s", claude_cwd)
-            else:
-                claude_cwd = repo_dir_local
-                logger.info("[review] Claude 工作目录 (仓库根): %s", claude_cwd)
-
-            ok = _run_claude_code_review_in_dir(
-                claude_cwd,
-                repo_full_name=repo_full_name,
-                pr_number=pr_number,
-                head_sha=head_sha,
-                base_sha=base_sha,
-                pr_title=pr_title,
-                pr_author=pr_author,
+                return False
+            ok = await _review_local_checkout(
+                repo_dir_local, repo_dir_local, repo_full_name, pr_number, head_sha, base_sha,
+                pr_title, pr_author, job_id, progress, repo, timeout,
             )
-            elapsed = time.time() - start_time
-            logger.info("[review] 完成，总耗时: %.1f 秒，结果: %s", elapsed, "成功" if ok else "失败")
-            return
-
-    # 克隆模式
-    logger.info("[review] 克隆模式，目标目录: %s", REPO_ROOT)
-    work_dir = Path(REPO_ROOT)
-    work_dir.mkdir(parents=True, exist_ok=True)
+        elapsed = time.time() - start_time
+        logger.info("[review] 完成，总耗时: %.1f 秒，结果: %s", elapsed, "成功" if ok else "失败")
+        return ok
 
-    if not _clone_and_checkout(repo_full_name, head_sha, work_dir):
+    # 克隆模式：持久镜像 + 每个任务一个 worktree
+    logger.info("[review] 克隆模式，镜像目录: %s", MIRROR_ROOT)
+    _report(progress, "mode", "clone")
+    mirror_dir = await _ensure_mirror(repo_full_name, progress)
+    if mirror_dir is None:
         logger.error("[review] 克隆失败，跳过代码审查")
-        return
+        return False
 
-    clone_dir = work_dir / repo_full_name.replace("/", "_")
-    logger.info("[review] 克隆成功: %s", clone_dir)
-
-    # 克隆模式下也可指定 Claude 工作子目录
-    if CLAUDE_SUBDIR:
-        claude_dir = (clone_dir / CLAUDE_SUBDIR).resolve()
-        if claude_dir.is_dir():
-            logger.info("[review] Claude 工作目录 (CLAUDE_SUBDIR): %s", claude_dir)
-            ok = _run_claude_code_review_in_dir(
-                claude_dir,
-                repo_full_name=repo_full_name,
-                pr_number=pr_number,
-                head_sha=head_sha,
-                base_sha=base_sha,
-                pr_title=pr_title,
-                pr_author=pr_author,
-            )
-        else:
-            logger.warning("[review] CLAUDE_SUBDIR 不存在: %s，使用克隆目录", claude_dir)
-            ok = _run_claude_code_review(
-                repo_full_name, pr_number, head_sha, base_sha, work_dir, pr_title, pr_author
-            )
-    else:
-        ok = _run_claude_code_review(
-            repo_full_name, pr_number, head_sha, base_sha, work_dir, pr_title, pr_author
+    name = f"{repo_full_name.replace('/', '_')}_pr{pr_number}_{head_sha[:7]}_{uuid.uuid4().hex[:6]}"
+    sparse_dir = repo.subdir if SPARSE_CHECKOUT else ""
+    clone_dir = await _add_worktree(
+        mirror_dir, pr_number, head_sha, base_sha, head_ref, name, sparse_dir, progress, mirror=True
+    )
+    if clone_dir is None:
+        logger.error("[review] 检出失败，跳过代码审查")
+        return False
+    try:
+        logger.info("[review] 检出成功: %s", clone_dir)
+
+        # 克隆模式下也可指定 Claude 工作子目录
+        claude_dir = clone_dir
+        if repo.subdir:
+            claude_dir = (clone_dir / repo.subdir).resolve()
+            if claude_dir.is_dir():
+                logger.info("[review] Claude 工作目录 (subdir): %s", claude_dir)
+            else:
+                logger.warning("[review] subdir 不存在: %s，使用克隆目录", claude_dir)
+                claude_dir = clone_dir
+        bundle = await _prepare_bundle(clone_dir, repo_full_name, head_sha, base_sha, progress)
+        ok = await _run_claude_code_review_in_dir(
+            claude_dir,
+            repo_full_name=repo_full_name,
+            pr_number=pr_number,
+            head_sha=head_sha,
+            base_sha=base_sha,
+            pr_title=pr_title,
+            pr_author=pr_author,
+            job_id=job_id,
+            progress=progress,
+            timeout=timeout,
+            bundle=bundle,
         )
+    finally:
+        await _remove_worktree(mirror_dir, clone_dir)
 
     elapsed = time.time() - start_time
     logger.info("[review] 完成，总耗时: %.1f 秒，结果: %s", elapsed, "成功" if ok else "失败")
-
-
-async def run_code_review_async(
-    repo_full_name: str,
-    pr_number: int,
-    head_sha: str,
-    base_sha: str,
-    pr_title: str = "",
-    pr_author: str = "",
-    head_ref: str = "",
-    base_ref: str = "",
-) -> None:
-    """异步执行 code review（在线程池中：克隆 + Claude Code 终端 /code-review）。"""
-    logger.info("[async] 提交后台任务: repo=%s pr=#%s head=%s", repo_full_name, pr_number, head_sha[:7])
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(
-        None,
-        _run_code_review_sync,
-        repo_full_name,
-        pr_number,
-        head_sha,
-        base_sha,
-        pr_title,
-        pr_author,
-        head_ref,
-        base_ref,
-    )
+    return ok
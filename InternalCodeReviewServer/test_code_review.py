@@ -10,6 +10,7 @@
   python test_code_review.py --repo-path .
 """
 import argparse
+import asyncio
 import logging
 import os
 import sys
@@ -58,7 +59,7 @@ def main():
     from review_runner import _run_claude_code_review_in_dir
 
     print(f"在目录 {repo_dir} 下执行 Claude Code code review ...")
-    ok = _run_claude_code_review_in_dir(repo_dir)
+    ok = asyncio.run(_run_claude_code_review_in_dir(repo_dir))
     print("完成" if ok else "失败")
     sys.exit(0 if ok else 1)
 
@@ -0,0 +1,56 @@
+"""
+ReviewQueue 回归测试（不启动 claude，review 由一个可控的假协程代替）。
+
+用法：
+  cd InternalCodeReviewServer
+  python -m pytest -q test_review_queue.py
+"""
+import asyncio
+
+import pytest
+
+import review_queue
+from review_queue import QueueFull, ReviewJob, ReviewQueue
+
+
+async def _wait_for(cond, timeout: float = 2.0) -> None:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not cond():
+        assert loop.time() < deadline, "等待超时"
+        await asyncio.sleep(0.01)
+
+
+def test_push_to_running_pr_is_admitted_when_queue_full(monkeypatch):
+    """队列已满时，对执行中 PR 的新推送仍被接受并替换旧任务，而不是被拒绝后让该 PR 没有审查。"""
+    async def scenario():
+        gate = asyncio.Event()
+
+        async def fake_review(*args, **kwargs):
+            await gate.wait()
+            return True
+
+        monkeypatch.setattr(review_queue, "run_code_review_async", fake_review)
+        queue = ReviewQueue(workers=1, max_queue=1, per_repo_limit=0, debounce=0)
+        queue.start()
+        try:
+            first, _ = queue.submit(ReviewJob("org/repo", 1, "a" * 40, "b" * 40))
+            await _wait_for(lambda: first.state != "queued")
+            queue.submit(ReviewJob("org/repo", 2, "c" * 40, "b" * 40))
+
+            # 全新的 PR 仍受队列上限限制，且被拒时不影响执行中的任务
+            with pytest.raises(QueueFull):
+                queue.submit(ReviewJob("org/repo", 3, "d" * 40, "b" * 40))
+            assert first.superseded_by is None
+
+            second, position = queue.submit(ReviewJob("org/repo", 1, "e" * 40, "b" * 40))
+            assert position == 2
+            assert first.superseded_by == second.id
+            await _wait_for(lambda: first.state == "superseded")
+            assert queue.get(second.id) is second
+            assert queue.rejected == 1
+        finally:
+            gate.set()
+            await queue.stop()
+
+    asyncio.run(scenario())
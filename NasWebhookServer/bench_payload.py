@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+热路径微基准：对 10 KB ~ 5 MB 的模拟 GitHub payload，测量
+verify_signature、parse_payload、转发编码（encode_body）、payload 投影的耗时，
+并对比标准库 json 与 orjson（若已安装）。
+用法：
+  python bench_payload.py
+  python bench_payload.py --sizes 10k,1m --repeat 20
+  python bench_payload.py --save bench.json                              # 保存结果作为基线
+  python bench_payload.py --baseline bench.json --max-regression 0.25    # 比基线慢 25% 以上则退出码 1
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import internal  # noqa: E402
+import jsonutil  # noqa: E402
+import projection  # noqa: E402
+from github import parse_payload, verify_signature  # noqa: E402
+
+SECRET = "bench-secret"
+DEFAULT_SIZES = "10k,100k,1m,5m"
+
+
+def _parse_size(text: str) -> int:
+    text = text.strip().lower()
+    units = {"k": 1024, "m": 1024 * 1024}
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def make_pull_request_payload(target_bytes: int) -> bytes:
+    """构造接近 target_bytes 的 pull_request payload（PR 描述、仓库对象与提交列表模拟真实体积）。"""
+    repo = {
+        "id": 123456,
+        "name": "repo",
+        "full_name": "owner/repo",
+        "private": True,
+        "owner": {"login": "owner", "id": 1, "type": "Organization", "url": "https://api.github.com/users/owner"},
+        "html_url": "https://github.com/owner/repo",
+        "description": "示例仓库 example repository",
+        "default_branch": "main",
+        **{f"{k}_url": f"https://api.github.com/repos/owner/repo/{k}{{/id}}" for k in (
+            "branches", "commits", "compare", "contents", "issues", "pulls", "releases", "tags", "trees",
+        )},
+    }
+    data = {
+        "action": "synchronize",
+        "number": 42,
+        "repository": repo,
+        "sender": {"login": "dev", "id": 2},
+        "pull_request": {
+            "number": 42,
+            "title": "feat: 优化转发性能",
+            "html_url": "https://github.com/owner/repo/pull/42",
+            "draft": False,
+            "user": {"login": "dev", "id": 2},
+            "body": "",
+            "head": {"sha": "a" * 40, "ref": "feature/relay", "repo": repo},
+            "base": {"sha": "b" * 40, "ref": "main", "repo": repo},
+            "additions": 1200,
+            "deletions": 300,
+            "changed_files": 48,
+        },
+        "commits": [],
+    }
+    base = len(json.dumps(data).encode("utf-8"))
+    commit = {
+        "id": "c" * 40,
+        "message": "fix: 调整重试逻辑 adjust retry logic\n\n" + "detail " * 20,
+        "author": {"name": "dev", "email": "dev@example.com"},
+        "added": ["src/a.py"],
+        "modified": ["src/b.py", "src/c.py"],
+        "removed": [],
+    }
+    per_commit = len(json.dumps(commit).encode("utf-8")) + 1
+    n = max(0, (target_bytes - base) // per_commit)
+    data["commits"] = [dict(commit, id=f"{i:040x}") for i in range(n)]
+    body = json.dumps(data).encode("utf-8")
+    pad = target_bytes - len(body)
+    if pad > 0:
+        data["pull_request"]["body"] = "x" * pad
+        body = json.dumps(data).encode("utf-8")
+    return body
+
+
+def _time(fn, repeat: int) -> float:
+    """返回 repeat 次中位数耗时（毫秒）。"""
+    fn()  # 预热
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(samples)
+
+
+def _with_backend(name: str, fn):
+    """在指定 JSON 后端（json / orjson）下执行 fn。"""
+    saved = jsonutil.orjson
+    if name == "json":
+        jsonutil.orjson = None
+    try:
+        return fn()
+    finally:
+        jsonutil.orjson = saved
+
+
+def run(sizes: list[int], repeat: int) -> dict[str, dict[str, float]]:
+    backends = ["json"] + (["orjson"] if jsonutil.orjson is not None else [])
+    paths = projection.DEFAULT_PROJECTIONS["pull_request"]
+    results: dict[str, dict[str, float]] = {}
+    for size in sizes:
+        body = make_pull_request_payload(size)
+        signature = "sha256=" + hmac.new(SECRET.encode(), body, hashlib.sha256).hexdigest()
+        label = f"{len(body) // 1024}KB"
+        row: dict[str, float] = {
+            "verify_signature": _time(lambda: verify_signature(body, signature, SECRET), repeat),
+        }
+        parsed = parse_payload(body)
+        for backend in backends:
+            row[f"parse_payload[{backend}]"] = _with_backend(
+                backend, lambda: _time(lambda: parse_payload(body), repeat)
+            )
+            row[f"encode_body[{backend}]"] = _with_backend(
+                backend, lambda: _time(lambda: internal.encode_body({"event": "pull_request", **parsed}), repeat)
+            )
+        row["project"] = _time(lambda: projection.project(parsed["payload"], paths), repeat)
+        projected = {**parsed, "payload": projection.project(parsed["payload"], paths)}
+        row["bytes_full"] = float(len(jsonutil.dumps({"event": "pull_request", **parsed})))
+        row["bytes_projected"] = float(len(jsonutil.dumps({"event": "pull_request", **projected})))
+        results[label] = row
+    return results
+
+
+def _print(results: dict[str, dict[str, float]]) -> None:
+    for label, row in results.items():
+        print(f"== payload {label}")
+        for name, value in row.items():
+            if name.startswith("bytes_"):
+                print(f"  {name:<28} {int(value):>12} B")
+            else:
+                print(f"  {name:<28} {value:>12.3f} ms")
+
+
+def _compare(results, baseline, max_regression: float) -> list[str]:
+    regressions = []
+    for label, row in results.items():
+        for name, value in row.items():
+            old = baseline.get(label, {}).get(name)
+            if name.startswith("bytes_") or not old:
+                continue
+            if value > old * (1 + max_regression):
+                regressions.append(f"{label} {name}: {old:.3f} ms -> {value:.3f} ms (+{value / old - 1:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Webhook 热路径微基准")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"payload 大小列表，默认 {DEFAULT_SIZES}")
+    parser.add_argument("--repeat", type=int, default=10, help="每项重复次数（取中位数），默认 10")
+    parser.add_argument("--save", help="把结果保存为 JSON（可作为基线）")
+    parser.add_argument("--baseline", help="与之前保存的基线 JSON 对比")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="允许的最大变慢比例，默认 0.25")
+    args = parser.parse_args()
+
+    print(f"JSON 后端: {jsonutil.BACKEND}  压缩: {internal._compression}")
+    results = run([_parse_size(s) for s in args.sizes.split(",") if s], args.repeat)
+    _print(results)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"已保存: {args.save}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = _compare(results, baseline, args.max_regression)
+        if regressions:
+            print("性能回退:")
+            for line in regressions:
+                print("  " + line)
+            sys.exit(1)
+        print("未发现超过阈值的性能回退")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Delivery 去重：按 X-GitHub-Delivery 记录已受理的投递，GitHub 重投（手动 redeliver、超时重试）
+的重复事件直接应答，不再转发到内网、不会触发第二次 Code Review。
+内存中为有容量上限的 LRU + TTL 缓存，可选持久化到 SQLite，容器重启后仍然生效。
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+DEDUP_ENABLED = os.environ.get("DEDUP_ENABLED", "1").strip().lower() in ("1", "true", "yes")
+# 最多记录的 delivery 数，超出后淘汰最久未出现的
+DEDUP_MAX_SIZE = int(os.environ.get("DEDUP_MAX_SIZE", "10000"))
+# delivery 记录保留秒数，默认 24 小时
+DEDUP_TTL = float(os.environ.get("DEDUP_TTL", "86400"))
+# 是否持久化到 SQLite（1/true），默认 0 仅内存
+DEDUP_PERSIST = os.environ.get("DEDUP_PERSIST", "0").strip().lower() in ("1", "true", "yes")
+DEDUP_PATH = os.environ.get("DEDUP_PATH", "").strip() or str(
+    Path(__file__).resolve().parent / "data" / "dedup.db"
+)
+
+
+class DeliveryCache:
+    """LRU + TTL 的 delivery id 缓存；path 非空时同步写入 SQLite。"""
+
+    def __init__(self, max_size: int = DEDUP_MAX_SIZE, ttl: float = DEDUP_TTL, path: str | None = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.duplicates = 0
+        self._inserts = 0
+        self._entries: OrderedDict[str, float] = OrderedDict()
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def open(self) -> None:
+        if not self.path:
+            return
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS deliveries (id TEXT PRIMARY KEY, seen_at REAL NOT NULL)"
+        )
+        cutoff = time.time() - self.ttl
+        conn.execute("DELETE FROM deliveries WHERE seen_at < ?", (cutoff,))
+        rows = conn.execute(
+            "SELECT id, seen_at FROM deliveries ORDER BY seen_at DESC LIMIT ?", (self.max_size,)
+        ).fetchall()
+        for delivery_id, seen_at in reversed(rows):
+            self._entries[delivery_id] = seen_at
+        self._conn = conn
+        logger.info("delivery 去重缓存已加载 path=%s entries=%s", self.path, len(self._entries))
+
+    def close(self) -> None:
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+            self._conn = None
+
+    def _expire(self, now: float) -> None:
+        """从 LRU 头部淘汰已过期或超出容量的记录。"""
+        cutoff = now - self.ttl
+        while self._entries:
+            seen_at = next(iter(self._entries.values()))
+            if seen_at >= cutoff and len(self._entries) <= self.max_size:
+                break
+            self._entries.popitem(last=False)
+
+    def _persist_add(self, delivery_id: str, seen_at: float) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO deliveries (id, seen_at) VALUES (?, ?)", (delivery_id, seen_at)
+            )
+            self._inserts += 1
+            if self._inserts % 100 == 0:
+                # 定期清理过期及超出容量的记录
+                self._conn.execute(
+                    "DELETE FROM deliveries WHERE seen_at < ? OR id NOT IN "
+                    "(SELECT id FROM deliveries ORDER BY seen_at DESC LIMIT ?)",
+                    (seen_at - self.ttl, self.max_size),
+                )
+
+    def _persist_remove(self, delivery_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM deliveries WHERE id = ?", (delivery_id,))
+
+    async def claim(self, delivery_id: str) -> bool:
+        """
+        登记一次投递：首次出现返回 True；TTL 内重复出现返回 False（并刷新其 LRU 位置）。
+        检查与登记在同一步完成，并发的重复投递只会有一个返回 True。
+        """
+        now = time.time()
+        seen_at = self._entries.get(delivery_id)
+        if seen_at is not None and seen_at >= now - self.ttl:
+            self._entries.move_to_end(delivery_id)
+            self.duplicates += 1
+            return False
+        self._entries[delivery_id] = now
+        self._entries.move_to_end(delivery_id)
+        self._expire(now)
+        if self._conn is not None:
+            await asyncio.to_thread(self._persist_add, delivery_id, now)
+        return True
+
+    async def release(self, delivery_id: str) -> None:
+        """撤销登记（受理失败时调用），使 GitHub 的重投可以再次被处理。"""
+        self._entries.pop(delivery_id, None)
+        if self._conn is not None:
+            await asyncio.to_thread(self._persist_remove, delivery_id)
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "duplicates": self.duplicates,
+            "persistent": self._conn is not None,
+        }
@@ -0,0 +1,167 @@
+"""
+边缘过滤：在转发前按规则（事件类型、action、仓库、分支的通配符）决定是否转发到内网。
+不可能触发内网处理的事件直接在本地应答，省去一次内网转发。
+"""
+import json
+import logging
+import os
+from dataclasses import dataclass
+from fnmatch import fnmatchcase
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+# 规则文件（JSON）路径；未设置时全部转发（与旧行为一致）
+RELAY_FILTER_FILE = os.environ.get("RELAY_FILTER_FILE", "").strip()
+
+_MATCH_FIELDS = ("event", "action", "repo", "branch", "base_branch")
+
+
+@dataclass(frozen=True)
+class FilterRule:
+    """
+    一条过滤规则。各字段为通配符列表（fnmatch，区分大小写），None 表示不限；
+    所有已设置字段都匹配时规则命中，effect 为 allow 或 deny。
+    """
+
+    effect: str
+    event: tuple[str, ...] | None = None
+    action: tuple[str, ...] | None = None
+    repo: tuple[str, ...] | None = None
+    branch: tuple[str, ...] | None = None
+    base_branch: tuple[str, ...] | None = None
+
+    def matches(self, fields: dict[str, str]) -> bool:
+        for name in _MATCH_FIELDS:
+            patterns = getattr(self, name)
+            if patterns is not None and not any(fnmatchcase(fields[name], p) for p in patterns):
+                return False
+        return True
+
+    def describe(self) -> str:
+        conds = [
+            f"{name}={','.join(getattr(self, name))}"
+            for name in _MATCH_FIELDS
+            if getattr(self, name) is not None
+        ]
+        return f"{self.effect}({' '.join(conds) or '*'})"
+
+
+@dataclass
+class FilterConfig:
+    """规则列表（按顺序匹配，首条命中生效）与未命中时的默认动作。"""
+
+    rules: list[FilterRule]
+    default: str = "allow"
+
+
+def _as_patterns(value: Any) -> tuple[str, ...] | None:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return (value,)
+    return tuple(str(v) for v in value)
+
+
+def parse_rules(data: dict[str, Any]) -> FilterConfig:
+    """
+    解析规则 JSON，例如：
+    {"default": "deny", "rules": [{"effect": "deny", "event": "pull_request", "action": "closed"},
+                                  {"effect": "allow", "event": "pull_request", "repo": "owner/*"}]}
+    """
+    default = data.get("default", "allow")
+    if default not in ("allow", "deny"):
+        raise ValueError(f"default 必须为 allow 或 deny: {default!r}")
+    rules = []
+    for i, raw in enumerate(data.get("rules", [])):
+        effect = raw.get("effect", "allow")
+        if effect not in ("allow", "deny"):
+            raise ValueError(f"rules[{i}].effect 必须为 allow 或 deny: {effect!r}")
+        unknown = set(raw) - {"effect", *_MATCH_FIELDS}
+        if unknown:
+            raise ValueError(f"rules[{i}] 含未知字段: {sorted(unknown)}")
+        rules.append(FilterRule(effect, **{k: _as_patterns(raw.get(k)) for k in _MATCH_FIELDS}))
+    return FilterConfig(rules=rules, default=default)
+
+
+def load_rules(path: str = RELAY_FILTER_FILE) -> FilterConfig:
+    """从 JSON 文件加载规则；未配置或加载失败时全部转发。"""
+    if not path:
+        return FilterConfig(rules=[])
+    try:
+        with open(path, encoding="utf-8") as f:
+            config = parse_rules(json.load(f))
+    except Exception as e:
+        logger.error("加载过滤规则失败 path=%s error=%s，将转发全部事件", path, e)
+        return FilterConfig(rules=[])
+    logger.info(
+        "已加载过滤规则 path=%s rules=%s default=%s",
+        path,
+        [r.describe() for r in config.rules],
+        config.default,
+    )
+    return config
+
+
+def match_fields(event_name: str, payload: dict[str, Any]) -> dict[str, str]:
+    """从 parse_payload 的结果中取出用于匹配的字段。"""
+    data = payload.get("payload") or {}
+    pr = data.get("pull_request") or {}
+    return {
+        "event": event_name,
+        "action": data.get("action") or "",
+        "repo": payload.get("repo") or "",
+        "branch": payload.get("branch") or "",
+        "base_branch": (pr.get("base") or {}).get("ref") or "",
+    }
+
+
+class FilterStats:
+    """过滤计数：按事件类型统计转发/过滤的次数与 body 字节数。"""
+
+    def __init__(self):
+        self.forwarded: dict[str, int] = {}
+        self.filtered: dict[str, int] = {}
+        self.forwarded_bytes = 0
+        self.filtered_bytes = 0
+
+    def record(self, event_name: str, allowed: bool, body_size: int) -> None:
+        counter = self.forwarded if allowed else self.filtered
+        counter[event_name] = counter.get(event_name, 0) + 1
+        if allowed:
+            self.forwarded_bytes += body_size
+        else:
+            self.filtered_bytes += body_size
+
+    def snapshot(self) -> dict[str, Any]:
+        total_forwarded = sum(self.forwarded.values())
+        total_filtered = sum(self.filtered.values())
+        total = total_forwarded + total_filtered
+        return {
+            "forwarded": total_forwarded,
+            "filtered": total_filtered,
+            "filtered_ratio": round(total_filtered / total, 4) if total else 0.0,
+            "forwarded_bytes": self.forwarded_bytes,
+            "filtered_bytes": self.filtered_bytes,
+            "forwarded_by_event": dict(self.forwarded),
+            "filtered_by_event": dict(self.filtered),
+        }
+
+
+filter_config = load_rules()
+filter_stats = FilterStats()
+
+
+def reload_rules() -> None:
+    """重新加载规则文件（启动时调用，便于记录加载结果）。"""
+    global filter_config
+    filter_config = load_rules()
+
+
+def should_forward(event_name: str, payload: dict[str, Any]) -> tuple[bool, str]:
+    """按规则判断是否转发，返回 (是否转发, 命中规则描述)。"""
+    fields = match_fields(event_name, payload)
+    for rule in filter_config.rules:
+        if rule.matches(fields):
+            return rule.effect == "allow", rule.describe()
+    return filter_config.default == "allow", f"default({filter_config.default})"
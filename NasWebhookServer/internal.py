@@ -1,49 +1,495 @@
 """
 内网通信：通过 HTTP 调用内网 API（httpx）。
+使用进程内共享的连接池（keep-alive），由 main.lifespan 负责创建与关闭。
+失败时按指数退避 + 随机抖动重试（5xx/429 同样重试并遵循 Retry-After），
+内网持续不可用时由熔断器快速失败，并定期放行探测请求。
+内网以 429/503 + Retry-After 表示繁忙（背压）时暂停转发，到期后只放行一个探测请求，成功后恢复。
+请求 body 可按 INTERNAL_COMPRESSION 压缩（gzip/zstd，Content-Encoding 标明）。
 """
+import asyncio
+import gzip
 import logging
 import os
+import random
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
 from typing import Any
 
 import httpx
 
+import jsonutil
+import metrics
+
 logger = logging.getLogger(__name__)
 
 INTERNAL_TARGET_URL = os.environ.get("INTERNAL_TARGET_URL", "").rstrip("/")
 INTERNAL_TARGET_PATH = os.environ.get("INTERNAL_TARGET_PATH", "/webhook/trigger")
+# 批量接口路径（RELAY_BATCH_MAX > 1 时使用）
+INTERNAL_BATCH_PATH = os.environ.get("INTERNAL_BATCH_PATH", "/webhook/trigger/batch")
 INTERNAL_TIMEOUT = float(os.environ.get("INTERNAL_TIMEOUT", "20"))
 INTERNAL_RETRIES = int(os.environ.get("INTERNAL_RETRIES", "2"))
+# 重试退避：第 n 次重试前等待 [0, min(BACKOFF_MAX, BACKOFF_BASE * 2^n)] 间的随机秒数（full jitter）
+INTERNAL_BACKOFF_BASE = float(os.environ.get("INTERNAL_BACKOFF_BASE", "0.5"))
+INTERNAL_BACKOFF_MAX = float(os.environ.get("INTERNAL_BACKOFF_MAX", "10"))
+# Retry-After 超过该秒数时不在本次调用内等待，直接返回并交由调用方（outbox）稍后重投
+INTERNAL_RETRY_AFTER_MAX = float(os.environ.get("INTERNAL_RETRY_AFTER_MAX", "30"))
+# 熔断器：连续失败 INTERNAL_CB_FAILURES 次后打开，INTERNAL_CB_RESET 秒后放行一次探测
+INTERNAL_CB_FAILURES = int(os.environ.get("INTERNAL_CB_FAILURES", "5"))
+INTERNAL_CB_RESET = float(os.environ.get("INTERNAL_CB_RESET", "30"))
+# 是否遵循内网背压（429/503 + Retry-After）：暂停转发直到 Retry-After 到期（1/true 默认）
+INTERNAL_BACKPRESSURE = os.environ.get("INTERNAL_BACKPRESSURE", "1").strip().lower() in ("1", "true", "yes")
+# 背压暂停的最长秒数，以及在 Retry-After 上追加的随机比例（错开多个 NasWebhookServer 的恢复时间）
+INTERNAL_BACKPRESSURE_MAX = float(os.environ.get("INTERNAL_BACKPRESSURE_MAX", "900"))
+INTERNAL_BACKPRESSURE_JITTER = float(os.environ.get("INTERNAL_BACKPRESSURE_JITTER", "0.2"))
+# 连接池：最大连接数、最大保活连接数、保活连接空闲过期秒数
+INTERNAL_MAX_CONNECTIONS = int(os.environ.get("INTERNAL_MAX_CONNECTIONS", "20"))
+INTERNAL_MAX_KEEPALIVE = int(os.environ.get("INTERNAL_MAX_KEEPALIVE", "10"))
+INTERNAL_KEEPALIVE_EXPIRY = float(os.environ.get("INTERNAL_KEEPALIVE_EXPIRY", "30"))
+# 是否启用 HTTP/2（需安装 httpx[http2]，未安装时自动回退 HTTP/1.1）
+INTERNAL_HTTP2 = os.environ.get("INTERNAL_HTTP2", "0").strip().lower() in ("1", "true", "yes")
+# 请求 body 压缩：none / gzip / zstd（zstd 需安装 zstandard，未安装时回退 gzip）
+INTERNAL_COMPRESSION = os.environ.get("INTERNAL_COMPRESSION", "none").strip().lower()
+# 小于该字节数的 body 不压缩
+INTERNAL_COMPRESSION_MIN_BYTES = int(os.environ.get("INTERNAL_COMPRESSION_MIN_BYTES", "1024"))
+
+# 视为暂时性故障、需要重试的状态码
+RETRYABLE_STATUS = frozenset({429, 500, 502, 503, 504})
+# 带 Retry-After 时视为内网背压的状态码
+BACKPRESSURE_STATUS = frozenset({429, 503})
+
+_client: httpx.AsyncClient | None = None
 
 
-async def send_to_internal(event_type: str, payload: dict[str, Any]) -> bool:
+@dataclass
+class RelayResult:
     """
-    向内网 API 发送 POST 请求（JSON body）。
-    返回 True 表示 2xx 成功，否则 False 并记录日志。
+    一次内网调用的结果。可直接当 bool 使用（True 表示 2xx 成功）。
+    retry_after 为建议的下次重试等待秒数（来自 Retry-After、熔断器或背压），None 表示无建议。
+    backpressure 为 True 表示内网繁忙、事件未被处理，应原样保留稍后再投（不算一次失败）。
     """
-    if not INTERNAL_TARGET_URL:
-        logger.warning("INTERNAL_TARGET_URL 未配置，跳过内网调用")
+
+    ok: bool
+    status: int | None = None
+    error: str = ""
+    retry_after: float | None = None
+    backpressure: bool = False
+
+    def __bool__(self) -> bool:
+        return self.ok
+
+    @property
+    def retryable(self) -> bool:
+        """失败是否可能是暂时性的（网络异常、5xx/429、熔断）；4xx 等重试无意义。"""
+        return not self.ok and (self.status is None or self.status in RETRYABLE_STATUS)
+
+
+class CircuitBreaker:
+    """
+    简单熔断器：closed（正常）→ 连续失败达到阈值 → open（快速失败）
+    → reset_timeout 后 half_open（仅放行一个探测请求）→ 成功则 closed，失败则重新 open。
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def allow(self) -> bool:
+        """是否允许发出请求；open 状态下超过 reset_timeout 后放行一次探测。"""
+        if self.failure_threshold <= 0 or self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+            logger.info("熔断器进入 half_open，放行探测请求")
+        if self.state == "half_open" and not self._probing:
+            self._probing = True
+            return True
         return False
 
-    url = f"{INTERNAL_TARGET_URL}{INTERNAL_TARGET_PATH}"
-    body = {"event": event_type, **payload}
+    def retry_in(self) -> float:
+        """距离下次允许探测的剩余秒数。"""
+        if self.state != "open":
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self) -> None:
+        if self.state != "closed":
+            logger.info("熔断器关闭，内网恢复")
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probing = False
+        if self.failure_threshold <= 0:
+            return
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning(
+                    "熔断器打开：连续失败 %s 次，%s 秒内快速失败", self.failures, self.reset_timeout
+                )
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+breaker = CircuitBreaker(INTERNAL_CB_FAILURES, INTERNAL_CB_RESET)
+
+
+class Backpressure:
+    """
+    内网背压：收到 429/503 + Retry-After 后 hold，到期前不再发出请求；
+    到期后只放行一个探测请求，内网正常应答（release）后恢复转发，再次繁忙则重新 hold。
+    与熔断器不同，背压表示内网可达但暂时不接受新任务，不计入熔断失败。
+    """
+
+    def __init__(self, enabled: bool = INTERNAL_BACKPRESSURE):
+        self.enabled = enabled
+        self.held = False
+        self.until = 0.0
+        self.signals = 0
+        self.last_status: int | None = None
+        self.last_retry_after: float | None = None
+        self._probing = False
+
+    @property
+    def blocked(self) -> bool:
+        """是否处于背压中（hold 未到期，或探测请求尚未返回）。"""
+        return self.held and (time.monotonic() < self.until or self._probing)
+
+    def allow(self) -> bool:
+        """是否允许发出请求；hold 到期后放行一次探测。"""
+        if not self.held:
+            return True
+        if time.monotonic() < self.until or self._probing:
+            return False
+        self._probing = True
+        logger.info("背压到期，放行探测请求")
+        return True
+
+    def retry_in(self) -> float:
+        """距离 hold 到期的剩余秒数。"""
+        if not self.held:
+            return 0.0
+        return max(0.0, self.until - time.monotonic())
+
+    def hold(self, status: int, retry_after: float) -> float:
+        """记录一次背压信号，暂停转发；返回实际暂停的秒数（含随机抖动）。"""
+        delay = min(INTERNAL_BACKPRESSURE_MAX, retry_after * random.uniform(1, 1 + INTERNAL_BACKPRESSURE_JITTER))
+        self.signals += 1
+        self.last_status = status
+        self.last_retry_after = retry_after
+        self.held = True
+        self._probing = False
+        self.until = max(self.until, time.monotonic() + delay)
+        metrics.RELAY_BACKPRESSURE_SIGNALS.labels(status=str(status)).inc()
+        logger.warning("内网背压 status=%s Retry-After=%.1fs，暂停转发 %.1f 秒", status, retry_after, self.retry_in())
+        return delay
+
+    def release(self) -> None:
+        if self.held:
+            logger.info("内网背压解除，恢复转发")
+        self.held = False
+        self._probing = False
+        self.until = 0.0
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "held": self.blocked,
+            "retry_in": round(self.retry_in(), 1),
+            "signals": self.signals,
+            "last_status": self.last_status,
+            "last_retry_after": self.last_retry_after,
+        }
+
+
+backpressure = Backpressure()
+
+
+def _backpressure_signal(status: int, retry_after: float | None) -> bool:
+    """该应答是否为内网背压信号（开启 INTERNAL_BACKPRESSURE 且 429/503 带 Retry-After）。"""
+    return backpressure.enabled and status in BACKPRESSURE_STATUS and retry_after is not None
+
+
+def _backoff_delay(attempt: int) -> float:
+    """第 attempt 次（从 0 开始）失败后的等待秒数：指数退避 + full jitter。"""
+    return random.uniform(0, min(INTERNAL_BACKOFF_MAX, INTERNAL_BACKOFF_BASE * (2 ** attempt)))
+
+
+def _parse_retry_after(value: str | None) -> float | None:
+    """解析 Retry-After 头：支持秒数或 HTTP 日期。"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _resolve_compression() -> str:
+    if INTERNAL_COMPRESSION in ("", "none", "0", "false"):
+        return "none"
+    if INTERNAL_COMPRESSION == "zstd":
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            logger.warning("INTERNAL_COMPRESSION=zstd 但未安装 zstandard（pip install zstandard），回退 gzip")
+            return "gzip"
+        return "zstd"
+    if INTERNAL_COMPRESSION != "gzip":
+        logger.warning("未知的 INTERNAL_COMPRESSION=%s，回退 gzip", INTERNAL_COMPRESSION)
+    return "gzip"
+
+
+_compression = _resolve_compression()
+
+
+class RelayStats:
+    """转发字节统计：JSON 字节数（未压缩）与实际发送字节数。"""
+
+    def __init__(self):
+        self.requests = 0
+        self.json_bytes = 0
+        self.wire_bytes = 0
+
+    def record(self, json_bytes: int, wire_bytes: int) -> None:
+        self.requests += 1
+        self.json_bytes += json_bytes
+        self.wire_bytes += wire_bytes
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "compression": _compression,
+            "requests": self.requests,
+            "json_bytes": self.json_bytes,
+            "wire_bytes": self.wire_bytes,
+            "saved_ratio": round(1 - self.wire_bytes / self.json_bytes, 4) if self.json_bytes else 0.0,
+        }
+
+
+relay_stats = RelayStats()
+
+
+def encode_body(body: Any) -> tuple[bytes, dict[str, str]]:
+    """把请求体编码为 JSON 字节（orjson 可用时用 orjson），按配置压缩，返回 (content, headers)。"""
+    raw = jsonutil.dumps(body)
+    headers = {"Content-Type": "application/json"}
+    content = raw
+    if _compression != "none" and len(raw) >= INTERNAL_COMPRESSION_MIN_BYTES:
+        if _compression == "zstd":
+            import zstandard
+
+            content = zstandard.ZstdCompressor(level=3).compress(raw)
+        else:
+            content = gzip.compress(raw, compresslevel=6)
+        headers["Content-Encoding"] = _compression
+    relay_stats.record(len(raw), len(content))
+    return content, headers
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _build_client() -> httpx.AsyncClient:
+    http2 = INTERNAL_HTTP2
+    if http2 and not _http2_available():
+        logger.warning("INTERNAL_HTTP2 已开启但未安装 h2（pip install httpx[http2]），回退 HTTP/1.1")
+        http2 = False
+    limits = httpx.Limits(
+        max_connections=INTERNAL_MAX_CONNECTIONS,
+        max_keepalive_connections=INTERNAL_MAX_KEEPALIVE,
+        keepalive_expiry=INTERNAL_KEEPALIVE_EXPIRY,
+    )
+    logger.info(
+        "创建内网连接池 max_connections=%s max_keepalive=%s keepalive_expiry=%ss http2=%s",
+        INTERNAL_MAX_CONNECTIONS,
+        INTERNAL_MAX_KEEPALIVE,
+        INTERNAL_KEEPALIVE_EXPIRY,
+        http2,
+    )
+    return httpx.AsyncClient(timeout=INTERNAL_TIMEOUT, limits=limits, http2=http2)
+
+
+async def open_client() -> None:
+    """创建共享连接池（在 lifespan 启动时调用）。"""
+    global _client
+    if _client is None:
+        _client = _build_client()
+
+
+async def close_client() -> None:
+    """关闭共享连接池（在 lifespan 关闭时调用）。"""
+    global _client
+    if _client is not None:
+        client, _client = _client, None
+        await client.aclose()
+        logger.info("内网连接池已关闭")
+
+
+def _get_client() -> httpx.AsyncClient:
+    # 未经 lifespan 启动（如脚本直接调用）时按需创建
+    global _client
+    if _client is None:
+        _client = _build_client()
+    return _client
+
+
+async def _post_with_retries(
+    url: str, body: Any, kind: str = "single"
+) -> tuple[RelayResult, httpx.Response | None]:
+    """
+    POST body 到 url，复用共享连接池；kind（single/batch）用作指标标签。
+    网络异常与 5xx/429 按指数退避 + 抖动重试（遵循 Retry-After）；熔断器打开时直接失败。
+    内网背压（429/503 + Retry-After）与背压未解除时不重试，直接返回 backpressure 结果，由调用方保留事件。
+    返回 (结果, 最后一次的响应)；无响应（异常、熔断）时响应为 None。
+    """
+    content, headers = encode_body(body)
+    client = _get_client()
+    result = RelayResult(ok=False)
+    resp: httpx.Response | None = None
 
     for attempt in range(INTERNAL_RETRIES + 1):
+        if not breaker.allow():
+            logger.warning("熔断器打开，跳过内网调用 url=%s retry_in=%.1fs", url, breaker.retry_in())
+            metrics.RELAY_RESPONSES.labels(kind=kind, status="circuit_open").inc()
+            return RelayResult(ok=False, error="circuit open", retry_after=breaker.retry_in()), None
+        if not backpressure.allow():
+            logger.info("内网背压中，暂缓内网调用 url=%s retry_in=%.1fs", url, backpressure.retry_in())
+            metrics.RELAY_RESPONSES.labels(kind=kind, status="backpressure").inc()
+            return RelayResult(
+                ok=False, error="backpressure", retry_after=backpressure.retry_in(), backpressure=True
+            ), None
+
+        retry_after = None
+        t0 = time.perf_counter()
         try:
-            async with httpx.AsyncClient(timeout=INTERNAL_TIMEOUT) as client:
-                resp = await client.post(url, json=body)
+            resp = await client.post(url, content=content, headers=headers)
+            metrics.RELAY_SECONDS.labels(kind=kind).observe(time.perf_counter() - t0)
+            metrics.RELAY_RESPONSES.labels(kind=kind, status=str(resp.status_code)).inc()
             if 200 <= resp.status_code < 300:
-                logger.info("内网调用成功 url=%s status=%s", url, resp.status_code)
-                return True
+                breaker.record_success()
+                backpressure.release()
+                logger.info(
+                    "内网调用成功 url=%s status=%s http=%s", url, resp.status_code, resp.http_version
+                )
+                return RelayResult(ok=True, status=resp.status_code), resp
             logger.warning(
-                "内网调用非 2xx url=%s status=%s body=%s",
+                "内网调用非 2xx attempt=%s url=%s status=%s body=%s",
+                attempt + 1,
                 url,
                 resp.status_code,
                 resp.text[:500] if resp.text else "",
             )
-            return False
+            retry_after = _parse_retry_after(resp.headers.get("Retry-After"))
+            result = RelayResult(
+                ok=False, status=resp.status_code, error=f"HTTP {resp.status_code}", retry_after=retry_after
+            )
+            if _backpressure_signal(resp.status_code, retry_after):
+                # 内网繁忙：可达，不计入熔断；暂停转发直到 Retry-After 到期，本次不在调用内等待
+                breaker.record_success()
+                result.retry_after = backpressure.hold(resp.status_code, retry_after)
+                result.backpressure = True
+                return result, resp
+            backpressure.release()
+            if resp.status_code not in RETRYABLE_STATUS:
+                # 4xx 等非暂时性错误：重试无意义；内网可达，不计入熔断
+                breaker.record_success()
+                return result, resp
+            breaker.record_failure()
         except Exception as e:
+            metrics.RELAY_SECONDS.labels(kind=kind).observe(time.perf_counter() - t0)
+            metrics.RELAY_RESPONSES.labels(kind=kind, status="error").inc()
+            breaker.record_failure()
             logger.warning("内网调用异常 attempt=%s url=%s error=%s", attempt + 1, url, e)
-            if attempt == INTERNAL_RETRIES:
-                logger.error("内网调用最终失败 url=%s", url, exc_info=True)
-                return False
-    return False
+            # 探测请求未得到应答：交给熔断器处理，不再保持背压
+            backpressure.release()
+            result = RelayResult(ok=False, error=str(e) or type(e).__name__)
+            resp = None
+
+        if attempt == INTERNAL_RETRIES:
+            break
+        if retry_after is not None and retry_after > INTERNAL_RETRY_AFTER_MAX:
+            logger.warning("Retry-After=%.1fs 超过上限 %.1fs，交由调用方稍后重试", retry_after, INTERNAL_RETRY_AFTER_MAX)
+            return result, resp
+        delay = retry_after if retry_after is not None else _backoff_delay(attempt)
+        logger.info("内网调用 %.2f 秒后重试 url=%s", delay, url)
+        await asyncio.sleep(delay)
+
+    logger.error("内网调用最终失败 url=%s status=%s error=%s", url, result.status, result.error)
+    return result, resp
+
+
+async def send_to_internal(event_type: str, payload: dict[str, Any]) -> RelayResult:
+    """
+    向内网 API 发送单个事件（POST JSON body），失败按退避重试、受熔断器保护。
+    返回 RelayResult，成功（2xx）时为真值。
+    """
+    if not INTERNAL_TARGET_URL:
+        logger.warning("INTERNAL_TARGET_URL 未配置，跳过内网调用")
+        return RelayResult(ok=False, error="INTERNAL_TARGET_URL not configured")
+
+    url = f"{INTERNAL_TARGET_URL}{INTERNAL_TARGET_PATH}"
+    result, _resp = await _post_with_retries(url, {"event": event_type, **payload})
+    return result
+
+
+async def send_batch_to_internal(items: list[tuple[str, dict[str, Any]]]) -> list[RelayResult]:
+    """
+    把多个事件合并为一次 POST 发到内网批量接口（INTERNAL_BATCH_PATH），返回与 items 一一对应的结果。
+    内网不支持批量接口（404/405）时逐条回退到 send_to_internal。
+    """
+    if not INTERNAL_TARGET_URL:
+        logger.warning("INTERNAL_TARGET_URL 未配置，跳过内网调用")
+        return [RelayResult(ok=False, error="INTERNAL_TARGET_URL not configured") for _ in items]
+    if len(items) == 1:
+        return [await send_to_internal(*items[0])]
+
+    url = f"{INTERNAL_TARGET_URL}{INTERNAL_BATCH_PATH}"
+    body = {"items": [{"event": event_type, **payload} for event_type, payload in items]}
+    result, resp = await _post_with_retries(url, body, kind="batch")
+    if not result:
+        if result.status in (404, 405):
+            logger.warning("内网不支持批量接口 url=%s status=%s，逐条发送", url, result.status)
+            return [await send_to_internal(event_type, payload) for event_type, payload in items]
+        return [result] * len(items)
+
+    try:
+        entries = jsonutil.loads(resp.content)["results"]
+        if len(entries) != len(items):
+            raise ValueError(f"results 数量 {len(entries)} 与请求 {len(items)} 不一致")
+    except Exception as e:
+        logger.error("解析批量响应失败 url=%s error=%s", url, e)
+        return [RelayResult(ok=False, status=resp.status_code, error=f"bad batch response: {e}")] * len(items)
+
+    results = []
+    for entry in entries:
+        status = int(entry.get("status", 0)) if isinstance(entry, dict) else 0
+        result = RelayResult(ok=200 <= status < 300, status=status, error="" if 200 <= status < 300 else f"HTTP {status}")
+        retry_after = entry.get("retry_after") if isinstance(entry, dict) else None
+        if _backpressure_signal(status, retry_after):
+            # 逐条背压（内网队列在批量处理途中变满）：其余事件稍后再投
+            result.retry_after = float(retry_after)
+            result.backpressure = True
+        results.append(result)
+    pressured = [r for r in results if r.backpressure]
+    if pressured:
+        delay = backpressure.hold(pressured[0].status, max(r.retry_after for r in pressured))
+        for r in pressured:
+            r.retry_after = delay
+    logger.info("批量转发完成 url=%s items=%d ok=%d", url, len(items), sum(1 for r in results if r))
+    return results
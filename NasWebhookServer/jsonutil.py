@@ -0,0 +1,27 @@
+"""
+JSON 编解码：优先使用 orjson（C 实现，解析/序列化更快），未安装时回退标准库 json。
+dumps 统一返回 UTF-8 bytes（紧凑格式、不转义非 ASCII）。
+"""
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - 取决于部署环境
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def loads(data: bytes | str) -> Any:
+    """解析 JSON（bytes 或 str）。"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> bytes:
+    """序列化为紧凑的 UTF-8 JSON bytes。"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
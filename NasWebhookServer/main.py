@@ -3,6 +3,7 @@ NasWebhookServer：接收 GitHub Webhook，校验后通过 HTTP 转发到内网
 """
 import logging
 import os
+import time
 from pathlib import Path
 from contextlib import asynccontextmanager
 
@@ -14,8 +15,13 @@ load_dotenv(Path(__file__).resolve().parent / ".env")
 from fastapi import FastAPI, Request, Response
 from fastapi.responses import JSONResponse
 
-from github import verify_signature, parse_payload, EVENT_HEADER, SIGNATURE_HEADER
-from internal import send_to_internal
+from github import verify_signature, parse_payload, EVENT_HEADER, SIGNATURE_HEADER, DELIVERY_HEADER
+from internal import send_to_internal, open_client, close_client, relay_stats, backpressure
+from outbox import Outbox, OUTBOX_ENABLED, OUTBOX_WORKERS
+from filters import should_forward, filter_stats, reload_rules
+from projection import project_payload, projection_stats
+from dedup import DeliveryCache, DEDUP_ENABLED, DEDUP_PERSIST, DEDUP_PATH
+import metrics
 
 logging.basicConfig(
     level=logging.INFO,
@@ -25,11 +31,31 @@ logger = logging.getLogger(__name__)
 
 SECRET = os.environ.get("GITHUB_WEBHOOK_SECRET", "")
 
+outbox: Outbox | None = Outbox() if OUTBOX_ENABLED else None
+deliveries: DeliveryCache | None = (
+    DeliveryCache(path=DEDUP_PATH if DEDUP_PERSIST else None) if DEDUP_ENABLED else None
+)
+
 
 @asynccontextmanager
 async def lifespan(_app: FastAPI):
-    yield
-    # 可在此做关闭逻辑
+    # 共享内网连接池：整个进程复用 keep-alive 连接，避免每次转发都重新握手
+    reload_rules()
+    if deliveries is not None:
+        deliveries.open()
+    await open_client()
+    if outbox is not None:
+        outbox.open()
+        outbox.start(OUTBOX_WORKERS)
+    try:
+        yield
+    finally:
+        if outbox is not None:
+            await outbox.stop()
+            outbox.close()
+        await close_client()
+        if deliveries is not None:
+            deliveries.close()
 
 
 app = FastAPI(title="NasWebhookServer", lifespan=lifespan)
@@ -37,28 +63,91 @@ app = FastAPI(title="NasWebhookServer", lifespan=lifespan)
 
 @app.get("/")
 async def root():
-    return {"service": "NasWebhookServer", "webhook": "POST /webhook"}
+    info: dict = {"service": "NasWebhookServer", "webhook": "POST /webhook", "metrics": "GET /metrics"}
+    info["backpressure"] = backpressure.snapshot()
+    if outbox is not None:
+        info["outbox"] = await outbox.stats()
+    return info
+
+
+@app.get("/stats")
+async def stats():
+    """转发统计：边缘过滤、payload 投影与压缩前后的字节数、内网背压、outbox 积压情况。"""
+    result: dict = {
+        "filter": filter_stats.snapshot(),
+        "projection": projection_stats.snapshot(),
+        "relay": relay_stats.snapshot(),
+        "backpressure": backpressure.snapshot(),
+    }
+    if deliveries is not None:
+        result["dedup"] = deliveries.snapshot()
+    if outbox is not None:
+        result["outbox"] = await outbox.stats()
+    return result
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus 指标（文本格式）。"""
+    if not metrics.ENABLED:
+        return JSONResponse(status_code=503, content={"error": "prometheus_client not installed"})
+    if outbox is not None:
+        metrics.set_outbox(await outbox.stats())
+    metrics.set_backpressure(backpressure.snapshot())
+    content, content_type = metrics.render()
+    return Response(content=content, media_type=content_type)
+
+
+async def _release_delivery(delivery_id: str) -> None:
+    if deliveries is not None and delivery_id:
+        await deliveries.release(delivery_id)
 
 
 @app.post("/webhook")
 async def webhook(request: Request) -> Response:
+    try:
+        response = await _handle_webhook(request)
+    except Exception:
+        metrics.WEBHOOK_RESPONSES.labels(status="500").inc()
+        raise
+    metrics.WEBHOOK_RESPONSES.labels(status=str(response.status_code)).inc()
+    return response
+
+
+async def _handle_webhook(request: Request) -> Response:
     body = await request.body()
     signature_256 = request.headers.get(SIGNATURE_HEADER)
     event_name = request.headers.get(EVENT_HEADER, "")
+    delivery_id = request.headers.get(DELIVERY_HEADER, "")
     client_host = request.client.host if request.client else ""
 
     if not SECRET:
         logger.error("GITHUB_WEBHOOK_SECRET 未配置")
         return JSONResponse(status_code=500, content={"error": "server misconfiguration"})
 
-    if not verify_signature(body, signature_256, SECRET):
+    t0 = time.perf_counter()
+    verified = verify_signature(body, signature_256, SECRET)
+    metrics.SIGNATURE_SECONDS.observe(time.perf_counter() - t0)
+    if not verified:
         logger.warning("Webhook 签名校验失败 client=%s", client_host)
         return JSONResponse(status_code=401, content={"error": "invalid signature"})
 
+    # 重复投递（GitHub 重投同一 delivery）直接应答，不再转发
+    if deliveries is not None and delivery_id:
+        if not await deliveries.claim(delivery_id):
+            logger.info("重复投递，已忽略 event=%s delivery=%s", event_name, delivery_id)
+            return JSONResponse(
+                status_code=200,
+                content={"ok": True, "duplicate": True, "event": event_name, "delivery": delivery_id},
+            )
+
+    t0 = time.perf_counter()
     try:
         payload = parse_payload(body)
+        metrics.PARSE_SECONDS.observe(time.perf_counter() - t0)
     except Exception as e:
         logger.warning("解析 payload 失败: %s", e)
+        await _release_delivery(delivery_id)
         return JSONResponse(status_code=400, content={"error": "invalid payload"})
 
     logger.info(
@@ -69,8 +158,43 @@ async def webhook(request: Request) -> Response:
         client_host,
     )
 
+    # 边缘过滤：不可能触发内网处理的事件在本地直接应答，不占用内网转发
+    allowed, rule = should_forward(event_name, payload)
+    filter_stats.record(event_name, allowed, len(body))
+    if not allowed:
+        logger.info("事件已过滤，不转发 event=%s repo=%s rule=%s", event_name, payload.get("repo"), rule)
+        return JSONResponse(
+            status_code=200,
+            content={"ok": True, "filtered": True, "event": event_name, "rule": rule},
+        )
+
+    # 仅保留内网需要的字段（RELAY_PROJECTION 开启时）
+    payload = project_payload(event_name, payload, len(body))
+
+    if outbox is not None:
+        # 先落盘再应答：投递由后台 worker 完成，GitHub 不必等待内网
+        try:
+            event_id = await outbox.put(event_name, payload)
+        except Exception:
+            await _release_delivery(delivery_id)
+            raise
+        return JSONResponse(
+            status_code=202,
+            content={"ok": True, "queued": True, "event": event_name, "id": event_id},
+        )
+
     ok = await send_to_internal(event_name, payload)
     if not ok:
+        # 未成功受理：撤销去重登记，GitHub 重投时可再次转发
+        await _release_delivery(delivery_id)
+        if ok.backpressure:
+            # 内网繁忙：如实告知 GitHub（可在 Recent Deliveries 中按 Retry-After 之后手动重投）
+            retry_after = int(ok.retry_after or 0) + 1
+            return JSONResponse(
+                status_code=503,
+                content={"error": "internal backpressure", "event": event_name, "retry_after": retry_after},
+                headers={"Retry-After": str(retry_after)},
+            )
         return JSONResponse(
             status_code=502,
             content={"error": "internal relay failed", "event": event_name},
@@ -0,0 +1,254 @@
+"""
+持久化 outbox：校验通过的事件先写入本地 SQLite 再立即应答 GitHub，
+由后台投递 worker 从 outbox 取出事件转发到内网，Webhook 响应时间不再依赖内网。
+内网背压（429/503 + Retry-After）期间 worker 暂停取事件，被退回的事件原样延后，不计入投递次数。
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+import jsonutil
+from internal import RelayResult, backpressure, send_to_internal, send_batch_to_internal
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_ENABLED = os.environ.get("OUTBOX_ENABLED", "1").strip().lower() in ("1", "true", "yes")
+OUTBOX_PATH = os.environ.get("OUTBOX_PATH", "").strip() or str(
+    Path(__file__).resolve().parent / "data" / "outbox.db"
+)
+OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", "2"))
+# 单个事件最多投递次数，超过后标记为 dead 不再投递
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "20"))
+# 投递失败后的重试间隔：首次 OUTBOX_RETRY_DELAY 秒，之后翻倍，最多 OUTBOX_RETRY_MAX_DELAY 秒
+OUTBOX_RETRY_DELAY = float(os.environ.get("OUTBOX_RETRY_DELAY", "5"))
+OUTBOX_RETRY_MAX_DELAY = float(os.environ.get("OUTBOX_RETRY_MAX_DELAY", "300"))
+# 投递租约秒数：worker 取出事件后在此时间内独占，进程崩溃后租约过期即可被重新投递
+OUTBOX_LEASE_SECONDS = float(os.environ.get("OUTBOX_LEASE_SECONDS", "120"))
+# 批量转发：每次最多合并 RELAY_BATCH_MAX 个事件为一次请求（1 表示不合并）；
+# 取到的事件不足上限时再等待 RELAY_BATCH_WINDOW 秒收集后续事件
+RELAY_BATCH_MAX = int(os.environ.get("RELAY_BATCH_MAX", "1"))
+RELAY_BATCH_WINDOW = float(os.environ.get("RELAY_BATCH_WINDOW", "0.2"))
+# 空闲时轮询间隔（有新事件入队时会立即唤醒）
+OUTBOX_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", "1"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event TEXT NOT NULL,
+    body TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    next_attempt_at REAL NOT NULL,
+    locked_until REAL NOT NULL DEFAULT 0,
+    last_error TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_ready ON outbox (status, next_attempt_at);
+"""
+
+
+class Outbox:
+    """
+    SQLite outbox 及其投递 worker。
+    事件在投递成功后删除；多次失败后标记为 dead，保留在库中便于排查。
+    """
+
+    def __init__(self, path: str = OUTBOX_PATH):
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        self._wakeup = asyncio.Event()
+        self._workers: list[asyncio.Task] = []
+
+    # ----- 存储 -----
+
+    def open(self) -> None:
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        # 上次进程退出时未完成的投递：释放租约，立即重新投递
+        conn.execute(
+            "UPDATE outbox SET locked_until = 0 WHERE status = 'pending' AND locked_until > 0"
+        )
+        self._conn = conn
+        logger.info("outbox 已打开 path=%s pending=%s", self.path, self._count("pending"))
+
+    def close(self) -> None:
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+            self._conn = None
+
+    def _count(self, status: str) -> int:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM outbox WHERE status = ?", (status,)
+            ).fetchone()
+        return row[0]
+
+    def _insert(self, event: str, payload: dict[str, Any]) -> int:
+        now = time.time()
+        body = jsonutil.dumps(payload).decode("utf-8")
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO outbox (event, body, created_at, next_attempt_at) VALUES (?, ?, ?, ?)",
+                (event, body, now, now),
+            )
+        return cur.lastrowid
+
+    def _claim(self, limit: int) -> list[tuple[int, str, dict[str, Any], int]]:
+        """取出最多 limit 个到期事件并加租约，返回 [(id, event, payload, attempts)]。"""
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, event, body, attempts FROM outbox "
+                "WHERE status = 'pending' AND next_attempt_at <= ? AND locked_until <= ? "
+                "ORDER BY id LIMIT ?",
+                (now, now, limit),
+            ).fetchall()
+            if rows:
+                self._conn.executemany(
+                    "UPDATE outbox SET locked_until = ? WHERE id = ?",
+                    [(now + OUTBOX_LEASE_SECONDS, r[0]) for r in rows],
+                )
+        return [(r[0], r[1], jsonutil.loads(r[2]), r[3]) for r in rows]
+
+    def _ack(self, event_id: int) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM outbox WHERE id = ?", (event_id,))
+
+    def _retry(
+        self, event_id: int, attempts: int, error: str, delay: float | None = None, permanent: bool = False
+    ) -> bool:
+        """记录一次失败；返回 False 表示已超过最大次数（或 permanent 失败）并标记为 dead。"""
+        attempts += 1
+        if delay is None:
+            delay = min(OUTBOX_RETRY_MAX_DELAY, OUTBOX_RETRY_DELAY * (2 ** (attempts - 1)))
+        dead = permanent or (OUTBOX_MAX_ATTEMPTS > 0 and attempts >= OUTBOX_MAX_ATTEMPTS)
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET attempts = ?, last_error = ?, locked_until = 0, "
+                "next_attempt_at = ?, status = ? WHERE id = ?",
+                (attempts, error[:500], time.time() + delay, "dead" if dead else "pending", event_id),
+            )
+        return not dead
+
+    def _defer(self, event_id: int, delay: float, error: str) -> None:
+        """内网背压退回的事件：延后 delay 秒再投，不增加投递次数。"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET last_error = ?, locked_until = 0, next_attempt_at = ? WHERE id = ?",
+                (error[:500], time.time() + delay, event_id),
+            )
+
+    # ----- 异步接口 -----
+
+    async def put(self, event: str, payload: dict[str, Any]) -> int:
+        """持久化事件并唤醒投递 worker，返回 outbox id。"""
+        event_id = await asyncio.to_thread(self._insert, event, payload)
+        self._wakeup.set()
+        return event_id
+
+    async def stats(self) -> dict[str, int]:
+        pending = await asyncio.to_thread(self._count, "pending")
+        dead = await asyncio.to_thread(self._count, "dead")
+        return {"pending": pending, "dead": dead}
+
+    def start(self, workers: int = OUTBOX_WORKERS) -> None:
+        for i in range(max(1, workers)):
+            self._workers.append(asyncio.create_task(self._worker_loop(i + 1)))
+        logger.info("outbox 投递 worker 已启动 workers=%s", len(self._workers))
+
+    async def stop(self) -> None:
+        for t in self._workers:
+            t.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+        logger.info("outbox 投递 worker 已停止")
+
+    async def _worker_loop(self, worker_no: int) -> None:
+        batch_max = max(1, RELAY_BATCH_MAX)
+        while True:
+            try:
+                if backpressure.blocked:
+                    # 内网繁忙：事件留在 outbox，等 Retry-After 到期（或其它 worker 的探测请求返回）
+                    await asyncio.sleep(backpressure.retry_in() or OUTBOX_POLL_INTERVAL)
+                    continue
+                items = await asyncio.to_thread(self._claim, batch_max)
+                if not items:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if len(items) < batch_max and RELAY_BATCH_WINDOW > 0:
+                    # 突发流量时短暂等待，把随后到达的事件合并到同一次请求
+                    await asyncio.sleep(RELAY_BATCH_WINDOW)
+                    items += await asyncio.to_thread(self._claim, batch_max - len(items))
+                await self._deliver(worker_no, items)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception("[outbox-%s] worker 异常: %s", worker_no, e)
+                await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+    async def _deliver(
+        self, worker_no: int, items: list[tuple[int, str, dict[str, Any], int]]
+    ) -> None:
+        start_time = time.time()
+        if len(items) == 1:
+            results = [await send_to_internal(items[0][1], items[0][2])]
+        else:
+            results = await send_batch_to_internal([(event, payload) for _, event, payload, _ in items])
+        elapsed = time.time() - start_time
+        if len(items) > 1:
+            logger.info(
+                "[outbox-%s] 批量投递 items=%d 成功=%d 耗时 %.2f 秒",
+                worker_no, len(items), sum(1 for r in results if r), elapsed,
+            )
+        for item, result in zip(items, results):
+            await self._settle(worker_no, item, result, elapsed)
+
+    async def _settle(
+        self, worker_no: int, item: tuple[int, str, dict[str, Any], int], result: RelayResult, elapsed: float
+    ) -> None:
+        """根据投递结果删除事件或安排重试。"""
+        event_id, event, payload, attempts = item
+        if result:
+            await asyncio.to_thread(self._ack, event_id)
+            logger.info(
+                "[outbox-%s] 投递成功 id=%s event=%s repo=%s 耗时 %.2f 秒",
+                worker_no, event_id, event, payload.get("repo"), elapsed,
+            )
+            return
+        if result.backpressure:
+            delay = max(result.retry_after or 0.0, OUTBOX_POLL_INTERVAL)
+            await asyncio.to_thread(self._defer, event_id, delay, result.error or "backpressure")
+            logger.info(
+                "[outbox-%s] 内网背压，暂缓投递 id=%s event=%s status=%s %.1f 秒后重试",
+                worker_no, event_id, event, result.status, delay,
+            )
+            return
+        # 内网给出 Retry-After 或熔断器打开时按其建议延后，否则按 outbox 自身的指数间隔
+        delay = result.retry_after if result.retry_after else None
+        alive = await asyncio.to_thread(
+            self._retry, event_id, attempts, result.error or "relay failed", delay, not result.retryable
+        )
+        if alive:
+            logger.warning(
+                "[outbox-%s] 投递失败，稍后重试 id=%s event=%s attempts=%s error=%s",
+                worker_no, event_id, event, attempts + 1, result.error,
+            )
+        else:
+            logger.error(
+                "[outbox-%s] 投递失败且不再重试，标记为 dead id=%s event=%s attempts=%s error=%s",
+                worker_no, event_id, event, attempts + 1, result.error,
+            )
@@ -0,0 +1,150 @@
+"""
+payload 投影：转发前只保留内网需要的字段，减小 outbox 与内网转发的数据量。
+按事件类型配置保留的字段路径（点分隔，"*" 表示列表中的每个元素）。
+"""
+import json
+import logging
+import os
+from typing import Any
+
+import jsonutil
+
+logger = logging.getLogger(__name__)
+
+# 是否启用投影（1/true）；默认关闭，转发完整 payload（与旧行为一致）
+RELAY_PROJECTION = os.environ.get("RELAY_PROJECTION", "0").strip().lower() in ("1", "true", "yes")
+# 自定义投影字段（JSON 文件）：{"事件类型": ["字段路径", ...]}，覆盖同名事件的默认配置
+RELAY_PROJECTION_FILE = os.environ.get("RELAY_PROJECTION_FILE", "").strip()
+
+# 默认投影：覆盖 InternalCodeReviewServer（get_pr_info、webhook_trigger）用到的字段
+DEFAULT_PROJECTIONS: dict[str, list[str]] = {
+    "pull_request": [
+        "action",
+        "number",
+        "repository.full_name",
+        "repository.name",
+        "pull_request.number",
+        "pull_request.title",
+        "pull_request.html_url",
+        "pull_request.draft",
+        "pull_request.user.login",
+        "pull_request.head.sha",
+        "pull_request.head.ref",
+        "pull_request.base.sha",
+        "pull_request.base.ref",
+        "pull_request.additions",
+        "pull_request.deletions",
+        "pull_request.changed_files",
+    ],
+}
+
+_MISSING = object()
+
+
+def _extract(data: Any, parts: list[str]) -> Any:
+    """按路径取值；路径不存在时返回 _MISSING。"*" 段返回逐元素结果（缺失元素为 _MISSING）。"""
+    if not parts:
+        return data
+    head, rest = parts[0], parts[1:]
+    if head == "*":
+        if not isinstance(data, list):
+            return _MISSING
+        return [_extract(item, rest) for item in data]
+    if not isinstance(data, dict) or head not in data:
+        return _MISSING
+    return _extract(data[head], rest)
+
+
+def _merge(target: dict[str, Any], parts: list[str], value: Any) -> None:
+    """把 _extract 的结果写回 target 中 parts 对应的位置，保留原有嵌套结构。"""
+    head, rest = parts[0], parts[1:]
+    if not rest:
+        target[head] = value
+        return
+    if rest[0] != "*":
+        child = target.setdefault(head, {})
+        if isinstance(child, dict):
+            _merge(child, rest, value)
+        return
+    if len(rest) == 1:
+        target[head] = [item for item in value if item is not _MISSING]
+        return
+    slots = target.get(head)
+    if not isinstance(slots, list) or len(slots) != len(value):
+        slots = [{} for _ in value]
+        target[head] = slots
+    for slot, item in zip(slots, value):
+        if item is not _MISSING and isinstance(slot, dict):
+            _merge(slot, rest[1:], item)
+
+
+def project(data: dict[str, Any], paths: list[str]) -> dict[str, Any]:
+    """只保留 paths 中列出的字段，返回新的字典。"""
+    result: dict[str, Any] = {}
+    for path in paths:
+        parts = path.split(".")
+        value = _extract(data, parts)
+        if value is not _MISSING:
+            _merge(result, parts, value)
+    return result
+
+
+def load_projections(path: str = RELAY_PROJECTION_FILE) -> dict[str, list[str]]:
+    """默认投影 + 文件中的自定义投影；加载失败时仅用默认投影。"""
+    projections = dict(DEFAULT_PROJECTIONS)
+    if not path:
+        return projections
+    try:
+        with open(path, encoding="utf-8") as f:
+            custom = json.load(f)
+        for event_name, paths in custom.items():
+            projections[event_name] = [str(p) for p in paths]
+    except Exception as e:
+        logger.error("加载投影配置失败 path=%s error=%s，仅使用默认投影", path, e)
+    return projections
+
+
+class ProjectionStats:
+    """投影前后字节数统计（原始字节为 GitHub 请求 body 长度）。"""
+
+    def __init__(self):
+        self.events = 0
+        self.original_bytes = 0
+        self.projected_bytes = 0
+
+    def record(self, original: int, projected: int) -> None:
+        self.events += 1
+        self.original_bytes += original
+        self.projected_bytes += projected
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "enabled": RELAY_PROJECTION,
+            "events": self.events,
+            "original_bytes": self.original_bytes,
+            "projected_bytes": self.projected_bytes,
+            "saved_ratio": round(1 - self.projected_bytes / self.original_bytes, 4)
+            if self.original_bytes
+            else 0.0,
+        }
+
+
+projections = load_projections()
+projection_stats = ProjectionStats()
+
+
+def project_payload(event_name: str, parsed: dict[str, Any], original_size: int) -> dict[str, Any]:
+    """
+    对 parse_payload 的结果做投影：仅替换其中的 "payload"，repo/branch/commit 等摘要字段保留。
+    未启用投影或该事件类型没有配置时原样返回。
+    """
+    paths = projections.get(event_name) if RELAY_PROJECTION else None
+    if not paths:
+        return parsed
+    projected = {**parsed, "payload": project(parsed.get("payload") or {}, paths)}
+    projected_size = len(jsonutil.dumps(projected))
+    projection_stats.record(original_size, projected_size)
+    logger.info(
+        "payload 投影 event=%s 原始=%d 字节 投影后=%d 字节", event_name, original_size, projected_size
+    )
+    return projected